@@ -0,0 +1,233 @@
+"""Replay archived roster exports into the SCD2 history in one pass.
+
+Loading months of exports by re-uploading them costs a BigQuery read, a load
+job and a scheduled-query trigger per file. This entry point parses every
+export under a directory or gs:// prefix in parallel, replays them in date
+order against an in-memory current state exactly as successive process_file
+calls would (each file's date standing in for the day it was processed), and
+writes the resulting history and current state in one transaction:
+
+    python backfill.py gs://bucket/archive/ --workers 4
+    python backfill.py ./exports --local-dir ./backfill_out    # fully offline
+
+A file's date is taken from the first YYYY-MM-DD / YYYYMMDD in its name,
+otherwise from its modification time. With --local-dir the history and
+current-state tables are written there as Parquet and nothing touches GCP.
+Otherwise the history table's upload lease is held while the starting state
+is read and the history written, and uploads queued on it meanwhile are
+upserted afterwards. With the GCS lease backend the leases live in
+LEASE_BUCKET, or in the bucket given by --lease-bucket, which must be the
+bucket uploads land in for process_file to see the lease.
+"""
+import argparse
+import logging
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+
+import fsspec
+import pandas as pd
+
+from excel_to_pandas import load_excel_to_dataframe, get_roster_schema, get_table_schema
+from scd2_diff import KEY_COLUMN, ROW_HASH_COLUMN, records_to_insert, compute_row_hash
+from snapshot_cache import normalize_snapshot
+from sharded_diff import diff_rosters, fingerprint_split
+
+EXPORT_SUFFIXES = ('.xlsx', '.xlsm', '.csv', '.parquet')
+DATE_IN_NAME = re.compile(r'(20\d{2})-?(\d{2})-?(\d{2})')
+
+
+def _export_date(path, info):
+    match = DATE_IN_NAME.search(os.path.basename(path))
+    if match:
+        try:
+            return date(*map(int, match.groups()))
+        except ValueError:
+            pass
+    modified = info.get('mtime') or info.get('updated') or info.get('timeCreated')
+    if isinstance(modified, (int, float)):
+        return datetime.fromtimestamp(modified).date()
+    return pd.Timestamp(modified).date()
+
+
+def list_exports(source):
+    """Return (run_date, path) for every export under a directory or gs:// prefix, oldest first."""
+    fs, root = fsspec.core.url_to_fs(source)
+    protocol = fs.protocol if isinstance(fs.protocol, str) else fs.protocol[0]
+    exports = []
+    for path, info in fs.find(root, detail=True).items():
+        if path.lower().endswith(EXPORT_SUFFIXES) and not os.path.basename(path).startswith('~$'):
+            url = path if protocol == 'file' else f"{protocol}://{path}"
+            exports.append((_export_date(path, info), url))
+    return sorted(exports)
+
+
+def _parse(export):
+    run_date, path = export
+    return load_excel_to_dataframe(path, current_date=run_date)
+
+
+def parse_exports(exports, workers):
+    """Parse the exports in worker processes; results keep the input order."""
+    if workers <= 1:
+        return [_parse(export) for export in exports]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_parse, exports))
+
+
+def replay_export(current, df_new, run_date, schema=None):
+    """Apply one parsed export to the current state the way process_roster does.
+
+    Returns (records, current, diff): the rows the export appends to history,
+    the current state afterwards, as the current-state table would then hold
+    it, and the Scd2Diff the records came from (None when nothing changed).
+    """
+    schema = schema or get_roster_schema()
+    columns_to_check = schema.names
+    unchanged = pd.DataFrame(columns=columns_to_check), current, None
+    df_new = df_new.dropna(subset=[KEY_COLUMN])
+    if df_new.empty:
+        return unchanged
+
+    df_existing = df_new.iloc[0:0]  # First load: every row is a new hire
+    if not current.empty:
+        changed_ids, new_ids = fingerprint_split(df_new, current, schema.compared_types)
+        if not changed_ids and not new_ids:
+            return unchanged
+        df_new = df_new[df_new[KEY_COLUMN].isin(changed_ids + new_ids)]
+        df_existing = current[current[KEY_COLUMN].isin(changed_ids)].drop(columns=[ROW_HASH_COLUMN])
+
+    # Both sides already follow the compiled schema, as in process_roster
+    df_existing = df_existing.reindex(columns=columns_to_check)
+    df_new = df_new.reindex(columns=columns_to_check)
+    schema.share_categories(df_new, df_existing)
+    diff = diff_rosters(df_existing, df_new, columns_to_check, run_date)
+    records = records_to_insert(diff)
+    opened = records_to_insert(diff._replace(closed=diff.closed.iloc[0:0]))
+
+    if opened.empty:
+        return records, current, diff
+    opened = opened.drop_duplicates(subset=[KEY_COLUMN], keep='first')
+    opened = normalize_snapshot(opened.assign(**{ROW_HASH_COLUMN: compute_row_hash(opened, schema.compared_types)}), schema)
+    kept = current[~current[KEY_COLUMN].isin(opened[KEY_COLUMN])]
+    current = pd.concat([kept, opened], ignore_index=True) if not kept.empty else opened.reset_index(drop=True)
+    return records, current, diff
+
+
+def replay_exports(exports, frames, current):
+    """Replay parsed exports in order; returns (history, current)."""
+    history = []
+    for (run_date, path), df_new in zip(exports, frames):
+        if df_new.empty:
+            logging.warning(f"Skipping {path}: no roster rows could be loaded.")
+            continue
+        records, current, _ = replay_export(current, df_new, run_date)
+        logging.info(f"{run_date} {path}: {len(records)} records, {len(current)} current employees.")
+        if not records.empty:
+            history.append(records)
+    if not history:
+        return pd.DataFrame(columns=get_roster_schema().names), current
+    return pd.concat(history, ignore_index=True), current
+
+
+def write_local(history, current, local_dir):
+    """Write both tables as Parquet, with row hashes as the pipeline would store them."""
+    os.makedirs(local_dir, exist_ok=True)
+    fingerprint_types = get_roster_schema().compared_types
+    history = normalize_snapshot(history.assign(**{ROW_HASH_COLUMN: compute_row_hash(history, fingerprint_types)}))
+    history.to_parquet(os.path.join(local_dir, 'history.parquet'), index=False)
+    current.to_parquet(os.path.join(local_dir, 'current.parquet'), index=False)
+    logging.info(f"Wrote {len(history)} history rows and {len(current)} current rows to {local_dir}.")
+
+
+def write_bigquery(history, current):
+    """Append the history and refresh the current-state table to match, in one transaction."""
+    from gcp_clients import get_bigquery_client
+    from merge_upsert import append_and_refresh
+    from snapshot_cache import invalidate_snapshot
+    from config import DATASET_NAME, TABLE_NAME, CURRENT_TABLE_NAME
+
+    if history.empty:
+        logging.info("The exports change nothing; leaving the tables as they are.")
+        return
+    # current holds every employee of the starting state, so refreshing them all replaces the table
+    try:
+        append_and_refresh(get_bigquery_client(), history, current.drop(columns=[ROW_HASH_COLUMN], errors='ignore'),
+                           DATASET_NAME, TABLE_NAME, CURRENT_TABLE_NAME)
+    finally:
+        invalidate_snapshot(DATASET_NAME, CURRENT_TABLE_NAME)
+    logging.info(f"Backfilled {len(history)} records; {CURRENT_TABLE_NAME} now holds {len(current)} employees.")
+
+
+def read_starting_state():
+    """Current state to replay on top of: the live current-state table, if any."""
+    from gcp_clients import get_bigquery_client, table_exists
+    from excel_to_pandas import create_table
+    from bigquery_upsert import ensure_row_hash_column, mark_text_format, require_text_format, ensure_current_table
+    from snapshot_cache import load_snapshot
+    from config import DATASET_NAME, TABLE_NAME, CURRENT_TABLE_NAME
+
+    client = get_bigquery_client()
+    if not table_exists(client, DATASET_NAME, TABLE_NAME):
+        create_table(client, DATASET_NAME, TABLE_NAME, get_table_schema(get_roster_schema()))
+        mark_text_format(client, DATASET_NAME, TABLE_NAME)
+    ensure_row_hash_column(client, DATASET_NAME, TABLE_NAME)
+    ensure_current_table(client, DATASET_NAME, TABLE_NAME, CURRENT_TABLE_NAME)
+    require_text_format(client, DATASET_NAME, [TABLE_NAME, CURRENT_TABLE_NAME])
+    return load_snapshot(client, DATASET_NAME, CURRENT_TABLE_NAME)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('source', help='directory or gs:// prefix holding the exports')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='parallel parser processes')
+    parser.add_argument('--local-dir', help='write Parquet output here instead of BigQuery')
+    parser.add_argument('--no-trigger', action='store_true', help='do not start the scheduled query afterwards')
+    parser.add_argument('--lease-bucket', help='bucket holding the table leases, when LEASE_BUCKET is not set')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+
+    leases = None
+    if not args.local_dir:
+        from table_lease import get_leases
+        try:
+            leases = get_leases(args.lease_bucket)
+        except ValueError as e:
+            parser.error(f"{e} Pass --lease-bucket with the bucket uploads land in.")
+
+    exports = list_exports(args.source)
+    if not exports:
+        logging.error(f"No exports found under {args.source}.")
+        return
+    logging.info(f"Replaying {len(exports)} exports from {exports[0][0]} to {exports[-1][0]}.")
+
+    # Parsed before taking the lease, as the exports do not depend on the tables
+    frames = parse_exports(exports, args.workers)
+    if args.local_dir:
+        history, current = replay_exports(exports, frames, normalize_snapshot(pd.DataFrame()))
+        write_local(history, current, args.local_dir)
+        return
+
+    from table_lease import held_lease, table_lease_name
+    from config import DATASET_NAME, TABLE_NAME
+
+    # Uploads arriving while the history is replayed and written wait in the lease's queue
+    name = table_lease_name(DATASET_NAME, TABLE_NAME)
+    with held_lease(leases, name) as renew_lease:
+        history, current = replay_exports(exports, frames, read_starting_state())
+        renew_lease()
+        write_bigquery(history, current)
+    if leases is not None:
+        from main import process_queued
+        process_queued(name, leases, args.lease_bucket)
+
+    if not args.no_trigger and not history.empty:
+        from main import trigger_scheduled_query
+        from scheduled_query import wait_for_runs
+        trigger_scheduled_query()
+        wait_for_runs()
+
+
+if __name__ == '__main__':
+    main()
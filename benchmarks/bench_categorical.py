@@ -0,0 +1,56 @@
+"""Measure what holding the low-cardinality roster columns as categoricals saves.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_categorical --employees 200000
+
+Both frames of a synthetic diff (see bench_scd2_diff) are conformed to the
+roster schema and given shared categories, as upsert_to_bigquery does, then
+compared with plain-string copies of the same columns: memory held by the
+categorical columns, and time for diff_scd2's change check on them.
+"""
+import argparse
+import time
+
+from benchmarks.bench_scd2_diff import make_frames
+from excel_to_pandas import get_roster_schema
+from scd2_diff import KEY_COLUMN, _changed
+
+
+def aligned_frames(n_employees):
+    """Current row and new row of every employee present on both sides, row for row."""
+    existing, new = make_frames(n_employees)
+    new = new.drop_duplicates(KEY_COLUMN)
+    existing = existing.drop_duplicates(KEY_COLUMN).set_index(KEY_COLUMN)
+    new = new[new[KEY_COLUMN].isin(existing.index)].reset_index(drop=True)
+    existing = existing.loc[new[KEY_COLUMN]].reset_index()
+    return existing, new
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--employees', type=int, default=200_000)
+    parser.add_argument('--repeat', type=int, default=5, help='runs per representation; the fastest is kept')
+    args = parser.parse_args()
+    schema = get_roster_schema()
+
+    columns = schema.categorical_columns
+    existing, new = aligned_frames(args.employees)
+    categorical = [schema.conform(existing.copy()), schema.conform(new.copy())]
+    schema.share_categories(*categorical)
+    plain = [df[columns].astype(object) for df in categorical]
+
+    print(f"employees={args.employees} columns={','.join(columns)}")
+    print(f"{'representation':<15} {'memory_mb':>10} {'compare_ms':>11} {'changed':>8}")
+    for label, (old, new_) in [('object', plain), ('categorical', categorical)]:
+        memory = sum(df[columns].memory_usage(deep=True, index=False).sum() for df in (old, new_)) / 2**20
+        best = float('inf')
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            changed = sum(int(_changed(old[col], new_[col]).sum()) for col in columns)
+            best = min(best, time.perf_counter() - start)
+        print(f"{label:<15} {memory:>10.1f} {best * 1000:>11.1f} {changed:>8}")
+
+
+if __name__ == '__main__':
+    main()
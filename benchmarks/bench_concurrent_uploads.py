@@ -0,0 +1,140 @@
+"""Check that concurrent uploads stay correct with table leases, and time them.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_concurrent_uploads --employees 2000 --uploads 4 --latency 0.1
+
+A first export is loaded and back-dated to yesterday. The next --uploads
+exports then arrive at once, each handled by its own thread as a separate
+instance would:
+
+    unguarded   every upload runs process_roster straight away, as with
+                LEASE_BACKEND=none
+    leased      every upload goes through run_serialized with SQLite leases;
+                uploads queued behind the holder are upserted as one batch
+
+Yesterday's versions can be closed at most once. An uncoordinated run closes
+some of them twice, each time with its own successor; double_closed counts
+those employees. The leased run must show none. Its history must also match
+a sequential run of the same exports in arrival order, which same_as_sequential
+reports. --latency delays every warehouse call, as BigQuery round trips do,
+which widens the window in which unguarded runs overlap.
+"""
+import argparse
+import logging
+import os
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+# The pipeline reads its settings at import; keep the snapshot cache local and throwaway
+os.environ.setdefault('SNAPSHOT_CACHE_DIR', tempfile.mkdtemp(prefix='bench_snapshot_'))
+os.environ['SNAPSHOT_BUCKET'] = ''
+
+import main  # noqa: E402
+import snapshot_cache  # noqa: E402
+from benchmarks.bench_overlap import SlowClient  # noqa: E402
+from benchmarks.roster_generator import write_export_series  # noqa: E402
+from config import PROJECT_ID, DATASET_NAME, TABLE_NAME, CURRENT_TABLE_NAME  # noqa: E402
+from gcp_clients import set_bigquery_client  # noqa: E402
+from local_warehouse import LocalWarehouseClient  # noqa: E402
+from pipelines import default_pipeline  # noqa: E402
+from table_lease import SQLiteLeases  # noqa: E402
+
+HISTORY_ID = f"{PROJECT_ID}.{DATASET_NAME}.{TABLE_NAME}"
+CURRENT_ID = f"{PROJECT_ID}.{DATASET_NAME}.{CURRENT_TABLE_NAME}"
+
+# Gap between upload arrivals, so the queue order is the export order
+ARRIVAL_GAP_SECONDS = 0.02
+
+
+def seed(client, first_export):
+    """Load the first export and date its versions yesterday."""
+    if not main.process_roster(first_export):
+        raise RuntimeError("Loading the first export failed.")
+    yesterday = (date.today() - timedelta(days=1)).isoformat()
+    for table_id in (HISTORY_ID, CURRENT_ID):
+        client.query(f"UPDATE `{table_id}` SET start_date = '{yesterday}', end_date = '{yesterday}'").result()
+    snapshot_cache.invalidate_snapshot(DATASET_NAME, CURRENT_TABLE_NAME)
+
+
+def history(client):
+    return client.query(f"SELECT * FROM `{HISTORY_ID}`").to_dataframe()
+
+
+def double_closed(df):
+    """Employees whose back-dated version was closed more than once."""
+    yesterday, today = date.today() - timedelta(days=1), date.today()
+    closing = df[(df['start_date'] == yesterday) & (df['end_date'] == today)]
+    counts = closing.groupby('emp_id').size()
+    return int((counts > 1).sum())
+
+
+def same_rows(left, right):
+    columns = [col for col in left.columns if col != 'row_hash']
+    left = left[columns].astype(str).sort_values(columns).reset_index(drop=True)
+    right = right[columns].astype(str).sort_values(columns).reset_index(drop=True)
+    return left.equals(right)
+
+
+def run(exports, latency, mode, lease_path=None):
+    """Process exports[1:] concurrently on a freshly seeded warehouse; returns (seconds, history)."""
+    client = LocalWarehouseClient()
+    set_bigquery_client(SlowClient(client, latency))
+    snapshot_cache.invalidate_snapshot(DATASET_NAME, CURRENT_TABLE_NAME)
+    try:
+        seed(client, exports[0])
+        pipeline = default_pipeline()
+
+        def upload(path):
+            if mode == 'sequential':
+                main.process_roster(path)
+            elif mode == 'unguarded':
+                main.process_roster(path)
+            else:
+                entry = {'file_path': path, 'bucket': 'local', 'name': os.path.basename(path), 'generation': 1}
+                main.run_serialized([pipeline], entry, SQLiteLeases(lease_path))
+
+        start = time.perf_counter()
+        if mode == 'sequential':
+            for path in exports[1:]:
+                upload(path)
+        else:
+            threads = []
+            for path in exports[1:]:
+                threads.append(threading.Thread(target=upload, args=(path,)))
+                threads[-1].start()
+                time.sleep(ARRIVAL_GAP_SECONDS)
+            for thread in threads:
+                thread.join()
+        return time.perf_counter() - start, history(client)
+    finally:
+        set_bigquery_client(None)
+        snapshot_cache.invalidate_snapshot(DATASET_NAME, CURRENT_TABLE_NAME)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--employees', type=int, default=2_000)
+    parser.add_argument('--uploads', type=int, default=4, help='exports arriving at the same time')
+    parser.add_argument('--latency', type=float, default=0.1, help='seconds added to every warehouse call')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)  # The pipeline logs every stage at INFO
+    main.trigger_scheduled_query = lambda ledger=None: None
+
+    with tempfile.TemporaryDirectory(prefix='bench_rosters_') as workdir:
+        exports = write_export_series(workdir, args.employees, exports=args.uploads + 1)
+        sequential_s, expected = run(exports, args.latency, 'sequential')
+        unguarded_s, unguarded = run(exports, args.latency, 'unguarded')
+        leased_s, leased = run(exports, args.latency, 'leased', os.path.join(workdir, 'leases.sqlite'))
+
+    print(f"employees={args.employees} uploads={args.uploads} latency={args.latency}s")
+    print(f"{'mode':<11} {'seconds':>8} {'history':>8} {'double_closed':>14} {'same_as_sequential':>19}")
+    for mode, seconds, df in [('sequential', sequential_s, expected), ('unguarded', unguarded_s, unguarded),
+                              ('leased', leased_s, leased)]:
+        print(f"{mode:<11} {seconds:>8.3f} {len(df):>8} {double_closed(df):>14} {str(same_rows(df, expected)):>19}")
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,109 @@
+"""Compare parse throughput of the upload formats the reader accepts.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_formats --employees 50000
+
+One synthetic roster (see roster_generator) is written as an xlsx workbook,
+a CSV file as Excel saves it, and a Parquet file with typed columns. Each
+is parsed from memory with load_excel_to_dataframe, as load_sheet parses a
+downloaded upload; xlsx once per engine installed. Every result must equal
+the openpyxl frame, which same_as_xlsx reports.
+"""
+import argparse
+import csv
+import io
+import logging
+import os
+import tempfile
+import time
+
+import pandas as pd
+
+import excel_to_pandas
+from benchmarks.roster_generator import HEADERS, generate_roster, write_roster
+from excel_to_pandas import ROSTER_COLUMN_COUNT, get_roster_schema, load_excel_to_dataframe
+
+COLUMNS = get_roster_schema().names[:ROSTER_COLUMN_COUNT]
+HEADER = [HEADERS.get(col, col.replace('_', ' ').title()) for col in COLUMNS]
+
+
+def write_csv(path, rows):
+    """Rows as Excel's CSV export writes them: dates as text, blanks as '-'."""
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(HEADER)
+        for row in rows:
+            writer.writerow([row[col].date().isoformat() if hasattr(row[col], 'date') else row[col] for col in COLUMNS])
+    return path
+
+
+def write_parquet(path, rows):
+    """Rows as a typed table: dates as timestamps with '-' as NULL, mixed columns as text."""
+    df = pd.DataFrame([[row[col] for col in COLUMNS] for row in rows], columns=HEADER)
+    for col, name in zip(COLUMNS, HEADER):
+        if col in get_roster_schema().date_columns:
+            df[name] = pd.to_datetime(df[name].mask(df[name].eq('-')))
+        elif df[name].map(type).nunique() > 1:
+            df[name] = df[name].astype(str)
+    df.to_parquet(path, index=False)
+    return path
+
+
+def engines():
+    """xlsx engines to time; calamine only when python-calamine is installed."""
+    try:
+        import python_calamine  # noqa: F401
+        return ['openpyxl', 'calamine']
+    except ImportError:
+        return ['openpyxl']
+
+
+def parse(data, name, file_format, repeat):
+    """Fastest of repeat parses of an upload held in memory; returns (seconds, frame)."""
+    best, df = float('inf'), None
+    for _ in range(repeat):
+        upload = io.BytesIO(data)
+        upload.name = name
+        start = time.perf_counter()
+        df = load_excel_to_dataframe(upload, file_format=file_format)
+        best = min(best, time.perf_counter() - start)
+    return best, df
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--employees', type=int, default=50_000)
+    parser.add_argument('--repeat', type=int, default=3, help='parses per format; the fastest is kept')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)  # The reader logs every load at INFO
+
+    rows = generate_roster(args.employees)
+    with tempfile.TemporaryDirectory(prefix='bench_formats_') as workdir:
+        paths = {
+            'xlsx': write_roster(os.path.join(workdir, 'roster.xlsx'), rows),
+            'csv': write_csv(os.path.join(workdir, 'roster.csv'), rows),
+            'parquet': write_parquet(os.path.join(workdir, 'roster.parquet'), rows),
+        }
+        uploads = {}
+        for file_format, path in paths.items():
+            with open(path, 'rb') as file:
+                uploads[file_format] = (file.read(), os.path.basename(path))
+
+    runs = [('xlsx', engine) for engine in engines()] + [('csv', 'pyarrow'), ('parquet', 'pyarrow')]
+    print(f"employees={args.employees}" + ('' if 'calamine' in engines() else ' (python-calamine not installed)'))
+    print(f"{'format':<8} {'engine':<9} {'size_mb':>8} {'seconds':>8} {'rows_per_s':>11} {'mb_per_s':>9} {'same_as_xlsx':>13}")
+    expected = None
+    for file_format, engine in runs:
+        data, name = uploads[file_format]
+        excel_to_pandas.XLSX_ENGINE = engine if file_format == 'xlsx' else 'auto'
+        excel_to_pandas.xlsx_engine.cache_clear()
+        seconds, df = parse(data, name, file_format, args.repeat)
+        expected = df if expected is None else expected
+        size = len(data) / 2**20
+        print(f"{file_format:<8} {engine:<9} {size:>8.1f} {seconds:>8.3f} {len(df) / seconds:>11.0f} "
+              f"{size / seconds:>9.1f} {str(df.equals(expected)):>13}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Measure how much OVERLAP_IO shortens process_roster when BigQuery calls are slow.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_overlap --employees 10000 --latency 0.3
+
+The local warehouse answers in microseconds, which hides the round trips
+that dominate in production, so every client call is delayed by --latency
+seconds (BigQuery metadata calls and short queries typically take 0.2-1 s).
+For each mode a first export is loaded untimed, the cached snapshot is
+dropped so the read is paid again, and processing the second export is timed.
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+# The pipeline reads its settings at import; keep the snapshot cache local and throwaway
+os.environ.setdefault('SNAPSHOT_CACHE_DIR', tempfile.mkdtemp(prefix='bench_snapshot_'))
+os.environ['SNAPSHOT_BUCKET'] = ''
+
+import main  # noqa: E402
+import snapshot_cache  # noqa: E402
+from benchmarks.roster_generator import write_export_series  # noqa: E402
+from config import DATASET_NAME, CURRENT_TABLE_NAME  # noqa: E402
+from gcp_clients import set_bigquery_client  # noqa: E402
+from local_warehouse import LocalWarehouseClient  # noqa: E402
+
+# Client calls that are a round trip to BigQuery
+REMOTE_CALLS = {'get_table', 'create_table', 'update_table', 'delete_table', 'query', 'list_rows',
+                'load_table_from_dataframe'}
+
+
+class SlowClient:
+    """Wrap a client so every remote call first sleeps for latency seconds."""
+
+    def __init__(self, client, latency):
+        self._client = client
+        self._latency = latency
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name not in REMOTE_CALLS:
+            return attr
+
+        def call(*args, **kwargs):
+            time.sleep(self._latency)
+            return attr(*args, **kwargs)
+        return call
+
+
+def run(exports, latency, overlap):
+    """Seconds process_roster takes on the second export."""
+    main.OVERLAP_IO = overlap
+    set_bigquery_client(SlowClient(LocalWarehouseClient(), latency))
+    try:
+        if not main.process_roster(exports[0]):
+            raise RuntimeError("Loading the first export failed.")
+        snapshot_cache.invalidate_snapshot(DATASET_NAME, CURRENT_TABLE_NAME)
+        start = time.perf_counter()
+        if not main.process_roster(exports[1]):
+            raise RuntimeError("Processing the second export failed.")
+        return time.perf_counter() - start
+    finally:
+        set_bigquery_client(None)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--employees', type=int, default=10_000)
+    parser.add_argument('--latency', type=float, default=0.3, help='seconds added to every BigQuery call')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per mode; the fastest is kept')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)  # The pipeline logs every stage at INFO
+    main.trigger_scheduled_query = lambda ledger=None: None
+
+    with tempfile.TemporaryDirectory(prefix='bench_rosters_') as workdir:
+        exports = write_export_series(workdir, args.employees, exports=2)
+        sequential = min(run(exports, args.latency, False) for _ in range(args.repeat))
+        overlapped = min(run(exports, args.latency, True) for _ in range(args.repeat))
+
+    print(f"employees={args.employees} latency={args.latency}s")
+    print(f"sequential  {sequential:8.3f}s")
+    print(f"overlapped  {overlapped:8.3f}s  ({1 - overlapped / sequential:.0%} less)")
+
+
+if __name__ == '__main__':
+    main_cli()
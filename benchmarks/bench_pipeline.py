@@ -0,0 +1,186 @@
+"""Benchmark the pipeline's stages against the local warehouse stand-in.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_pipeline --sizes 1000 10000 --churn 0.05 --new-hires 0.02
+    python -m benchmarks.bench_pipeline --json before.json
+    python -m benchmarks.bench_pipeline --baseline before.json --tolerance 0.25
+
+For every size a weekly series of three synthetic exports is generated
+(see roster_generator) and pushed through the pipeline on a fresh
+LocalWarehouseClient:
+
+    excel_load              load_excel_to_dataframe on the first export
+    process_initial         process_roster on the first export (empty tables)
+    read_existing_data      the full-history read
+    load_snapshot           current-state read with no cached copy
+    upsert_to_bigquery      diff and write of the second export
+    process_incremental     process_roster on the third export
+    process_unchanged       process_roster on the third export again
+
+Each stage reports wall time, rows/second and peak memory. On Linux that is
+the peak RSS during the stage, reset through /proc/self/clear_refs; elsewhere
+it is tracemalloc's peak of Python allocations, which slows the stage down.
+With --baseline, the run fails when a stage is more than --tolerance slower
+than in the baseline file written by an earlier --json run; --repeat keeps
+the fastest of several runs to make that comparison less noisy.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# The pipeline reads its settings at import; keep the snapshot cache local and throwaway
+os.environ.setdefault('SNAPSHOT_CACHE_DIR', tempfile.mkdtemp(prefix='bench_snapshot_'))
+os.environ['SNAPSHOT_BUCKET'] = ''
+
+import main  # noqa: E402
+import snapshot_cache  # noqa: E402
+from benchmarks.roster_generator import write_export_series  # noqa: E402
+from bigquery_upsert import read_existing_data, upsert_to_bigquery  # noqa: E402
+from config import DATASET_NAME, TABLE_NAME, CURRENT_TABLE_NAME  # noqa: E402
+from excel_to_pandas import load_excel_to_dataframe  # noqa: E402
+from gcp_clients import set_bigquery_client  # noqa: E402
+from local_warehouse import LocalWarehouseClient  # noqa: E402
+from scd2_diff import ROW_HASH_COLUMN  # noqa: E402
+
+CLEAR_REFS = '/proc/self/clear_refs'
+
+
+def _rss_peak_supported():
+    try:
+        with open(CLEAR_REFS, 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _rss_peak_mb():
+    with open('/proc/self/status') as file:
+        for line in file:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    return float('nan')
+
+
+def measure(fn, use_rss):
+    """Run fn(); return (result, seconds, peak_mb)."""
+    if use_rss:
+        with open(CLEAR_REFS, 'w') as file:
+            file.write('5')  # Reset the peak RSS to the current RSS
+    else:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - start
+    if use_rss:
+        peak_mb = _rss_peak_mb()
+    else:
+        peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return result, seconds, peak_mb
+
+
+def _clear_snapshot_cache():
+    snapshot_cache.invalidate_snapshot(DATASET_NAME, CURRENT_TABLE_NAME)
+
+
+def run_size(n_employees, churn, new_hire_rate, workdir, use_rss, mode):
+    """Run every stage for one roster size; returns one result dict per stage."""
+    exports = write_export_series(os.path.join(workdir, str(n_employees)), n_employees, 3, churn, new_hire_rate)
+    client = LocalWarehouseClient()
+    set_bigquery_client(client)
+    _clear_snapshot_cache()
+    main.UPSERT_MODE = mode
+
+    def upsert_inputs():
+        existing = snapshot_cache.read_current_table(client, DATASET_NAME, CURRENT_TABLE_NAME)
+        return existing.drop(columns=[ROW_HASH_COLUMN]), load_excel_to_dataframe(exports[1])
+
+    # (name, untimed setup returning the stage's arguments, timed stage)
+    stages = [
+        ('excel_load', None, lambda: load_excel_to_dataframe(exports[0])),
+        ('process_initial', None, lambda: main.process_roster(exports[0])),
+        ('read_existing_data', None, lambda: read_existing_data(client, DATASET_NAME, TABLE_NAME)),
+        ('load_snapshot', lambda: (_clear_snapshot_cache(),),
+         lambda _: snapshot_cache.load_snapshot(client, DATASET_NAME, CURRENT_TABLE_NAME)),
+    ]
+    if mode == 'dataframe':
+        stages.append(('upsert_to_bigquery', upsert_inputs, upsert_to_bigquery))
+    stages += [
+        ('process_incremental', None, lambda: main.process_roster(exports[2])),
+        ('process_unchanged', None, lambda: main.process_roster(exports[2])),
+    ]
+
+    results = []
+    for name, setup, fn in stages:
+        args = setup() if setup else ()
+        result, seconds, peak_mb = measure(lambda: fn(*args), use_rss)
+        if result is False or (isinstance(result, dict) and not result.get('success')):
+            raise RuntimeError(f"Stage {name} failed for {n_employees} employees: {result}")
+        rows = len(result) if hasattr(result, '__len__') and not isinstance(result, dict) else n_employees
+        results.append({
+            'employees': n_employees, 'stage': name, 'seconds': round(seconds, 4),
+            'rows_per_s': round(rows / seconds) if seconds else None, 'peak_mb': round(peak_mb, 1),
+        })
+    set_bigquery_client(None)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return the stages that got slower than baseline by more than tolerance."""
+    expected = {(row['employees'], row['stage']): row['seconds'] for row in baseline}
+    regressions = []
+    for row in results:
+        before = expected.get((row['employees'], row['stage']))
+        if before and row['seconds'] > before * (1 + tolerance):
+            regressions.append(f"{row['stage']} @ {row['employees']}: {before:.3f}s -> {row['seconds']:.3f}s")
+    return regressions
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 10_000])
+    parser.add_argument('--churn', type=float, default=0.05)
+    parser.add_argument('--new-hires', type=float, default=0.02)
+    parser.add_argument('--mode', choices=['dataframe', 'merge'], default='dataframe', help='UPSERT_MODE to run')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per size; the fastest run of each stage is kept')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='results file of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown per stage, as a fraction')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)  # The pipeline logs every stage at INFO
+
+    # The downstream scheduled query is a single remote call and has no local stand-in
+    main.trigger_scheduled_query = lambda ledger=None: None
+    use_rss = _rss_peak_supported()
+
+    results = []
+    print(f"{'employees':>10} {'stage':<20} {'seconds':>9} {'rows/s':>10} {'peak_mb':>8}")
+    with tempfile.TemporaryDirectory(prefix='bench_rosters_') as workdir:
+        for n in args.sizes:
+            runs = [run_size(n, args.churn, args.new_hires, workdir, use_rss, args.mode) for _ in range(args.repeat)]
+            for stage_runs in zip(*runs):
+                row = min(stage_runs, key=lambda run: run['seconds'])
+                results.append(row)
+                print(f"{row['employees']:>10} {row['stage']:<20} {row['seconds']:>9.3f} "
+                      f"{row['rows_per_s'] or 0:>10} {row['peak_mb']:>8.1f}")
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,148 @@
+"""Benchmark the set-based SCD2 diff against the former per-emp_id loop.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_scd2_diff --sizes 1000 10000 100000 500000
+
+The row-wise reference implementation is quadratic, so it only runs up to
+--reference-max employees; for those sizes the two outputs are also checked
+for equality. change_set_s is the time to build the audit change set from the
+same diff, which replaced the per-employee log lines.
+"""
+import argparse
+import time
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from excel_to_pandas import get_roster_schema
+from scd2_diff import diff_scd2, records_to_insert, change_set
+
+COLUMNS_TO_CHECK = get_roster_schema().names
+
+
+def make_frames(n_employees, churn=0.05, new_hire_rate=0.02, history_rate=0.05, seed=0):
+    """Build an existing snapshot and a new export with some changed, some new and some
+    re-versioned employees (more than one existing row per emp_id)."""
+    rng = np.random.default_rng(seed)
+    emp_ids = np.char.add('E', np.arange(n_employees).astype(str)).astype(object)
+    hire_dates = pd.to_datetime('2020-01-01') + pd.to_timedelta(rng.integers(0, 1500, n_employees), unit='D')
+    existing = pd.DataFrame({
+        'emp_id': emp_ids,
+        'site': rng.choice(['BOG', 'MDE', 'CLO'], n_employees).astype(object),
+        'name': np.char.add('Agent ', emp_ids.astype(str)).astype(object),
+        'role': rng.choice(['Agent', 'Team Lead', 'QA'], n_employees).astype(object),
+        'status': rng.choice(['Active', 'Inactive'], n_employees).astype(object),
+        'leader': rng.choice([f'Leader {i}' for i in range(50)], n_employees).astype(object),
+        'manager': rng.choice([f'Manager {i}' for i in range(10)], n_employees).astype(object),
+        'work_email': np.char.add(emp_ids.astype(str), '@example.com').astype(object),
+        'wave': rng.integers(1, 40, n_employees).astype(str).astype(object),
+        'alo_credential_user_name': np.char.add('alo_', emp_ids.astype(str)).astype(object),
+        'date_of_hire': hire_dates.date,
+        'termination_date': pd.Series([pd.NaT] * n_employees).to_numpy(dtype=object),
+        'go_live': (hire_dates + pd.Timedelta(days=30)).date,
+        'tenure': rng.integers(0, 60, n_employees),
+        'contract_type': rng.choice(['Fixed', 'Indefinite'], n_employees).astype(object),
+        'contract_end_date': (hire_dates + pd.Timedelta(days=365)).date,
+        'flash_card_user': rng.choice(['Yes', 'No'], n_employees).astype(object),
+        'national_id': rng.integers(10**8, 10**9, n_employees).astype(str).astype(object),
+        'personal_email': np.char.add(emp_ids.astype(str), '@mail.com').astype(object),
+        'birthday': (pd.to_datetime('1990-01-01') + pd.to_timedelta(rng.integers(0, 7000, n_employees), unit='D')).date,
+        'address': np.char.add('Street ', rng.integers(1, 200, n_employees).astype(str)).astype(object),
+        'barrio_localidad': rng.choice(['Chapinero', 'Suba', 'Usaquen'], n_employees).astype(object),
+        'phone_number': rng.integers(3 * 10**9, 4 * 10**9, n_employees).astype(str).astype(object),
+        'natterbox': rng.integers(1000, 9999, n_employees).astype(str).astype(object),
+        'start_date': date(2024, 1, 1),
+        'end_date': date(2024, 1, 1),
+    })
+
+    new = existing.copy()
+    history = existing[rng.random(n_employees) < history_rate].copy()
+    history['status'] = 'Previous'
+    history['end_date'] = date(2023, 12, 31)
+    existing = pd.concat([history, existing], ignore_index=True).sort_values('emp_id', kind='stable', ignore_index=True)
+
+    churn_mask = rng.random(n_employees) < churn
+    new.loc[churn_mask, 'status'] = 'Changed'
+    n_new = int(n_employees * new_hire_rate)
+    hires = existing.sample(n=n_new, random_state=seed).copy()
+    hires['emp_id'] = np.char.add('N', np.arange(n_new).astype(str)).astype(object)
+    new = pd.concat([new, hires], ignore_index=True).sample(frac=1.0, random_state=seed).reset_index(drop=True)
+    return existing, new
+
+
+def reference_diff(existing_df, new_df, columns_to_check, run_date):
+    """The per-emp_id loop formerly used by upsert_to_bigquery, kept for comparison."""
+    existing_df = existing_df.copy()
+    records = []
+    comparison_columns = [col for col in columns_to_check if col not in ['emp_id', 'start_date', 'end_date']]
+    for emp_id in new_df['emp_id'].unique():
+        existing_records = existing_df[existing_df['emp_id'] == emp_id]
+        new_records = new_df[new_df['emp_id'] == emp_id]
+        if not existing_records.empty and not new_records.empty:
+            existing_values = existing_records[comparison_columns].values[0].astype(str)
+            new_values = new_records[comparison_columns].values[0].astype(str)
+            if not (existing_values == new_values).all():
+                last_index = existing_records.index[-1]
+                existing_df.at[last_index, 'end_date'] = run_date
+                records.append(existing_df.loc[[last_index]])
+                new_record_df = pd.DataFrame([new_records.iloc[0].to_dict()])
+                new_record_df['start_date'] = run_date
+                new_record_df['end_date'] = run_date
+                records.append(new_record_df)
+        if emp_id not in existing_df['emp_id'].values:
+            for new_record in new_records.itertuples(index=False):
+                new_record_df = pd.DataFrame([new_record._asdict()])
+                new_record_df['start_date'] = run_date
+                new_record_df['end_date'] = run_date
+                records.append(new_record_df)
+    if not records:
+        return pd.DataFrame(columns=columns_to_check)
+    return pd.concat(records, ignore_index=True)[columns_to_check]
+
+
+def _same_rows(left, right):
+    left = left.astype(str).reset_index(drop=True)
+    right = right.astype(str).reset_index(drop=True)
+    return left.equals(right)
+
+
+def run(sizes, reference_max):
+    run_date = date.today()
+    print(f"{'employees':>10} {'vectorized_s':>13} {'rows/s':>12} {'inserted':>9} {'change_set_s':>13} "
+          f"{'reference_s':>12} {'equal':>6}")
+    for n in sizes:
+        existing, new = make_frames(n)
+
+        start = time.perf_counter()
+        diff = diff_scd2(existing, new, COLUMNS_TO_CHECK, run_date)
+        result = records_to_insert(diff)
+        elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        change_set(diff, COLUMNS_TO_CHECK, run_date)
+        change_set_s = time.perf_counter() - start
+
+        reference_s, equal = '-', '-'
+        if n <= reference_max:
+            start = time.perf_counter()
+            expected = reference_diff(existing, new, COLUMNS_TO_CHECK, run_date)
+            reference_s = f"{time.perf_counter() - start:.3f}"
+            equal = str(_same_rows(result, expected))
+
+        print(f"{n:>10} {elapsed:>13.3f} {len(new) / elapsed:>12.0f} {len(result):>9} {change_set_s:>13.3f} "
+              f"{reference_s:>12} {equal:>6}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 10_000, 50_000, 100_000, 500_000])
+    parser.add_argument('--reference-max', type=int, default=5_000,
+                        help='largest roster size to also run the row-wise reference loop on')
+    args = parser.parse_args()
+    run(args.sizes, args.reference_max)
+
+
+if __name__ == '__main__':
+    main()
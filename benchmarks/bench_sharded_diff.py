@@ -0,0 +1,97 @@
+"""Measure how the sharded SCD2 diff scales with worker processes.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_sharded_diff --employees 1000000 --workers 1 2 4 8
+
+A synthetic diff (see bench_scd2_diff) is conformed to the roster schema, as
+upsert_to_bigquery conforms its frames, then diffed in process (workers=1)
+and by sharded_diff_scd2 with each --workers count. The pool is warmed up
+before timing, as it stays up on a warm instance. speedup is relative to the
+in-process diff; same_records checks that records_to_insert is unchanged.
+
+The second table times fingerprint_split, which hashes the whole new roster
+and splits its emp_ids against the current fingerprints before any diff, on
+a mostly unchanged roster (--split-churn of the employees changed), the
+usual upload. same_split checks the changed and new emp_ids.
+Speedups near the worker count need that many idle cores.
+"""
+import argparse
+import os
+import time
+from datetime import date
+
+from benchmarks.bench_scd2_diff import make_frames
+from excel_to_pandas import get_roster_schema
+from scd2_diff import KEY_COLUMN, ROW_HASH_COLUMN, compute_row_hash, diff_scd2, records_to_insert
+import sharded_diff
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--employees', type=int, default=1_000_000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--repeat', type=int, default=3, help='runs per worker count; the fastest is kept')
+    parser.add_argument('--split-churn', type=float, default=0.01, help='share of employees changed for the split timings')
+    args = parser.parse_args()
+    schema = get_roster_schema()
+
+    existing, new = make_frames(args.employees)
+    existing, new = schema.conform(existing), schema.conform(new)
+    schema.share_categories(existing, new)
+    columns, run_date = schema.names, date.today()
+
+    print(f"employees={args.employees} rows={len(existing) + len(new)} cpus={os.cpu_count()}")
+    print(f"{'workers':>8} {'seconds':>8} {'rows_per_s':>11} {'speedup':>8} {'same_records':>13}")
+    expected, baseline = None, None
+    for workers in args.workers:
+        if workers > 1:  # A pool of this size, started before timing
+            sharded_diff.sharded_diff_scd2(existing.head(1000), new.head(1000), columns, run_date, workers)
+        best = float('inf')
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            if workers > 1:
+                diff = sharded_diff.sharded_diff_scd2(existing, new, columns, run_date, workers)
+            else:
+                diff = diff_scd2(existing, new, columns, run_date)
+            best = min(best, time.perf_counter() - start)
+        records = records_to_insert(diff)
+        expected = records if expected is None else expected
+        baseline = best if baseline is None else baseline
+        print(f"{workers:>8} {best:>8.3f} {(len(existing) + len(new)) / best:>11.0f} {baseline / best:>8.2f} "
+              f"{str(records.equals(expected)):>13}")
+        sharded_diff.shutdown_pools()
+
+    bench_split(args, schema)
+
+
+def bench_split(args, schema):
+    """Time the fingerprint split of a mostly unchanged roster, in process and sharded."""
+    existing, new = make_frames(args.employees, churn=args.split_churn, new_hire_rate=0.001, history_rate=0)
+    new = schema.conform(new)
+    current = schema.conform(existing)
+    fingerprints = current.assign(**{ROW_HASH_COLUMN: compute_row_hash(current, schema.compared_types)})[[KEY_COLUMN, ROW_HASH_COLUMN]]
+
+    print(f"fingerprint split: rows={len(new)} churn={args.split_churn}")
+    print(f"{'workers':>8} {'seconds':>8} {'rows_per_s':>11} {'speedup':>8} {'changed':>8} {'same_split':>11}")
+    expected, baseline = None, None
+    for workers in args.workers:
+        if workers > 1:
+            sharded_diff.sharded_fingerprint_split(new.head(1000), fingerprints.head(1000), schema.compared_types, workers)
+        best = float('inf')
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            if workers > 1:
+                split = sharded_diff.sharded_fingerprint_split(new, fingerprints, schema.compared_types, workers)
+            else:
+                split = sharded_diff.fingerprint_split(new, fingerprints, schema.compared_types, workers=1)
+            best = min(best, time.perf_counter() - start)
+        expected = split if expected is None else expected
+        baseline = best if baseline is None else baseline
+        print(f"{workers:>8} {best:>8.3f} {len(new) / best:>11.0f} {baseline / best:>8.2f} {len(split[0]):>8} "
+              f"{str(split == expected):>11}")
+        sharded_diff.shutdown_pools()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""Check the Cloud Function's cold-start import budget with python -X importtime.
+
+Run from the repository root (exits non-zero when the budget is exceeded):
+
+    python -m benchmarks.import_time --budget-ms 1500
+
+Besides the total time to `import main`, it fails when a module that is
+only needed on some code paths is imported at module load.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+# Modules that must only be imported when an invocation actually uses them
+DEFERRED_MODULES = [
+    'pyspark',
+    'google.cloud.storage',
+    'google.cloud.bigquery_storage',
+    'google.cloud.bigquery_datatransfer_v1',
+    'openpyxl',
+    'gcsfs',
+]
+DEFAULT_BUDGET_MS = 1500
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(module='main'):
+    """Return ({module: cumulative_us}, total_us) for a fresh `import module`."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=REPO_ROOT, capture_output=True, text=True, check=True,
+    )
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, name = (part.strip() for part in line[len('import time:'):].split('|'))
+        cumulative[name] = int(cumulative_us)
+    return cumulative, cumulative.get(module, 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--budget-ms', type=float, default=float(os.environ.get('IMPORT_BUDGET_MS', DEFAULT_BUDGET_MS)))
+    parser.add_argument('--top', type=int, default=10, help='number of slowest imports to print')
+    args = parser.parse_args()
+
+    cumulative, total_us = measure()
+    print(f"import main: {total_us / 1000:.0f} ms (budget {args.budget_ms:.0f} ms)")
+    for name, us in sorted(cumulative.items(), key=lambda item: item[1], reverse=True)[1:args.top + 1]:
+        print(f"  {us / 1000:8.1f} ms  {name}")
+
+    eager = [name for name in DEFERRED_MODULES if name in cumulative]
+    if eager:
+        print(f"FAIL: imported at module load: {', '.join(eager)}")
+    if total_us / 1000 > args.budget_ms:
+        print("FAIL: import budget exceeded")
+    sys.exit(1 if eager or total_us / 1000 > args.budget_ms else 0)
+
+
+if __name__ == '__main__':
+    main()
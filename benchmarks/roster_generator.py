@@ -0,0 +1,146 @@
+"""Generate realistic synthetic 'Roster ALO' workbooks.
+
+Run from the repository root:
+
+    python -m benchmarks.roster_generator exports/ --employees 10000 --exports 3 \
+        --churn 0.05 --new-hires 0.02
+
+The first export holds --employees rows; every following one changes a
+--churn share of employees (transfers, new leaders, terminations, ...) and
+adds a --new-hires share of new employees. Files are named
+roster_YYYY-MM-DD.xlsx, one week apart, so backfill.py orders them. Cells
+are written the way the real exports store them: ids and phone numbers as
+numbers, dates as Excel dates and '-' for blanks.
+"""
+import argparse
+import os
+import random
+from datetime import date, datetime, timedelta
+
+from excel_to_pandas import ROSTER_SHEET_NAME, ROSTER_COLUMN_COUNT, get_roster_schema
+
+# Sheet headers; clean_column_names turns them into the schema's column names
+HEADERS = {
+    'emp_id': 'Emp ID', 'alo_credential_user_name': 'ALO Credential User Name',
+    'date_of_hire': 'Date of Hire', 'barrio_localidad': 'Barrio / Localidad', 'national_id': 'National ID',
+}
+
+SITES = ['Bogota', 'Medellin', 'Cali', 'Barranquilla']
+ROLES = ['Agent', 'Senior Agent', 'Team Lead', 'QA Analyst', 'Trainer']
+FIRST_NAMES = ['Ana', 'Luis', 'Carlos', 'Maria', 'Juan', 'Laura', 'Andres', 'Camila', 'Diego', 'Valentina']
+LAST_NAMES = ['Garcia', 'Rodriguez', 'Martinez', 'Lopez', 'Gomez', 'Perez', 'Diaz', 'Torres', 'Ramirez', 'Rojas']
+BARRIOS = ['Chapinero', 'Suba', 'Usaquen', 'Kennedy', 'Engativa', 'Teusaquillo', 'Fontibon']
+CONTRACT_TYPES = ['Indefinite', 'Fixed Term', 'Apprentice']
+FIRST_EMP_ID = 100000
+
+
+def _excel_date(day):
+    return datetime(day.year, day.month, day.day)
+
+
+def new_employee(emp_id, rnd, as_of):
+    """One roster row (column name -> cell value) for a newly hired employee."""
+    first, last = rnd.choice(FIRST_NAMES), rnd.choice(LAST_NAMES)
+    hired = as_of - timedelta(days=rnd.randint(0, 1500))
+    contract = rnd.choice(CONTRACT_TYPES)
+    return {
+        'emp_id': emp_id,
+        'site': rnd.choice(SITES),
+        'name': f"{first} {last} {emp_id}",
+        'role': rnd.choice(ROLES),
+        'status': 'Active',
+        'leader': f"Leader {rnd.randint(1, 200)}",
+        'manager': f"Manager {rnd.randint(1, 25)}",
+        'work_email': f"{first.lower()}.{last.lower()}{emp_id}@example.com",
+        'wave': rnd.randint(1, 80),
+        'alo_credential_user_name': f"alo{emp_id}",
+        'date_of_hire': _excel_date(hired),
+        'termination_date': '-',
+        'go_live': _excel_date(hired + timedelta(days=rnd.randint(14, 45))),
+        'tenure': (as_of - hired).days // 30,
+        'contract_type': contract,
+        'contract_end_date': _excel_date(hired + timedelta(days=365)) if contract == 'Fixed Term' else '-',
+        'flash_card_user': rnd.choice(['Yes', 'No']),
+        'national_id': rnd.randint(10**7, 10**10),
+        'personal_email': f"{first.lower()}{emp_id}@mail.example",
+        'birthday': _excel_date(date(1970, 1, 1) + timedelta(days=rnd.randint(0, 12000))),
+        'address': f"Calle {rnd.randint(1, 200)} # {rnd.randint(1, 99)}-{rnd.randint(1, 99)}",
+        'barrio_localidad': rnd.choice(BARRIOS),
+        'phone_number': rnd.randint(3000000000, 3509999999),
+        'natterbox': rnd.choice([rnd.randint(1000, 9999), '-']),
+    }
+
+
+def generate_roster(n_employees, seed=0, as_of=date(2024, 1, 1)):
+    """Rows of a first export with n_employees employees."""
+    rnd = random.Random(seed)
+    return [new_employee(FIRST_EMP_ID + i, rnd, as_of) for i in range(n_employees)]
+
+
+def evolve_roster(rows, churn=0.05, new_hire_rate=0.02, seed=0, as_of=date(2024, 1, 8)):
+    """The next export: a churn share of employees changes, a new_hire_rate share is added."""
+    rnd = random.Random(seed)
+    rows = [dict(row) for row in rows]
+    for row in rnd.sample(rows, int(len(rows) * churn)):
+        change = rnd.choice(['leader', 'role', 'wave', 'site', 'address', 'terminate'])
+        if change == 'terminate':
+            row['status'] = 'Terminated'
+            row['termination_date'] = _excel_date(as_of)
+        elif change == 'leader':
+            row['leader'] = f"Leader {rnd.randint(1, 200)}"
+        elif change == 'role':
+            row['role'] = rnd.choice(ROLES)
+        elif change == 'wave':
+            row['wave'] = rnd.randint(1, 80)
+        elif change == 'site':
+            row['site'] = rnd.choice(SITES)
+        else:
+            row['address'] = f"Calle {rnd.randint(1, 200)} # {rnd.randint(1, 99)}-{rnd.randint(1, 99)}"
+    next_id = max(row['emp_id'] for row in rows) + 1
+    rows.extend(new_employee(next_id + i, rnd, as_of) for i in range(int(len(rows) * new_hire_rate)))
+    return rows
+
+
+def write_roster(path, rows):
+    """Write rows as a roster workbook with the sheet and header layout of the real exports."""
+    import openpyxl
+
+    columns = get_roster_schema().names[:ROSTER_COLUMN_COUNT]
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet(ROSTER_SHEET_NAME)
+    sheet.append([HEADERS.get(col, col.replace('_', ' ').title()) for col in columns])
+    for row in rows:
+        sheet.append([row[col] for col in columns])
+    workbook.save(path)
+    return path
+
+
+def write_export_series(directory, n_employees, exports=3, churn=0.05, new_hire_rate=0.02, seed=0,
+                        first_date=date(2024, 1, 1)):
+    """Write a weekly series of exports into directory; returns their paths, oldest first."""
+    os.makedirs(directory, exist_ok=True)
+    rows = generate_roster(n_employees, seed=seed, as_of=first_date)
+    paths = []
+    for i in range(exports):
+        export_date = first_date + timedelta(weeks=i)
+        if i:
+            rows = evolve_roster(rows, churn, new_hire_rate, seed=seed + i, as_of=export_date)
+        paths.append(write_roster(os.path.join(directory, f"roster_{export_date.isoformat()}.xlsx"), rows))
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory')
+    parser.add_argument('--employees', type=int, default=10_000)
+    parser.add_argument('--exports', type=int, default=1)
+    parser.add_argument('--churn', type=float, default=0.05, help='share of employees changed per export')
+    parser.add_argument('--new-hires', type=float, default=0.02, help='share of employees added per export')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    for path in write_export_series(args.directory, args.employees, args.exports, args.churn, args.new_hires, args.seed):
+        print(path)
+
+
+if __name__ == '__main__':
+    main()
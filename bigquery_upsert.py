@@ -1,236 +1,301 @@
-from google.cloud import bigquery
-from excel_to_pandas import load_dataframe_to_bigquery
-from config import PROJECT_ID, DATASET_NAME, TABLE_NAME
-import pandas as pd
-import logging
-import fsspec
-from google.api_core.exceptions import NotFound
-from datetime import datetime
-import config
-
-# Check if the table exists
-def table_exists(client, dataset_name, table_name):
-    try:
-        # Use the client to check if the table exists
-        table_ref = client.dataset(dataset_name).table(table_name)
-        client.get_table(table_ref)  # This will raise an error if the table does not exist
-        return True
-    except NotFound:
-        return False
-# Read existing data from BigQuery
-# def read_existing_data(client, dataset_name, table_name):
-#     query = f"SELECT * FROM `{PROJECT_ID}.{dataset_name}.{table_name}`"
-    
-#     try:
-#         df = client.query(query).to_dataframe()
-        
-#         # Log the number of rows retrieved
-#         logging.info(f"Query result for {dataset_name}.{table_name} has {df.shape[0]} rows.")
-        
-#         if 'start_date' in df.columns:
-#             logging.info(df['start_date'].head())
-
-#         # Apply the conversion
-#         if 'start_date' in df.columns:
-#             df['start_date'] = pd.to_datetime(df['start_date'], errors='coerce').dt.date
-#         if 'end_date' in df.columns:
-#             df['end_date'] = pd.to_datetime(df['end_date'], errors='coerce').dt.date
-
-#         if 'start_date' in df.columns:
-#             logging.info(df['start_date'].head())
-
-#         return df
-#     except Exception as e:
-#         logging.error(f"Error reading data from BigQuery: {e}")
-#         return pd.DataFrame()  # Return empty DataFrame on error
-
-
-def read_existing_data(client, dataset_name, table_name):
-    query = f"""
-    SELECT * EXCEPT(latest_record) 
-    FROM (
-      SELECT *, 
-             MAX(start_date) OVER (PARTITION BY name ORDER BY start_date) = start_date AS latest_record
-      FROM `{PROJECT_ID}.{dataset_name}.{table_name}`
-      ORDER BY name, start_date
-    ) 
-    WHERE latest_record = true
-    """
-    
-    try:
-        # Execute query and load results into a DataFrame
-        df = client.query(query).to_dataframe()
-        
-        # Log the number of rows retrieved
-        logging.info(f"Query result for {dataset_name}.{table_name} has {df.shape[0]} rows.")
-        
-        # Preview start_date column before conversion
-        if 'start_date' in df.columns:
-            logging.info("Preview of start_date column before conversion:")
-            logging.info(df['start_date'].head())
-        
-        # Convert date columns to ensure consistent format
-        if 'start_date' in df.columns:
-            df['start_date'] = pd.to_datetime(df['start_date'], errors='coerce').dt.date
-        if 'end_date' in df.columns:
-            df['end_date'] = pd.to_datetime(df['end_date'], errors='coerce').dt.date
-        
-        # Log start_date after conversion
-        if 'start_date' in df.columns:
-            logging.info("Preview of start_date column after conversion:")
-            logging.info(df['start_date'].head())
-        
-        return df
-    
-    except Exception as e:
-        # Log the error and return an empty DataFrame
-        logging.error(f"Error reading data from BigQuery: {e}")
-        return pd.DataFrame()  # Return empty DataFrame on error
-
-
-def upsert_to_bigquery(existing_df, new_df):
-    # Set up logging
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-
-    try:
-        # Strip whitespace from column names
-        new_df.columns = new_df.columns.str.strip()
-        existing_df.columns = existing_df.columns.str.strip()
-
-        logging.info("Stripped columns in new_df: %s", new_df.columns.tolist())
-        logging.info("Stripped columns in existing_df: %s", existing_df.columns.tolist())
-
-        # Define columns to check for presence in DataFrames
-        columns_to_check = [
-            'emp_id', 'site', 'name', 'role', 'status', 'leader', 'manager',
-            'work_email', 'wave', 'alo_credential_user_name',  
-            'date_of_hire', 'termination_date', 'go_live',  
-            'tenure', 'contract_type', 'contract_end_date',  
-            'flash_card_user', 'national_id', 'personal_email',  
-            'birthday', 'address', 'barrio_localidad', 'phone_number',  
-            'natterbox', 'start_date', 'end_date'
-        ]
-
-        # Check for missing columns in new_df and existing_df
-        for df_name, df in zip(['new_df', 'existing_df'], [new_df, existing_df]):
-            missing_columns = [col for col in columns_to_check if col not in df.columns]
-            if missing_columns:
-                error_message = f"Columns missing from {df_name}: {', '.join(missing_columns)}"
-                logging.error(error_message)
-                return {"success": False, "error": error_message}
-
-        # Drop rows with missing emp_id in both DataFrames before merging
-        new_df_before_drop = new_df.shape[0]
-        existing_df_before_drop = existing_df.shape[0]
-        new_df = new_df.dropna(subset=['emp_id'])
-        existing_df = existing_df.dropna(subset=['emp_id'])
-        logging.info(f"Dropped {new_df_before_drop - new_df.shape[0]} rows from new_df and {existing_df_before_drop - existing_df.shape[0]} rows from existing_df due to missing emp_id.")
-
-        # Convert 'start_date' and 'end_date' in both DataFrames to proper date format
-        for df in [new_df, existing_df]:
-            try:
-                df['start_date'] = pd.to_datetime(df['start_date'], errors='coerce').dt.date
-                df['end_date'] = pd.to_datetime(df['end_date'], errors='coerce').dt.date
-
-                if df['start_date'].isnull().any() or df['end_date'].isnull().any():
-                    raise ValueError(f"Date conversion failed in one of the rows in DataFrame:\n{df.head()}")
-            except Exception as date_conversion_error:
-                error_message = f"Error converting date columns: {str(date_conversion_error)}"
-                logging.error(error_message)
-                return {"success": False, "error": error_message}
-
-        # Case 1: If the existing_df is empty, insert new data
-        if existing_df.empty:
-            try:
-                logging.info("No existing data found in BigQuery. Inserting new data.")
-                load_dataframe_to_bigquery(new_df, PROJECT_ID, DATASET_NAME, TABLE_NAME)
-                return {"success": True, "message": "Inserted new data."}
-            except Exception as insert_error:
-                error_message = f"Error inserting new data: {str(insert_error)}"
-                logging.error(error_message)
-                return {"success": False, "error": error_message}
-
-        records_to_insert = []
-
-        # Case 2: Process the new data with existing records
-        for emp_id in new_df['emp_id'].unique():
-            try:
-                existing_records = existing_df[existing_df['emp_id'] == emp_id]
-                new_records = new_df[new_df['emp_id'] == emp_id]
-
-                if not existing_records.empty and not new_records.empty:
-                    # Compare all relevant columns (excluding emp_id, start_date, and end_date)
-                    comparison_columns = [col for col in columns_to_check if col not in ['emp_id', 'start_date', 'end_date']]
-                    existing_values = existing_records[comparison_columns].values[0]
-                    new_values = new_records[comparison_columns].values[0]
-
-                    # Convert to strings for comparison
-                    existing_values = existing_values.astype(str)
-                    new_values = new_values.astype(str)
-
-                    changes_detected = not (existing_values == new_values).all()
-
-                    if changes_detected:
-                        # Check for specific columns that have changed
-                        changed_columns = [col for col, old_val, new_val in zip(comparison_columns, existing_values, new_values) if old_val != new_val]
-                        
-                        # Log the changes detected
-                        if changed_columns:
-                            logging.info(f"Changes detected for emp_id {emp_id}: {', '.join(changed_columns)}.")
-
-                        # Update end_date for the most recent existing record
-                        last_index = existing_records.index[-1]
-                        existing_df.at[last_index, 'end_date'] = datetime.now().date()
-                        logging.info(f"Updated end_date for emp_id {emp_id} to current date.")
-
-                        # Append the updated existing record
-                        updated_existing_record_df = existing_df.loc[[last_index]]  # Get the updated record
-                        records_to_insert.append(updated_existing_record_df)
-
-                        # Append the new record only if it does not match the existing record
-                        new_record_df = pd.DataFrame([new_records.iloc[0].to_dict()])
-                        new_record_df['start_date'] = datetime.now().date()
-                        new_record_df['end_date'] = datetime.now().date()
-                        records_to_insert.append(new_record_df)
-
-                    else:
-                        # Log that the record is identical
-                        logging.info(f"No changes detected for emp_id {emp_id}. Skipping insertion.")
-
-                # If emp_id is new, simply insert it
-                if emp_id not in existing_df['emp_id'].values:
-                    for new_record in new_records.itertuples(index=False):
-                        new_record_df = pd.DataFrame([new_record._asdict()])
-                        new_record_df['start_date'] = datetime.now().date()
-                        new_record_df['end_date'] = datetime.now().date()
-                        records_to_insert.append(new_record_df)
-                        logging.info(f"Inserted new emp_id {emp_id} with record: {new_record_df.to_dict(orient='records')}.")
-
-            except Exception as processing_error:
-                error_message = f"Error processing emp_id {emp_id}: {str(processing_error)}"
-                logging.error(error_message)
-                return {"success": False, "error": error_message}
-
-        # Final DataFrame preparation and insertion
-        try:
-            if records_to_insert:
-                records_to_insert_df = pd.concat(records_to_insert, ignore_index=True)
-                records_to_insert_df.columns = records_to_insert_df.columns.str.replace('_old', '', regex=False).str.replace('_new', '', regex=False)
-                records_to_insert_df = records_to_insert_df[columns_to_check]  # Ensure only relevant columns are included
-                records_to_insert_df.reset_index(drop=True, inplace=True)
-
-                logging.info(f"Inserting {len(records_to_insert_df)} records into BigQuery.")
-                load_dataframe_to_bigquery(records_to_insert_df, PROJECT_ID, DATASET_NAME, TABLE_NAME)
-                return {"success": True, "message": f"Inserted {len(records_to_insert_df)} records into BigQuery."}
-            else:
-                return {"success": True, "message": "No records to insert into BigQuery."}
-
-        except Exception as final_insertion_error:
-            error_message = f"Error during final insertion: {str(final_insertion_error)}"
-            logging.error(error_message)
-            return {"success": False, "error": error_message}
-
-    except Exception as general_error:
-        error_message = f"General error in upsert_to_bigquery: {str(general_error)}"
-        logging.error(error_message)
-        return {"success": False, "error": error_message}
+from google.cloud import bigquery
+from gcp_clients import get_bigquery_client, table_exists
+from excel_to_pandas import read_to_dataframe, create_table, get_table_schema, get_roster_schema
+from scd2_diff import records_to_insert, change_set, row_hash_sql, ROW_HASH_COLUMN
+from change_audit import write_change_set
+from sharded_diff import diff_rosters
+from merge_upsert import append_and_refresh
+from snapshot_cache import table_state, update_snapshot
+from instrumentation import span
+from config import PROJECT_ID, DATASET_NAME, TABLE_NAME, CURRENT_TABLE_NAME
+import pandas as pd
+import logging
+from datetime import datetime
+
+# Read existing data from BigQuery
+# def read_existing_data(client, dataset_name, table_name):
+#     query = f"SELECT * FROM `{PROJECT_ID}.{dataset_name}.{table_name}`"
+    
+#     try:
+#         df = client.query(query).to_dataframe()
+        
+#         # Log the number of rows retrieved
+#         logging.info(f"Query result for {dataset_name}.{table_name} has {df.shape[0]} rows.")
+        
+#         if 'start_date' in df.columns:
+#             logging.info(df['start_date'].head())
+
+#         # Apply the conversion
+#         if 'start_date' in df.columns:
+#             df['start_date'] = pd.to_datetime(df['start_date'], errors='coerce').dt.date
+#         if 'end_date' in df.columns:
+#             df['end_date'] = pd.to_datetime(df['end_date'], errors='coerce').dt.date
+
+#         if 'start_date' in df.columns:
+#             logging.info(df['start_date'].head())
+
+#         return df
+#     except Exception as e:
+#         logging.error(f"Error reading data from BigQuery: {e}")
+#         return pd.DataFrame()  # Return empty DataFrame on error
+
+
+def existing_data_query(dataset_name, table_name, schema=None):
+    """Query read_existing_data runs: the latest version of every roster row in history."""
+    columns = ", ".join((schema or get_roster_schema()).names)
+    return f"""
+    SELECT {columns}
+    FROM (
+      SELECT {columns},
+             MAX(start_date) OVER (PARTITION BY name ORDER BY start_date) = start_date AS latest_record
+      FROM `{PROJECT_ID}.{dataset_name}.{table_name}`
+    )
+    WHERE latest_record = true
+    """
+
+
+def read_existing_data(client, dataset_name, table_name, schema=None):
+    schema = schema or get_roster_schema()
+    query = existing_data_query(dataset_name, table_name, schema)
+
+    try:
+        # Only the roster columns are read, as Arrow; dates arrive as date32 and are not re-parsed
+        df = read_to_dataframe(client.query(query), schema)
+        logging.info(f"Query result for {dataset_name}.{table_name} has {df.shape[0]} rows.")
+        return df
+
+    except Exception as e:
+        # Log the error and return an empty DataFrame
+        logging.error(f"Error reading data from BigQuery: {e}")
+        return pd.DataFrame()  # Return empty DataFrame on error
+
+
+# Latest version of every emp_id, restricted to the given columns
+CURRENT_VERSION_QUERY = """
+    SELECT {columns}
+    FROM (
+      SELECT {columns},
+             ROW_NUMBER() OVER (PARTITION BY emp_id ORDER BY start_date DESC, end_date DESC) AS version_rank
+      FROM `{table_id}`
+      {where}
+    )
+    WHERE version_rank = 1
+    """
+
+
+def ensure_row_hash_column(client, dataset_name, table_name, schema=None):
+    """Add the row_hash column to a table created before fingerprints existed and fill it."""
+    table = client.get_table(f"{PROJECT_ID}.{dataset_name}.{table_name}")
+    if any(field.name == ROW_HASH_COLUMN for field in table.schema):
+        return False
+
+    table.schema = list(table.schema) + [bigquery.SchemaField(ROW_HASH_COLUMN, "STRING")]
+    client.update_table(table, ["schema"])
+    logging.info(f"Added {ROW_HASH_COLUMN} column to {table.full_table_id}.")
+    backfill_row_hashes(client, dataset_name, table_name, schema)
+    return True
+
+
+def backfill_row_hashes(client, dataset_name, table_name, schema=None):
+    """Fill row_hash for rows written without one, using the same fingerprint as pandas."""
+    query = f"""
+    UPDATE `{PROJECT_ID}.{dataset_name}.{table_name}`
+    SET {ROW_HASH_COLUMN} = {row_hash_sql((schema or get_roster_schema()).compared_types)}
+    WHERE {ROW_HASH_COLUMN} IS NULL
+    """
+    job = client.query(query)
+    job.result()
+    logging.info(f"Backfilled {job.num_dml_affected_rows} row hashes in {dataset_name}.{table_name}.")
+
+
+# Label marking a table whose text columns hold whole numbers without the '.0' the first reader left
+TEXT_FORMAT_LABEL = 'roster_text_format'
+TEXT_FORMAT_VERSION = 'integral'
+# A whole number rendered from a float, as pd.read_excel upcast columns holding a blank cell
+FLOAT_TEXT_PATTERN = r"r'^(-?[0-9]+)\.0$'"
+
+# Tables this instance found labelled, so the label is read once per instance
+_text_formatted = set()
+
+
+def has_text_format(client, dataset_name, table_name):
+    """Whether a table is labelled as holding whole numbers without the first reader's '.0'; read once per instance."""
+    table_id = f"{PROJECT_ID}.{dataset_name}.{table_name}"
+    if (id(client), table_id) in _text_formatted:
+        return True
+    labels = getattr(client.get_table(table_id), 'labels', None) or {}
+    if labels.get(TEXT_FORMAT_LABEL) != TEXT_FORMAT_VERSION:
+        return False
+    _text_formatted.add((id(client), table_id))
+    return True
+
+
+def mark_text_format(client, dataset_name, table_name):
+    """Label a table as holding text in the streaming reader's format, e.g. one it just created."""
+    table_id = f"{PROJECT_ID}.{dataset_name}.{table_name}"
+    table = client.get_table(table_id)
+    table.labels = {**(getattr(table, 'labels', None) or {}), TEXT_FORMAT_LABEL: TEXT_FORMAT_VERSION}
+    client.update_table(table, ["labels"])
+    _text_formatted.add((id(client), table_id))
+
+
+def require_text_format(client, dataset_name, table_names):
+    """Raise RuntimeError unless every table is labelled, so a run never diffs against the old format."""
+    unmigrated = [table_name for table_name in table_names if not has_text_format(client, dataset_name, table_name)]
+    if unmigrated:
+        raise RuntimeError(f"{', '.join(unmigrated)} in {dataset_name} may still hold whole numbers stored as "
+                           f"'3001234567.0'; run python migrate_text_format.py once before processing uploads.")
+
+
+def ensure_text_format(client, dataset_name, table_name, schema=None):
+    """Strip the '.0' the first reader appended to whole numbers in text columns, once per table.
+
+    pd.read_excel read a text column holding a blank cell as floats, so its
+    ids, phone numbers and codes were stored as '3001234567.0'; the streaming
+    reader renders them as '3001234567'. Rows still holding the old form are
+    rewritten and their row_hash recomputed, so the next diff does not take
+    every such employee for a change. The table is then labelled. A text
+    cell that really held e.g. '12.0' is rewritten as well. This is a data
+    migration run by migrate_text_format.py; uploads refuse unlabelled tables.
+    """
+    if has_text_format(client, dataset_name, table_name):
+        return False
+
+    schema = schema or get_roster_schema()
+    columns = [col for col in schema.text_columns if schema.field_types[col] == 'STRING']
+    if columns:
+        rewrites = ', '.join(f"{col} = REGEXP_REPLACE({col}, {FLOAT_TEXT_PATTERN}, r'\\1')" for col in columns)
+        matches = ' OR '.join(f"REGEXP_CONTAINS({col}, {FLOAT_TEXT_PATTERN})" for col in columns)
+        # row_hash is cleared with the rewrite and refilled from the new values; a run
+        # interrupted in between only leaves NULL hashes for the next call to fill
+        job = client.query(f"""
+        UPDATE `{PROJECT_ID}.{dataset_name}.{table_name}`
+        SET {rewrites}, {ROW_HASH_COLUMN} = NULL
+        WHERE {matches}
+        """)
+        job.result()
+        logging.info(f"Rewrote whole numbers stored as floats in {job.num_dml_affected_rows} rows of {dataset_name}.{table_name}.")
+        backfill_row_hashes(client, dataset_name, table_name, schema)
+
+    mark_text_format(client, dataset_name, table_name)
+    return True
+
+
+def ensure_current_table(client, dataset_name, table_name, current_table_name, schema=None):
+    """Create the one-row-per-employee table and seed it from history the first time."""
+    if table_exists(client, dataset_name, current_table_name):
+        return False
+
+    table_schema = get_table_schema(schema or get_roster_schema())
+    create_table(client, dataset_name, current_table_name, table_schema, partition_field=None)
+    columns = ", ".join(field.name for field in table_schema)
+    query = f"INSERT INTO `{PROJECT_ID}.{dataset_name}.{current_table_name}` ({columns})" + CURRENT_VERSION_QUERY.format(
+        columns=columns,
+        table_id=f"{PROJECT_ID}.{dataset_name}.{table_name}",
+        where="",
+    )
+    job = client.query(query)
+    job.result()
+    logging.info(f"Seeded {dataset_name}.{current_table_name} with {job.num_dml_affected_rows} current versions.")
+    if has_text_format(client, dataset_name, table_name):  # Copied from history, so in its format
+        mark_text_format(client, dataset_name, current_table_name)
+    return True
+
+
+def append_versions(records_df, opened_df, dataset_name=DATASET_NAME, table_name=TABLE_NAME,
+                    current_table_name=CURRENT_TABLE_NAME, schema=None):
+    """Append rows to the history table and make the opened rows the current versions, in one transaction."""
+    if records_df.empty:
+        raise RuntimeError(f"No records to append to {table_name}.")
+    client = get_bigquery_client()
+    before = table_state(client, dataset_name, current_table_name)
+    job = append_and_refresh(client, records_df, opened_df, dataset_name, table_name, current_table_name, schema)
+    update_snapshot(client, opened_df, dataset_name, current_table_name, schema, before=before, written=job.ended)
+
+
+def record_change_set(changes, dataset_name, table_name):
+    """Write one batch describing what changed; the history rows are written either way."""
+    try:
+        write_change_set(changes, dataset_name, table_name)
+    except Exception as audit_error:
+        logging.warning(f"Could not record the change set of {table_name}: {audit_error}")
+
+
+def upsert_to_bigquery(existing_df, new_df, dataset_name=DATASET_NAME, table_name=TABLE_NAME,
+                       current_table_name=CURRENT_TABLE_NAME, schema=None):
+    # Set up logging
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    try:
+        # Strip whitespace from column names
+        new_df.columns = new_df.columns.str.strip()
+        existing_df.columns = existing_df.columns.str.strip()
+
+        # Columns to check for presence in DataFrames, in table order
+        schema = schema or get_roster_schema()
+        columns_to_check = schema.names
+
+        # Check for missing columns in new_df and existing_df
+        for df_name, df in zip(['new_df', 'existing_df'], [new_df, existing_df]):
+            missing_columns = [col for col in columns_to_check if col not in df.columns]
+            if missing_columns:
+                error_message = f"Columns missing from {df_name}: {', '.join(missing_columns)}"
+                logging.error(error_message)
+                return {"success": False, "error": error_message}
+
+        # Drop rows with missing emp_id in both DataFrames before merging
+        new_df_before_drop = new_df.shape[0]
+        existing_df_before_drop = existing_df.shape[0]
+        new_df = new_df.dropna(subset=['emp_id'])
+        existing_df = existing_df.dropna(subset=['emp_id'])
+        logging.info(f"Dropped {new_df_before_drop - new_df.shape[0]} rows from new_df and {existing_df_before_drop - existing_df.shape[0]} rows from existing_df due to missing emp_id.")
+
+        # Give both DataFrames the schema's dtypes (a no-op for frames already conformed)
+        for df in [new_df, existing_df]:
+            try:
+                schema.conform(df)
+                missing_dates = int((df['start_date'].isnull() | df['end_date'].isnull()).sum())
+                if missing_dates:
+                    raise ValueError(f"Date conversion failed in {missing_dates} rows of the DataFrame.")
+            except Exception as date_conversion_error:
+                error_message = f"Error converting date columns: {str(date_conversion_error)}"
+                logging.error(error_message)
+                return {"success": False, "error": error_message}
+        schema.share_categories(new_df, existing_df)
+
+        # Diff the new data against existing records in one keyed, columnar pass; with no
+        # existing records every row is a new hire, and the change set says so
+        try:
+            with span('diff', rows_in=len(existing_df) + len(new_df), table=table_name) as stage:
+                run_date = datetime.now().date()
+                diff = diff_rosters(existing_df, new_df, columns_to_check, run_date)
+                stage['rows_out'] = len(diff.closed) + len(diff.opened) + len(diff.new_hires)
+            logging.info(f"Detected changes for {len(diff.opened)} existing emp_ids and {len(diff.new_hires)} new records.")
+        except Exception as processing_error:
+            error_message = f"Error computing changes: {str(processing_error)}"
+            logging.error(error_message)
+            return {"success": False, "error": error_message}
+
+        # Final DataFrame preparation and insertion
+        try:
+            records_to_insert_df = records_to_insert(diff)
+            if not records_to_insert_df.empty:
+                logging.info(f"Inserting {len(records_to_insert_df)} records into BigQuery.")
+                opened_df = records_to_insert(diff._replace(closed=diff.closed.iloc[0:0]))
+                append_versions(records_to_insert_df, opened_df, dataset_name, table_name, current_table_name, schema)
+
+                record_change_set(change_set(diff, columns_to_check, run_date), dataset_name, table_name)
+                return {"success": True, "message": f"Inserted {len(records_to_insert_df)} records into BigQuery.",
+                        "inserted_rows": len(records_to_insert_df)}
+            else:
+                return {"success": True, "message": "No records to insert into BigQuery.", "inserted_rows": 0}
+
+        except Exception as final_insertion_error:
+            error_message = f"Error during final insertion: {str(final_insertion_error)}"
+            logging.error(error_message)
+            return {"success": False, "error": error_message}
+
+    except Exception as general_error:
+        error_message = f"General error in upsert_to_bigquery: {str(general_error)}"
+        logging.error(error_message)
+        return {"success": False, "error": error_message}
@@ -0,0 +1,61 @@
+"""Batch output of the change set each upsert writes.
+
+Instead of a log line per changed employee, upsert_to_bigquery builds the
+change set with scd2_diff.change_set (emp_id, change type, changed columns
+and their old and new values) and hands it here once. In merge mode it is
+built from the rows the merge script returns. AUDIT_OUTPUT picks the
+destination: 'table' appends it to <table>_changes with one load job,
+'parquet' writes one file per upsert under AUDIT_PATH (local or gs://), and
+'none' keeps nothing. Only a per-type summary is logged either way.
+"""
+import logging
+import posixpath
+import uuid
+
+import fsspec
+from google.cloud import bigquery
+
+from gcp_clients import get_bigquery_client
+from instrumentation import span, job_stats
+from config import PROJECT_ID, AUDIT_OUTPUT, AUDIT_PATH
+
+AUDIT_SCHEMA = [
+    bigquery.SchemaField('run_date', 'DATE'),
+    bigquery.SchemaField('emp_id', 'STRING'),
+    bigquery.SchemaField('change_type', 'STRING'),
+    bigquery.SchemaField('changed_columns', 'STRING', mode='REPEATED'),
+    bigquery.SchemaField('old_values', 'STRING'),
+    bigquery.SchemaField('new_values', 'STRING'),
+]
+
+
+def audit_table_name(table_name):
+    """Table holding the change sets of a history table."""
+    return f"{table_name}_changes"
+
+
+def write_change_set(changes, dataset_name, table_name, output=AUDIT_OUTPUT):
+    """Store one upsert's change set in a single batch; returns where it went, or None."""
+    if output == 'none' or changes.empty:
+        return None
+    summary = ', '.join(f"{count} {change_type}" for change_type, count in changes['change_type'].value_counts().items())
+
+    with span('audit_write', rows_in=len(changes), table=table_name) as stage:
+        if output == 'table':
+            destination = f"{PROJECT_ID}.{dataset_name}.{audit_table_name(table_name)}"
+            job_config = bigquery.LoadJobConfig(schema=AUDIT_SCHEMA, write_disposition=bigquery.WriteDisposition.WRITE_APPEND)
+            job = get_bigquery_client().load_table_from_dataframe(changes, destination, job_config=job_config)
+            job.result()
+            stage.update(job_stats(job))
+        elif output == 'parquet':
+            run_date = changes['run_date'].iloc[0]
+            destination = posixpath.join(AUDIT_PATH, table_name, f"{run_date}_{uuid.uuid4().hex}.parquet")
+            fs, path = fsspec.core.url_to_fs(destination)
+            fs.makedirs(posixpath.dirname(path), exist_ok=True)
+            with fs.open(path, 'wb') as file:
+                changes.to_parquet(file, index=False)
+        else:
+            raise ValueError(f"Unknown AUDIT_OUTPUT '{output}'; expected 'table', 'parquet' or 'none'.")
+
+    logging.info(f"Recorded {summary} records in {destination}.")
+    return destination
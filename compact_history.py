@@ -0,0 +1,201 @@
+"""Compact the SCD2 history table with Spark.
+
+Every change appends two rows to tbl_alo_roster: a copy of the previous
+version re-dated to close it, and the new version. Over time the table holds
+several rows per version, plus overlapping date ranges left by re-runs and
+manual fixes, and every scan of it pays for them. This job reads the whole
+history, merges consecutive identical versions of an emp_id into one row
+spanning their dates, clips each version's end_date to the next version's
+start_date, and writes the compacted table back:
+
+    python compact_history.py                                    # report only
+    python compact_history.py --replace                          # rewrite the BigQuery tables
+    python compact_history.py --input ./backfill_out/history.parquet --local-dir ./compacted
+
+Versions are compared on the schema's compared columns, so the latest version
+of each employee, and with it the current-state table, keeps its content.
+Spark runs in local[*] mode unless --master says otherwise. --replace holds
+the history table's upload lease from the read to the write, so uploads
+arriving meanwhile wait in its queue and are upserted afterwards, and swaps
+the contents of the history and current-state tables in one transaction.
+BigQuery time travel keeps the previous contents for seven days.
+"""
+import argparse
+import logging
+import os
+import tempfile
+from contextlib import nullcontext
+
+from excel_to_pandas import get_roster_schema, get_table_schema
+from scd2_diff import KEY_COLUMN, ROW_HASH_COLUMN, compute_row_hash
+from schema_utils import DATE_DTYPE
+from snapshot_cache import normalize_snapshot
+
+
+def get_spark(master='local[*]'):
+    from pyspark.sql import SparkSession
+
+    return (SparkSession.builder
+            .master(master)
+            .appName('roster-history-compaction')
+            .config('spark.sql.session.timeZone', 'UTC')
+            .getOrCreate())
+
+
+def read_history(spark, source, workdir):
+    """History as a Spark DataFrame, from a Parquet path or, when source is None, the BigQuery table.
+
+    The table is downloaded as Arrow (through the Storage Read API when it is
+    installed) and handed to Spark as Parquet, so dates stay dates.
+    """
+    if source:
+        return spark.read.parquet(source).select(*get_roster_schema().names)
+
+    import pyarrow.parquet as pq
+    from gcp_clients import get_bigquery_client, get_bqstorage_client
+    from config import PROJECT_ID, DATASET_NAME, TABLE_NAME
+
+    client = get_bigquery_client()
+    fields = [field for field in get_table_schema(get_roster_schema()) if field.name != ROW_HASH_COLUMN]
+    table = client.list_rows(f"{PROJECT_ID}.{DATASET_NAME}.{TABLE_NAME}", selected_fields=fields).to_arrow(
+        bqstorage_client=get_bqstorage_client()
+    )
+    path = os.path.join(workdir, 'history_in.parquet')
+    pq.write_table(table, path)
+    logging.info(f"Read {table.num_rows} history rows from {DATASET_NAME}.{TABLE_NAME}.")
+    return spark.read.parquet(path)
+
+
+def compact_versions(history, compared_columns):
+    """Merge consecutive identical versions per emp_id and clip overlapping date ranges.
+
+    Rows of an emp_id are ordered by (start_date, end_date). A row starts a new
+    version unless its compared columns equal the previous row's; each version
+    spans the earliest start_date and latest end_date of its rows. A version
+    ending after the next one starts is cut back to that start_date.
+    """
+    from pyspark.sql import Window
+    from pyspark.sql import functions as F
+
+    by_date = Window.partitionBy(KEY_COLUMN).orderBy('start_date', 'end_date')
+    content = F.struct(*compared_columns)
+    versions = (history
+                .withColumn('_starts_version', ~F.lag(content).over(by_date).eqNullSafe(content))
+                .withColumn('_version', F.sum(F.col('_starts_version').cast('int'))
+                            .over(by_date.rowsBetween(Window.unboundedPreceding, Window.currentRow)))
+                .groupBy(KEY_COLUMN, '_version')
+                .agg(F.min('start_date').alias('start_date'), F.max('end_date').alias('end_date'),
+                     *[F.first(col).alias(col) for col in compared_columns]))
+
+    next_start = F.lead('start_date').over(by_date)
+    return (versions
+            .withColumn('_overlaps', F.coalesce(F.col('end_date') > next_start, F.lit(False)))
+            .withColumn('end_date', F.greatest('start_date', F.least('end_date', next_start)))
+            .select(*get_roster_schema().names, '_overlaps'))
+
+
+def current_versions(compacted):
+    """Latest version of every emp_id, picked the way CURRENT_VERSION_QUERY does."""
+    from pyspark.sql import Window
+    from pyspark.sql import functions as F
+
+    latest = Window.partitionBy(KEY_COLUMN).orderBy(F.col('start_date').desc(), F.col('end_date').desc())
+    return compacted.withColumn('_rank', F.row_number().over(latest)).filter('_rank = 1').select(*get_roster_schema().names)
+
+
+def to_pandas(df, workdir, name):
+    """Collect a Spark DataFrame through Parquet, typed like the pipeline's frames."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    path = os.path.join(workdir, name)
+    df.write.mode('overwrite').parquet(path)
+    return get_roster_schema().conform(pq.read_table(path).to_pandas(types_mapper={pa.date32(): DATE_DTYPE}.get))
+
+
+def write_bigquery(history, current):
+    """Replace the history and current-state tables with the compacted versions, in one transaction."""
+    from gcp_clients import get_bigquery_client
+    from merge_upsert import replace_tables
+    from snapshot_cache import invalidate_snapshot
+    from config import DATASET_NAME, TABLE_NAME, CURRENT_TABLE_NAME
+
+    try:
+        replace_tables(get_bigquery_client(), history, current, DATASET_NAME, TABLE_NAME, CURRENT_TABLE_NAME)
+    finally:
+        invalidate_snapshot(DATASET_NAME, CURRENT_TABLE_NAME)
+    logging.info(f"Replaced {TABLE_NAME} with {len(history)} compacted rows and {CURRENT_TABLE_NAME} with {len(current)} employees.")
+
+
+def compact(spark, source=None, local_dir=None, replace=False, lease_bucket=None):
+    """Compact the history from source (the BigQuery table when None) and write it where asked.
+
+    When replacing the tables, the history table's lease is held from the read
+    to the write, and uploads queued on it meanwhile are upserted afterwards.
+    """
+    lease, leases = nullcontext(lambda: None), None
+    if replace:
+        from table_lease import get_leases, held_lease, table_lease_name
+        from config import DATASET_NAME, TABLE_NAME
+
+        name = table_lease_name(DATASET_NAME, TABLE_NAME)
+        leases = get_leases(lease_bucket)
+        lease = held_lease(leases, name)
+    with lease as renew_lease, tempfile.TemporaryDirectory(prefix='roster_compaction_') as workdir:
+        history = read_history(spark, source, workdir).cache()
+        compacted = compact_versions(history, list(get_roster_schema().compared_types)).cache()
+        rows_before, rows_after = history.count(), compacted.count()
+        overlaps = compacted.filter('_overlaps').count()
+        employees = compacted.select(KEY_COLUMN).distinct().count()
+        logging.info(f"Compacted {rows_before} history rows into {rows_after} versions of {employees} employees; "
+                     f"clipped {overlaps} overlapping date ranges.")
+        if not (local_dir or replace):
+            return
+
+        compacted = compacted.drop('_overlaps')
+        history_df = to_pandas(compacted.orderBy(KEY_COLUMN, 'start_date', 'end_date'), workdir, 'history_out')
+        history_df = history_df.assign(**{ROW_HASH_COLUMN: compute_row_hash(history_df, get_roster_schema().compared_types)})
+        current_df = to_pandas(current_versions(compacted), workdir, 'current_out')
+        current_df = normalize_snapshot(current_df.assign(**{ROW_HASH_COLUMN: compute_row_hash(current_df, get_roster_schema().compared_types)}))
+
+        if local_dir:
+            os.makedirs(local_dir, exist_ok=True)
+            history_df.to_parquet(os.path.join(local_dir, 'history.parquet'), index=False)
+            current_df.to_parquet(os.path.join(local_dir, 'current.parquet'), index=False)
+            logging.info(f"Wrote {len(history_df)} history rows and {len(current_df)} current rows to {local_dir}.")
+        if replace:
+            renew_lease()  # Spark may have run past LEASE_TTL_SECONDS
+            write_bigquery(history_df, current_df)
+
+    if leases is not None:
+        from main import process_queued
+
+        process_queued(name, leases, lease_bucket)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--input', help='Parquet history to compact instead of the BigQuery table')
+    parser.add_argument('--local-dir', help='write the compacted tables here as Parquet')
+    parser.add_argument('--replace', action='store_true', help='replace the BigQuery history and current-state tables')
+    parser.add_argument('--master', default='local[*]', help='Spark master URL')
+    parser.add_argument('--lease-bucket', help='bucket holding the table leases, when LEASE_BUCKET is not set')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+
+    if args.replace:
+        from table_lease import get_leases
+        try:
+            get_leases(args.lease_bucket)
+        except ValueError as e:
+            parser.error(f"{e} Pass --lease-bucket with the bucket uploads land in.")
+
+    spark = get_spark(args.master)
+    try:
+        compact(spark, args.input, args.local_dir, args.replace, args.lease_bucket)
+    finally:
+        spark.stop()
+
+
+if __name__ == '__main__':
+    main()
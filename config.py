@@ -1,4 +1,79 @@
-PROJECT_ID = 'tdcxai-data-science'
-DATASET_NAME = 'project_fit'
-TABLE_NAME = 'tbl_alo_roster'
-# TABLE_NAME = 'tbl_test'
\ No newline at end of file
+import os
+
+PROJECT_ID = 'tdcxai-data-science'
+DATASET_NAME = 'project_fit'
+TABLE_NAME = 'tbl_alo_roster'
+# TABLE_NAME = 'tbl_test'
+
+# One row per employee: the latest version from TABLE_NAME, maintained by the pipeline
+CURRENT_TABLE_NAME = os.environ.get('CURRENT_TABLE_NAME', f'{TABLE_NAME}_current')
+
+# 'dataframe' diffs in the function; 'merge' stages the file and runs the SCD2 logic inside BigQuery
+UPSERT_MODE = os.environ.get('UPSERT_MODE', 'dataframe')
+
+# Rows converted per chunk by the streaming Excel reader; bounds the reader's peak memory
+EXCEL_CHUNK_SIZE = int(os.environ.get('EXCEL_CHUNK_SIZE', 10000))
+
+# Reader for xlsx uploads: 'openpyxl', 'calamine' (python-calamine, Rust-backed) or 'auto' for
+# calamine when installed; tests/test_excel_to_pandas.py checks calamine against openpyxl.
+# CSV and Parquet uploads are read with pyarrow
+XLSX_ENGINE = os.environ.get('XLSX_ENGINE', 'openpyxl')
+
+# Idempotency ledger of processed uploads: 'gcs', 'sqlite' or 'none'
+LEDGER_BACKEND = os.environ.get('LEDGER_BACKEND', 'gcs')
+LEDGER_BUCKET = os.environ.get('LEDGER_BUCKET', '')  # Defaults to the upload bucket
+LEDGER_PREFIX = os.environ.get('LEDGER_PREFIX', '_ledger/')
+LEDGER_PATH = os.environ.get('LEDGER_PATH', '/tmp/roster_ledger.sqlite')
+
+# Per-table leases serializing concurrent invocations, and the queue of uploads waiting on them:
+# 'gcs', 'sqlite' or 'none' (no coordination; only safe with a single instance). A lease left by a
+# crashed instance expires after LEASE_TTL_SECONDS, which must exceed the function timeout
+LEASE_BACKEND = os.environ.get('LEASE_BACKEND', 'gcs')
+LEASE_BUCKET = os.environ.get('LEASE_BUCKET', LEDGER_BUCKET)  # Defaults to the upload bucket
+LEASE_PREFIX = os.environ.get('LEASE_PREFIX', '_lease/')
+LEASE_PATH = os.environ.get('LEASE_PATH', '/tmp/roster_leases.sqlite')
+LEASE_TTL_SECONDS = int(os.environ.get('LEASE_TTL_SECONDS', 600))
+QUEUE_MAX_ATTEMPTS = int(os.environ.get('QUEUE_MAX_ATTEMPTS', 5))  # Failures before a queued upload is dead-lettered
+
+# Copies of the current-state table reused across invocations; an empty value disables that copy
+SNAPSHOT_CACHE_DIR = os.environ.get('SNAPSHOT_CACHE_DIR', '/tmp/roster_snapshot')
+SNAPSHOT_BUCKET = os.environ.get('SNAPSHOT_BUCKET', '')
+SNAPSHOT_PREFIX = os.environ.get('SNAPSHOT_PREFIX', '_snapshot/')
+
+# Registry of the roster pipelines this deployment serves, and the threads that parse and upsert them
+PIPELINES_PATH = os.environ.get('PIPELINES_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pipelines.yaml'))
+PIPELINE_WORKERS = int(os.environ.get('PIPELINE_WORKERS', 4))
+
+# Worker processes sharing the fingerprint split and SCD2 diff of large rosters by emp_id hash
+# (1 runs both in process), and the combined rows of both frames below which they stay in process
+DIFF_WORKERS = int(os.environ.get('DIFF_WORKERS', 1))
+DIFF_SHARD_MIN_ROWS = int(os.environ.get('DIFF_SHARD_MIN_ROWS', 200000))
+
+# Start table checks and the snapshot read while the upload is still downloading and parsing
+OVERLAP_IO = os.environ.get('OVERLAP_IO', 'true').lower() == 'true'
+
+# Opt-in profiling of each invocation's trace: 'cprofile', 'tracemalloc' or both, comma-separated
+PROFILE = os.environ.get('PROFILE', '')
+PROFILE_TOP = int(os.environ.get('PROFILE_TOP', 25))
+
+# Change set of each upsert: appended to <table>_changes ('table'), written as
+# Parquet under AUDIT_PATH, a local directory or gs:// prefix ('parquet'), or not kept ('none')
+AUDIT_OUTPUT = os.environ.get('AUDIT_OUTPUT', 'table')
+AUDIT_PATH = os.environ.get('AUDIT_PATH', '/tmp/roster_audit')
+
+# Downstream scheduled query started after a roster change. Changes within one window of
+# TRIGGER_WINDOW_SECONDS share a single run, requested once the window has closed; the
+# invocation that claimed the window waits for that and at most TRIGGER_WAIT_SECONDS more for
+# the transfer API, so the function timeout must exceed their sum
+TRANSFER_PROJECT_ID = os.environ.get('TRANSFER_PROJECT_ID', PROJECT_ID)
+TRANSFER_CONFIG_ID = os.environ.get('TRANSFER_CONFIG_ID', '671d5600-0000-2ecb-91d3-089e0831d8c8')
+TRIGGER_WINDOW_SECONDS = int(os.environ.get('TRIGGER_WINDOW_SECONDS', 300))
+TRIGGER_WAIT_SECONDS = float(os.environ.get('TRIGGER_WAIT_SECONDS', 10))
+
+# Plan mode: process_file parses and diffs each upload and logs what it would write, with
+# BigQuery dry-run estimates of the bytes its queries scan, but loads and triggers nothing.
+# Queries are priced at BQ_PRICE_PER_TIB (on-demand USD per TiB scanned), reads of table storage
+# through the Storage Read API at BQ_STORAGE_READ_PRICE_PER_TIB (USD per TiB read)
+PLAN_MODE = os.environ.get('PLAN_MODE', 'false').lower() == 'true'
+BQ_PRICE_PER_TIB = float(os.environ.get('BQ_PRICE_PER_TIB', 6.25))
+BQ_STORAGE_READ_PRICE_PER_TIB = float(os.environ.get('BQ_STORAGE_READ_PRICE_PER_TIB', 1.1))
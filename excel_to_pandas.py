@@ -1,148 +1,351 @@
-import pandas as pd
-from google.cloud import bigquery
-from datetime import datetime
-from config import PROJECT_ID, DATASET_NAME, TABLE_NAME
-import logging
-import fsspec
-from schema_utils import load_schema, sync_columns
-import os
-
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
-
-# Load schema globally
-REFERENCE_SCHEMA = load_schema(os.path.join(os.path.dirname(__file__), "reference_schema.yaml"))
-
-
-def load_excel_to_dataframe(file_path):
-    """Load an Excel file into a Pandas DataFrame."""
-    try:
-        logging.info(f"Loading Excel file from: {file_path}")
-        df = pd.read_excel(file_path, sheet_name='Roster ALO', usecols='A:X', header=0)
-
-        # Clean and prepare the columns
-        df.columns = df.columns.str.strip().str.replace(r'[^a-zA-Z0-9_]', '_', regex=True)\
-            .str.replace(r'_{2,}', '_', regex=True).str.strip('_').str.lower()  # Convert column names to lowercase
-
-        # Transform specific columns to string
-        columns_to_convert = ['emp_id', 'wave', 'national_id', 'address', 
-                              'barrio_localidad', 'natterbox', 'phone_number']
-
-        # Convert the specified columns to string
-        df[columns_to_convert] = df[columns_to_convert].fillna('').astype('string')
-        df['tenure'] = pd.to_numeric(df['tenure'], errors='coerce')  # Convert to numeric, set invalid entries to NaN
-        df['tenure'].fillna(0, inplace=True)  # Replace NaN with 0 (or any default value)
-        df['tenure'] = df['tenure'].astype('int64')  # Convert to int64
-
-        #df['birthday'] = (pd.to_datetime(df['birthday'].replace('-', pd.NaT), format='%d-%m-%Y', errors='coerce').dt.strftime('%d/%m/%Y'))
-        # Log data types after conversion to ensure they are correct
-        logging.info(f"Data types after string conversion: {df.dtypes}")
-
-        # Handle date columns separately
-        date_columns = ['contract_end_date', 'date_of_hire', 'go_live', 
-                        'termination_date', 'start_date', 'end_date', 'birthday']
-        
-        for col in date_columns:
-            if col in df.columns:
-                df[col] = df[col].replace('-', pd.NaT)  # Replace '-' with NaT
-                df[col] = pd.to_datetime(df[col], errors='coerce').dt.date  # Convert to date (YYYY-MM-DD format)
-
-                # Log the conversion results
-                logging.info(f"Processed date column: {col}, resulting data types: {df[col].dtypes}")
-        
-
-        # Ensure 'start_date' and 'end_date' are present and filled with current date if missing
-        current_date = pd.to_datetime(datetime.now().date()).date()
-        if 'start_date' not in df.columns:
-            df['start_date'] = current_date
-        if 'end_date' not in df.columns:
-            df['end_date'] = current_date
-
-        df = sync_columns(df, REFERENCE_SCHEMA)
-
-
-        # Final logging of DataFrame shape and types
-        logging.info(f"Loaded DataFrame with {len(df)} rows and columns: {df.columns.tolist()}")
-        logging.info("Final DataFrame dtypes:")
-        logging.info(df.dtypes)
-
-        return df
-
-    except Exception as e:
-        logging.error(f"Error loading Excel file '{file_path}' into DataFrame: {e}")
-        return pd.DataFrame()  # Return empty DataFrame on error
-
-
-TABLE_SCHEMA = [
-    bigquery.SchemaField("emp_id", "STRING"),
-    bigquery.SchemaField("site", "STRING"),
-    bigquery.SchemaField("name", "STRING"),
-    bigquery.SchemaField("role", "STRING"),
-    bigquery.SchemaField("status", "STRING"),
-    bigquery.SchemaField("leader", "STRING"),
-    bigquery.SchemaField("manager", "STRING"),
-    bigquery.SchemaField("work_email", "STRING"),
-    bigquery.SchemaField("wave", "STRING"),
-    bigquery.SchemaField("alo_credential_user_name", "STRING"),
-    bigquery.SchemaField("date_of_hire", "DATE"),
-    bigquery.SchemaField("termination_date", "DATE"),
-    bigquery.SchemaField("go_live", "DATE"),
-    bigquery.SchemaField("tenure", "INT64"),
-    bigquery.SchemaField("contract_type", "STRING"),
-    bigquery.SchemaField("contract_end_date", "DATE"),
-    bigquery.SchemaField("flash_card_user", "STRING"),
-    bigquery.SchemaField("national_id", "STRING"),
-    bigquery.SchemaField("personal_email", "STRING"),
-    bigquery.SchemaField("birthday", "DATE"),
-    bigquery.SchemaField("address", "STRING"),
-    bigquery.SchemaField("barrio_localidad", "STRING"),
-    bigquery.SchemaField("phone_number", "STRING"),
-    bigquery.SchemaField("natterbox", "STRING"),
-    bigquery.SchemaField("start_date", "DATE"),
-    bigquery.SchemaField("end_date", "DATE"),
-]
-
-def table_exists(client, dataset_name, table_name):
-    try:
-        # Use the client to check if the table exists
-        table_ref = client.dataset(dataset_name).table(table_name)
-        client.get_table(table_ref)  # This will raise an error if the table does not exist
-        return True
-    except NotFound:
-        return False
-
-def create_table(client, dataset_name, table_name, schema):
-    """Create a BigQuery table with the specified schema."""
-    table_id = f"{client.project}.{dataset_name}.{table_name}"
-    table = bigquery.Table(table_id, schema=schema)
-    
-    try:
-        table = client.create_table(table)  # API request
-        logging.info(f"Created table {table_id}.")
-    except Exception as e:
-        logging.error(f"Error creating table {table_id}: {e}")
-
-def load_dataframe_to_bigquery(df, project_id, dataset_name, table_name):
-    """Load the DataFrame to BigQuery."""
-    if df.empty:
-        logging.info("DataFrame is empty; nothing to load into BigQuery.")
-        return False
-
-    client = bigquery.Client()
-    table_id = f'{project_id}.{dataset_name}.{table_name}'
-
-    # Check and create the table if necessary
-    if not table_exists(client, dataset_name, table_name):
-        create_table(client, dataset_name, table_name, TABLE_SCHEMA)
-
-    logging.info(f"Loading DataFrame to BigQuery table: {table_id}")
-
-    # Load DataFrame to BigQuery
-    try:
-        job_config = bigquery.LoadJobConfig(write_disposition=bigquery.WriteDisposition.WRITE_APPEND)
-        job = client.load_table_from_dataframe(df, table_id, job_config=job_config)
-        job.result()  # Wait for job to complete
-        logging.info(f"Loaded {len(df)} rows into {table_id}.")
-        return True
-    except Exception as e:
-        logging.error(f"Error loading DataFrame to BigQuery: {e}")
-        return False
+import pandas as pd
+from google.cloud import bigquery
+from datetime import datetime
+from config import EXCEL_CHUNK_SIZE, XLSX_ENGINE
+import logging
+import fsspec
+import pyarrow as pa
+from schema_utils import load_schema, schema_version, sync_columns, compile_schema, DATE_DTYPE
+from scd2_diff import ROW_HASH_COLUMN, compute_row_hash
+import os
+import io
+import functools
+import contextlib
+from instrumentation import span, job_stats
+from gcp_clients import get_bigquery_client, get_bqstorage_client, table_exists, remember_table
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+
+REFERENCE_SCHEMA_PATH = os.path.join(os.path.dirname(__file__), "reference_schema.yaml")
+
+
+@functools.lru_cache(maxsize=None)
+def get_reference_schema(path=REFERENCE_SCHEMA_PATH):
+    """Parse a reference schema once per instance, on first use."""
+    return load_schema(path)
+
+
+@functools.lru_cache(maxsize=None)
+def get_schema_version(path=REFERENCE_SCHEMA_PATH):
+    return schema_version(path)
+
+
+@functools.lru_cache(maxsize=None)
+def get_roster_schema(path=REFERENCE_SCHEMA_PATH):
+    """Compile a reference schema into a roster's conversion plan, once per instance."""
+    return compile_schema(get_reference_schema(path))
+
+
+ROSTER_SHEET_NAME = 'Roster ALO'
+ROSTER_COLUMN_COUNT = 24  # Columns A:X
+
+
+def clean_column_names(columns):
+    """Normalise sheet headers to lowercase snake_case names."""
+    return pd.Index(columns).str.strip().str.replace(r'[^a-zA-Z0-9_]', '_', regex=True)\
+        .str.replace(r'_{2,}', '_', regex=True).str.strip('_').str.lower()  # Convert column names to lowercase
+
+
+def _header_names(header):
+    """Name blank headers the way pd.read_excel does."""
+    return [f"Unnamed: {i}" if value is None else str(value) for i, value in enumerate(header)]
+
+
+def _cell_value(value):
+    """Integral floats come back as ints, as pd.read_excel returns them."""
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _text(value):
+    if value is None or value is pd.NaT or (isinstance(value, float) and value != value):
+        return ''
+    if isinstance(value, float) and value.is_integer():  # ints upcast by a blank cell in the column
+        return str(int(value))
+    return str(value)
+
+
+def convert_roster_types(df, current_date, schema=None):
+    """Apply the roster type coercions to one frame (or chunk) of raw sheet rows."""
+    schema = schema or get_roster_schema()
+
+    # Convert the text columns to string, rendering each cell once
+    for col in schema.text_columns:
+        df[col] = pd.array([_text(value) for value in df[col]], dtype='string')
+
+    # Integers and dates are coerced straight to their final dtypes; invalid
+    # entries become 0 and NULL respectively
+    for col in schema.int_columns:
+        df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0).astype('int64')
+    for col in schema.date_columns:
+        if col in df.columns:
+            values = df[col].mask(df[col].eq('-'))  # '-' marks a blank date; masked so it cannot defeat format inference
+            df[col] = pd.to_datetime(values, errors='coerce').astype(DATE_DTYPE)
+
+    # Ensure the SCD dates are present and filled with current date if missing
+    for col in schema.scd_date_columns:
+        if col not in df.columns:
+            df[col] = pd.Series(current_date, index=df.index, dtype=DATE_DTYPE)
+    return df
+
+
+# Upload formats by object name suffix; other names are told apart by their first bytes
+FORMAT_SUFFIXES = {'.xlsx': 'xlsx', '.xlsm': 'xlsx', '.csv': 'csv', '.parquet': 'parquet', '.pq': 'parquet'}
+
+
+def detect_format(file_name, head=b''):
+    """'xlsx', 'parquet' or 'csv', from the file name's suffix or else its first bytes."""
+    suffix = os.path.splitext(str(file_name or ''))[1].lower()
+    if suffix in FORMAT_SUFFIXES:
+        return FORMAT_SUFFIXES[suffix]
+    if head.startswith(b'PK\x03\x04'):  # Zip container, as every xlsx workbook is
+        return 'xlsx'
+    if head.startswith(b'PAR1'):
+        return 'parquet'
+    return 'csv'
+
+
+@functools.lru_cache(maxsize=None)
+def xlsx_engine():
+    """Reader used for xlsx workbooks: XLSX_ENGINE, or with 'auto' python-calamine when it is installed."""
+    if XLSX_ENGINE != 'auto':
+        return XLSX_ENGINE
+    try:
+        import python_calamine  # noqa: F401
+        return 'calamine'
+    except ImportError:
+        return 'openpyxl'
+
+
+def _openpyxl_rows(file, sheet_name, column_count):
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    try:
+        yield from workbook[sheet_name].iter_rows(max_col=column_count, values_only=True)
+    finally:
+        workbook.close()
+
+
+def _calamine_rows(file, sheet_name, column_count):
+    """Rows as openpyxl returns them: blank cells are None rather than ''."""
+    from python_calamine import CalamineWorkbook
+
+    sheet = CalamineWorkbook.from_filelike(file).get_sheet_by_name(sheet_name)
+    for row in sheet.iter_rows():
+        yield tuple(None if value == '' else value for value in row[:column_count])
+
+
+def _iter_sheet_chunks(file, chunk_size, sheet_name, column_count, engine=None):
+    """Raw chunks of a workbook sheet, read row by row."""
+    read_rows = _calamine_rows if (engine or xlsx_engine()) == 'calamine' else _openpyxl_rows
+    rows = read_rows(file, sheet_name, column_count)
+    header = next(rows, None)
+    if header is None:
+        return
+    raw_columns = clean_column_names(_header_names(header))
+
+    buffer = []
+    for row in rows:
+        if all(value is None for value in row):
+            continue
+        buffer.append([_cell_value(value) for value in row])
+        if len(buffer) == chunk_size:
+            yield pd.DataFrame(buffer, columns=raw_columns[:len(buffer[0])])
+            buffer = []
+    if buffer:
+        yield pd.DataFrame(buffer, columns=raw_columns[:len(buffer[0])])
+
+
+def _table_batches(file, file_format, chunk_size):
+    """Arrow record batches of a CSV or Parquet file, with its header names."""
+    if file_format == 'parquet':
+        import pyarrow.parquet as pq
+
+        parquet = pq.ParquetFile(file)
+        return parquet.schema_arrow.names, parquet.iter_batches(batch_size=chunk_size)
+
+    import csv
+    import pyarrow.csv as pa_csv
+
+    # Every cell is read as text, as a sheet's cells arrive before conversion;
+    # type inference on the first block would reject later rows that disagree
+    text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+    header = next(csv.reader(text), [])
+    text.detach()
+    file.seek(0)
+    names = [f"f{i}" for i in range(len(header))]
+    reader = pa_csv.open_csv(
+        file,
+        read_options=pa_csv.ReadOptions(column_names=names, skip_rows=1),
+        convert_options=pa_csv.ConvertOptions(column_types={name: pa.string() for name in names},
+                                              strings_can_be_null=True),
+    )
+    return header, reader
+
+
+def _iter_table_chunks(file, file_format, chunk_size, column_count):
+    """Raw chunks of a CSV or Parquet export, headed like the sheet they were exported from."""
+    header, batches = _table_batches(file, file_format, chunk_size)
+    raw_columns = clean_column_names(_header_names([name or None for name in header[:column_count]]))
+    for batch in batches:
+        chunk = batch.select(range(len(raw_columns))).to_pandas()
+        chunk.columns = raw_columns
+        chunk = chunk.dropna(how='all')
+        if len(chunk) > chunk_size:  # CSV blocks are sized in bytes, not rows
+            for start in range(0, len(chunk), chunk_size):
+                yield chunk.iloc[start:start + chunk_size].reset_index(drop=True)
+        elif not chunk.empty:
+            yield chunk.reset_index(drop=True)
+
+
+def iter_excel_chunks(file_path, chunk_size=EXCEL_CHUNK_SIZE, as_arrow=False, current_date=None,
+                      sheet_name=ROSTER_SHEET_NAME, column_count=ROSTER_COLUMN_COUNT, schema=None, file_format=None):
+    """Stream a roster export as typed DataFrame chunks (or Arrow record batches).
+
+    The format is file_format when given, else detected from the file name or
+    its first bytes (see detect_format). Workbooks are walked row by row by
+    xlsx_engine(), openpyxl in read-only mode or python-calamine, so the raw
+    sheet is never materialised; CSV is read in blocks by pyarrow and Parquet
+    one row group batch at a time. sheet_name only applies to workbooks.
+    Peak memory is roughly the workbook's shared-strings table plus about
+    2 x chunk_size x 24 cells (~5 MB per 1,000 rows) for the chunk being
+    converted; 10,000 rows stay well under 64 MB. Fully blank rows are
+    skipped; pd.read_excel kept them, and they became employees with a blank
+    emp_id once converted. start_date and end_date default to
+    current_date, today unless given. file_path may also be an open binary
+    file, e.g. an upload already downloaded into memory.
+    """
+    current_date = current_date or datetime.now().date()
+    schema = schema or get_roster_schema()
+    source = fsspec.open(file_path, 'rb') if isinstance(file_path, str) else contextlib.nullcontext(file_path)
+    with source as file:
+        if file_format is None:
+            head = file.read(4)
+            file.seek(0)
+            file_format = detect_format(getattr(file, 'name', file_path), head)
+        if file_format == 'xlsx':
+            raw_chunks = _iter_sheet_chunks(file, chunk_size, sheet_name, column_count)
+        else:
+            raw_chunks = _iter_table_chunks(file, file_format, chunk_size, column_count)
+
+        # Every format goes through the same header cleanup, type coercion and column sync
+        columns = None
+        for chunk in raw_chunks:
+            chunk, columns = _finish_chunk(chunk, columns, current_date, schema)
+            yield pa.RecordBatch.from_pandas(chunk, preserve_index=False) if as_arrow else chunk
+
+
+def _finish_chunk(chunk, columns, current_date, schema):
+    """Type one raw chunk; the first chunk fixes the synced column names for the rest."""
+    chunk = convert_roster_types(chunk, current_date, schema)
+    if columns is None:
+        with span('column_sync'):
+            chunk = sync_columns(chunk, schema.positions)
+    else:
+        chunk.columns = columns
+    return chunk, chunk.columns
+
+
+def load_excel_to_dataframe(file_path, chunk_size=EXCEL_CHUNK_SIZE, current_date=None,
+                            sheet_name=ROSTER_SHEET_NAME, column_count=ROSTER_COLUMN_COUNT, schema=None,
+                            file_format=None):
+    """Load a roster export (xlsx, CSV or Parquet) into a Pandas DataFrame, converting it chunk by chunk."""
+    file_name = getattr(file_path, 'name', file_path)
+    try:
+        logging.info(f"Loading sheet '{sheet_name}' of roster export from: {file_name}")
+        with span('excel_load', sheet=sheet_name) as stage:
+            chunks = list(iter_excel_chunks(file_path, chunk_size=chunk_size, current_date=current_date,
+                                            sheet_name=sheet_name, column_count=column_count, schema=schema,
+                                            file_format=file_format))
+            if not chunks:
+                logging.warning(f"No rows found in sheet '{sheet_name}' of {file_name}.")
+                return pd.DataFrame()
+            df = pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+            # Categorical columns are encoded once the whole sheet is in, so one set of categories covers it
+            df = (schema or get_roster_schema()).conform(df)
+            stage['rows_out'] = len(df)
+
+        logging.info(f"Loaded DataFrame with {len(df)} rows in {len(chunks)} chunks.")
+
+        return df
+
+    except Exception as e:
+        logging.error(f"Error loading sheet '{sheet_name}' of roster export '{file_name}' into DataFrame: {e}")
+        return pd.DataFrame()  # Return empty DataFrame on error
+
+
+@functools.lru_cache(maxsize=None)
+def get_table_schema(schema):
+    """BigQuery schema of the history and current-state tables of a compiled roster schema."""
+    fields = [bigquery.SchemaField(col.name, col.field_type) for col in schema.columns]
+    return fields + [bigquery.SchemaField(ROW_HASH_COLUMN, "STRING")]
+
+
+def create_table(client, dataset_name, table_name, schema, partition_field='start_date', clustering_fields=('emp_id',)):
+    """Create a BigQuery table with the specified schema.
+
+    History tables are partitioned by day of start_date and clustered by
+    emp_id, so reads of recent versions or of a few employees prune storage.
+    """
+    table_id = f"{client.project}.{dataset_name}.{table_name}"
+    table = bigquery.Table(table_id, schema=schema)
+    if partition_field:
+        table.time_partitioning = bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY, field=partition_field)
+    if clustering_fields:
+        table.clustering_fields = list(clustering_fields)
+
+    try:
+        table = client.create_table(table)  # API request
+        remember_table(client, dataset_name, table_name)
+        logging.info(f"Created table {table_id}.")
+    except Exception as e:
+        logging.error(f"Error creating table {table_id}: {e}")
+
+def load_dataframe_to_bigquery(df, project_id, dataset_name, table_name, schema=None):
+    """Load the DataFrame to BigQuery."""
+    schema = schema or get_roster_schema()
+    if df.empty:
+        logging.info("DataFrame is empty; nothing to load into BigQuery.")
+        return False
+
+    client = get_bigquery_client()
+    table_id = f'{project_id}.{dataset_name}.{table_name}'
+
+    # Check and create the table if necessary
+    if not table_exists(client, dataset_name, table_name):
+        create_table(client, dataset_name, table_name, get_table_schema(schema))
+
+    logging.info(f"Loading DataFrame to BigQuery table: {table_id}")
+
+    # Fingerprint every row so change detection can compare hashes only
+    df = df.assign(**{ROW_HASH_COLUMN: compute_row_hash(df, schema.compared_types)})
+
+    # Load DataFrame to BigQuery
+    try:
+        job_config = bigquery.LoadJobConfig(
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+            schema_update_options=[bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION],
+        )
+        with span('load_job', rows_in=len(df), table=table_name) as stage:
+            job = client.load_table_from_dataframe(df, table_id, job_config=job_config)
+            job.result()  # Wait for job to complete
+            stage.update(job_stats(job))
+        logging.info(f"Loaded {len(df)} rows into {table_id}.")
+        return True
+    except Exception as e:
+        logging.error(f"Error loading DataFrame to BigQuery: {e}")
+        return False
+
+
+def read_to_dataframe(result, schema=None):
+    """Download a query job or list_rows result as Arrow, typed by a roster schema.
+
+    The download goes through the BigQuery Storage Read API when it is
+    available. DATE columns arrive as date32 and stay that way, so nothing is
+    re-parsed after the read.
+    """
+    table = result.to_arrow(bqstorage_client=get_bqstorage_client())
+    df = table.to_pandas(types_mapper={pa.date32(): DATE_DTYPE}.get)
+    return (schema or get_roster_schema()).conform(df)
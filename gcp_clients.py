@@ -0,0 +1,101 @@
+"""Google Cloud clients and table metadata reused across warm invocations.
+
+Client libraries are imported on first use, so modules the current
+invocation does not need (storage, data transfer) stay out of the cold
+start, and each client is built once per instance instead of per call.
+"""
+import functools
+import logging
+
+from google.api_core.exceptions import NotFound
+
+# Tables known to exist, so existence is checked once per instance
+_known_tables = set()
+
+# Client used instead of bigquery.Client, e.g. a LocalWarehouseClient
+_bigquery_override = None
+
+
+def get_bigquery_client():
+    if _bigquery_override is not None:
+        return _bigquery_override
+    return _default_bigquery_client()
+
+
+@functools.lru_cache(maxsize=None)
+def _default_bigquery_client():
+    from google.cloud import bigquery
+
+    return bigquery.Client()
+
+
+def get_bqstorage_client():
+    """Storage Read API client for Arrow downloads, or None to read through the REST API.
+
+    None is also returned when google-cloud-bigquery-storage is not installed
+    or a stand-in BigQuery client is in use.
+    """
+    if _bigquery_override is not None:
+        return None
+    return _default_bqstorage_client()
+
+
+@functools.lru_cache(maxsize=None)
+def _default_bqstorage_client():
+    try:
+        from google.cloud import bigquery_storage
+    except ImportError:
+        logging.info("google-cloud-bigquery-storage is not installed; reading results through the REST API.")
+        return None
+    return bigquery_storage.BigQueryReadClient()
+
+
+def set_bigquery_client(client):
+    """Route every BigQuery call of this process to client; None restores the default."""
+    global _bigquery_override
+    _bigquery_override = client
+    _known_tables.clear()
+
+
+@functools.lru_cache(maxsize=None)
+def get_storage_client():
+    from google.cloud import storage
+
+    return storage.Client()
+
+
+@functools.lru_cache(maxsize=None)
+def get_transfer_client():
+    from google.cloud import bigquery_datatransfer_v1
+
+    return bigquery_datatransfer_v1.DataTransferServiceClient()
+
+
+def _table_key(client, dataset_name, table_name):
+    return (id(client), f"{client.project}.{dataset_name}.{table_name}")
+
+
+# Check if the table exists
+def table_exists(client, dataset_name, table_name):
+    key = _table_key(client, dataset_name, table_name)
+    if key in _known_tables:
+        return True
+    try:
+        # Use the client to check if the table exists
+        table_ref = client.dataset(dataset_name).table(table_name)
+        client.get_table(table_ref)  # This will raise an error if the table does not exist
+    except NotFound:
+        return False
+    _known_tables.add(key)
+    return True
+
+
+def remember_table(client, dataset_name, table_name):
+    """Record a table this instance has just created."""
+    _known_tables.add(_table_key(client, dataset_name, table_name))
+
+
+def forget_table(client, dataset_name, table_name):
+    """Drop a cached existence check, e.g. after a table was deleted by hand."""
+    _known_tables.discard(_table_key(client, dataset_name, table_name))
+    logging.info(f"Forgot cached metadata for {dataset_name}.{table_name}.")
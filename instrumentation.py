@@ -0,0 +1,203 @@
+"""Per-invocation trace of the pipeline's stages, emitted as one JSON record.
+
+    with trace('process_file', bucket=bucket_name, name=file_name) as record:
+        with span('excel_load', rows_in=None, sheet=sheet_name) as stage:
+            df = load(...)
+            stage['rows_out'] = len(df)
+
+A span records its duration, the rows going in and out where the stage knows
+them, its peak RSS with peak_rss_delta_mb, how far the peak rose while the
+stage ran, and, for BigQuery jobs, job_stats(job). The peak
+is reset through /proc/self/clear_refs whenever a span starts while no other
+span runs, so sequential stages each report their own peak; stages running
+at the same time on different threads share one window and each sees the
+rise it overlapped. The trace's peak_rss_mb is the highest of them. Where
+the peak cannot be reset (peak_rss_reset is false, e.g. off Linux) it is the
+process's lifetime high-water mark.
+Spans opened outside a trace cost two clock reads and are dropped. When the
+trace ends its record is printed as a single JSON line, which Cloud Logging
+stores as one structured entry.
+
+PROFILE opts into deep dives: 'cprofile' adds the functions with the highest
+cumulative time, 'tracemalloc' the largest allocation sites; give both
+comma-separated. cProfile only sees the thread it runs in, so work handed to
+a thread pool is wrapped with profiled() to be included.
+"""
+import contextlib
+import cProfile
+import functools
+import io
+import json
+import pstats
+import threading
+import time
+import tracemalloc
+
+from config import PROFILE, PROFILE_TOP
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Trace being recorded, if any; one invocation runs per instance at a time
+_active = None
+
+
+# Writing '5' here resets the process's peak RSS (VmHWM) to its current RSS (Linux only)
+CLEAR_REFS = '/proc/self/clear_refs'
+PROC_STATUS = '/proc/self/status'
+
+
+def reset_peak_rss():
+    """Start a new peak RSS window; returns False where the peak cannot be reset."""
+    try:
+        with open(CLEAR_REFS, 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """Highest resident set size since the last reset_peak_rss (or process start), in MB.
+
+    VmHWM honours the reset; ru_maxrss, the fallback off Linux, is a
+    lifetime high-water mark.
+    """
+    try:
+        with open(PROC_STATUS) as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)  # KB on Linux
+
+
+def job_stats(job):
+    """Rows, bytes and slot time a BigQuery job reports, for adding to a span."""
+    stats = {}
+    for key in ('output_rows', 'total_bytes_processed', 'total_bytes_billed', 'slot_millis'):
+        value = getattr(job, key, None)
+        if value is not None:
+            stats[key] = value
+    return stats
+
+
+class _Trace:
+    def __init__(self, record, modes):
+        self.record = record
+        self.modes = modes
+        self.stats = None
+        self.lock = threading.Lock()
+        self.open_spans = 0
+        self.reset = reset_peak_rss()
+        self.peak = None
+
+    def open_span(self):
+        """Peak RSS as a span starts; the peak is reset first when no other span is running."""
+        with self.lock:
+            if self.open_spans == 0:
+                self.reset = reset_peak_rss() and self.reset
+            self.open_spans += 1
+            return peak_rss_mb()
+
+    def close_span(self):
+        """Peak RSS as a span ends, also kept towards the invocation's peak."""
+        with self.lock:
+            self.open_spans -= 1
+            peak = peak_rss_mb()
+            if peak is not None:
+                self.peak = max(self.peak or 0, peak)
+            return peak
+
+    def add_profile(self, profiler):
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profiler)
+            else:
+                self.stats.add(profiler)
+
+
+@contextlib.contextmanager
+def span(name, /, rows_in=None, **fields):
+    """Time one stage; yields its record so the stage can add rows_out and job statistics."""
+    record = {'stage': name, **fields}
+    if rows_in is not None:
+        record['rows_in'] = rows_in
+    active = _active
+    start_peak = active.open_span() if active is not None else None
+    start = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record['error'] = str(e)
+        raise
+    finally:
+        record['seconds'] = round(time.perf_counter() - start, 4)
+        if active is not None:
+            end_peak = active.close_span()
+            record['peak_rss_mb'] = end_peak
+            if start_peak is not None and end_peak is not None:
+                record['peak_rss_delta_mb'] = round(end_peak - start_peak, 1)
+            active.record['spans'].append(record)
+
+
+def profiled(fn):
+    """Wrap fn so its calls show up in the active trace's cProfile output from any thread."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        active = _active
+        if active is None or 'cprofile' not in active.modes:
+            return fn(*args, **kwargs)
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(fn, *args, **kwargs)
+        finally:
+            active.add_profile(profiler)
+    return wrapper
+
+
+@contextlib.contextmanager
+def trace(name, /, **fields):
+    """Collect the spans of one invocation and print them as one JSON record at the end."""
+    global _active
+    modes = {mode.strip() for mode in PROFILE.split(',') if mode.strip()}
+    active = _Trace({'severity': 'INFO', 'message': f"{name} trace", **fields, 'spans': []}, modes)
+    previous, _active = _active, active
+
+    profiler = cProfile.Profile() if 'cprofile' in modes else None
+    started_tracemalloc = 'tracemalloc' in modes and not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+    start = time.perf_counter()
+    try:
+        yield active.record
+    finally:
+        active.record['seconds'] = round(time.perf_counter() - start, 4)
+        peak = peak_rss_mb()
+        active.record['peak_rss_mb'] = max(active.peak or 0, peak) if peak is not None else None
+        active.record['peak_rss_reset'] = active.reset
+        if profiler is not None:
+            profiler.disable()
+        if started_tracemalloc:
+            # The profilers' own bookkeeping is not what a deep dive is after
+            snapshot = tracemalloc.take_snapshot().filter_traces(
+                [tracemalloc.Filter(False, module.__file__) for module in (tracemalloc, cProfile, pstats)]
+            )
+            active.record['tracemalloc_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+            active.record['allocations'] = [str(stat) for stat in snapshot.statistics('lineno')[:PROFILE_TOP]]
+            tracemalloc.stop()
+        if profiler is not None:
+            active.add_profile(profiler)
+            output = io.StringIO()
+            active.stats.stream = output
+            active.stats.sort_stats('cumulative').print_stats(PROFILE_TOP)
+            active.record['profile'] = [line for line in output.getvalue().splitlines() if line.strip()]
+        _active = previous
+        print(json.dumps(active.record, default=str), flush=True)
@@ -0,0 +1,124 @@
+"""Idempotency ledger of roster uploads that have already been processed.
+
+An upload is identified by its content checksum (md5Hash, or crc32c for
+composite objects) and, as a fallback, by bucket/name#generation, each
+combined with the reference schema version. A byte-identical re-upload,
+a retried event or a copy saved under another name therefore matches an
+existing entry and is skipped before any parsing or BigQuery work.
+"""
+import base64
+import hashlib
+import json
+import sqlite3
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+
+from gcp_clients import get_storage_client
+from config import LEDGER_BACKEND, LEDGER_BUCKET, LEDGER_PREFIX, LEDGER_PATH
+
+
+def _checksum_hex(value):
+    """GCS reports checksums base64-encoded; keys use their hex form."""
+    try:
+        return base64.b64decode(value).hex()
+    except (ValueError, TypeError):
+        return value
+
+
+def build_ledger_keys(event, schema_version):
+    """Keys identifying an upload: its content checksum and its object generation."""
+    keys = []
+    checksum = event.get('md5Hash') or event.get('crc32c')
+    if checksum:
+        algorithm = 'md5' if event.get('md5Hash') else 'crc32c'
+        keys.append(f"content:{algorithm}:{_checksum_hex(checksum)}:{schema_version}")
+    if event.get('generation'):
+        keys.append(f"generation:{event['bucket']}/{event['name']}#{event['generation']}:{schema_version}")
+    return keys
+
+
+class LedgerBackend(ABC):
+    """Storage for ledger entries; record must be an atomic create."""
+
+    @abstractmethod
+    def contains(self, key):
+        """Whether key is stored."""
+
+    @abstractmethod
+    def add(self, key, metadata):
+        """Store key; return False when it was already present."""
+
+    def seen(self, keys):
+        return any(self.contains(key) for key in keys)
+
+    def record(self, keys, metadata):
+        entry = dict(metadata, recorded_at=datetime.now(timezone.utc).isoformat())
+        for key in keys:
+            self.add(key, entry)
+
+
+class NullLedger(LedgerBackend):
+    """Ledger that never skips anything (LEDGER_BACKEND=none)."""
+
+    def contains(self, key):
+        return False
+
+    def add(self, key, metadata):
+        return True
+
+
+class SQLiteLedger(LedgerBackend):
+    """Ledger in a local SQLite file, for tests and offline runs."""
+
+    def __init__(self, path=LEDGER_PATH):
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS ledger (key TEXT PRIMARY KEY, metadata TEXT NOT NULL)"
+        )
+
+    def contains(self, key):
+        return self.connection.execute("SELECT 1 FROM ledger WHERE key = ?", (key,)).fetchone() is not None
+
+    def add(self, key, metadata):
+        cursor = self.connection.execute(
+            "INSERT OR IGNORE INTO ledger (key, metadata) VALUES (?, ?)", (key, json.dumps(metadata, default=str))
+        )
+        return cursor.rowcount == 1
+
+
+class GCSLedger(LedgerBackend):
+    """Ledger stored as one small object per key, created with ifGenerationMatch=0."""
+
+    def __init__(self, bucket_name, prefix=LEDGER_PREFIX, client=None):
+        self.bucket = (client or get_storage_client()).bucket(bucket_name)
+        self.prefix = prefix
+
+    def _blob(self, key):
+        return self.bucket.blob(f"{self.prefix}{hashlib.sha256(key.encode('utf-8')).hexdigest()}.json")
+
+    def contains(self, key):
+        return self._blob(key).exists()
+
+    def add(self, key, metadata):
+        from google.api_core.exceptions import PreconditionFailed
+
+        try:
+            self._blob(key).upload_from_string(
+                json.dumps(dict(metadata, key=key), default=str),
+                content_type='application/json',
+                if_generation_match=0,
+            )
+            return True
+        except PreconditionFailed:
+            return False
+
+
+def get_ledger(bucket_name):
+    """Ledger configured by LEDGER_BACKEND; the GCS ledger defaults to the upload bucket."""
+    if LEDGER_BACKEND == 'none':
+        return NullLedger()
+    if LEDGER_BACKEND == 'sqlite':
+        return SQLiteLedger()
+    if LEDGER_BACKEND == 'gcs':
+        return GCSLedger(LEDGER_BUCKET or bucket_name)
+    raise ValueError(f"Unknown LEDGER_BACKEND '{LEDGER_BACKEND}'")
@@ -0,0 +1,326 @@
+"""SQLite stand-in for the few BigQuery client calls the pipeline makes.
+
+LocalWarehouseClient runs the pipeline's SQL locally so that upsert logic
+can be exercised without a GCP project:
+
+    client = LocalWarehouseClient()
+    merge_upsert_to_bigquery(client, df_new, DATASET_NAME, TABLE_NAME, CURRENT_TABLE_NAME)
+
+or, for code that obtains its client from gcp_clients:
+
+    set_bigquery_client(LocalWarehouseClient())
+    process_roster('roster.xlsx')
+
+Only the BigQuery syntax the pipeline itself generates is translated:
+`project.dataset.table` identifiers, named @parameters, `IN UNNEST(@array)`,
+a top-level `SELECT * EXCEPT(...)`, BEGIN/COMMIT TRANSACTION scripts,
+script-scoped TEMP tables, escaped and raw (r'...') string literals,
+`ARRAY_TO_STRING([...], sep)` and the functions row_hash_sql and the text
+rewrite use (MD5, TO_HEX, FORMAT_DATE, REGEXP_CONTAINS, REGEXP_REPLACE).
+DATE values are stored as ISO text and REPEATED values as JSON arrays; table
+labels are kept in memory. A dry run compiles the statements without running
+them and reports the stored size of the tables they reference as the bytes
+processed.
+"""
+import functools
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+from datetime import date, datetime, timezone
+from types import SimpleNamespace
+
+import pandas as pd
+from google.api_core.exceptions import NotFound
+from google.cloud import bigquery
+from config import PROJECT_ID
+
+
+def _table_id(table):
+    """Normalise a table id, reference or Table into 'project.dataset.table'."""
+    if isinstance(table, str):
+        return table
+    return f"{table.project}.{table.dataset_id}.{table.table_id}"
+
+
+def _to_sql_value(value):
+    if isinstance(value, datetime):  # DATE columns loaded from datetime64 data
+        return value.date().isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, (list, tuple)) or getattr(value, 'ndim', 0) == 1:  # REPEATED columns
+        return json.dumps([_to_sql_value(item) for item in value])
+    if value is None or value is pd.NA or value is pd.NaT or (isinstance(value, float) and value != value):
+        return None
+    if hasattr(value, 'item'):  # numpy scalars
+        return value.item()
+    return value
+
+
+# A BigQuery string literal, optionally raw (r'...'), with backslash escapes
+_STRING_LITERAL = re.compile(r"(?<![\w'])([rR]?)'((?:[^'\\]|\\.)*)'")
+_ARRAY_TO_STRING = re.compile(r"ARRAY_TO_STRING\(\[(.*?)\],\s*('(?:[^'\\]|\\.)*')\)", re.S)
+_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', '\\': '\\', "'": "'", '"': '"'}
+
+
+def _unescape(text):
+    """Value of a BigQuery string literal's body: \\xHH and the usual escapes."""
+    return re.sub(r'\\(x[0-9a-fA-F]{2}|.)',
+                  lambda m: chr(int(m.group(1)[1:], 16)) if m.group(1)[0] == 'x' else _ESCAPES.get(m.group(1), m.group(1)),
+                  text)
+
+
+def _sqlite_literal(match):
+    value = match.group(2) if match.group(1) else _unescape(match.group(2))
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _format_date(fmt, value):
+    return None if value is None else date.fromisoformat(str(value)[:10]).strftime(fmt)
+
+
+def _array_to_string(separator, *values):
+    return separator.join(str(value) for value in values if value is not None)
+
+
+def _regexp_replace(value, pattern, replacement):
+    return None if value is None else re.sub(pattern, replacement, value)
+
+
+def _regexp_contains(value, pattern):
+    return None if value is None else re.search(pattern, value) is not None
+
+
+def _locked(method):
+    """Run a client call while holding the client's lock."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class LocalQueryJob:
+    """Result of LocalWarehouseClient.query, mirroring the QueryJob calls we use."""
+
+    def __init__(self, rows, columns, num_dml_affected_rows, date_columns):
+        self._rows = rows
+        self._columns = columns
+        self._date_columns = date_columns
+        self.num_dml_affected_rows = num_dml_affected_rows
+        self.total_bytes_processed = 0
+        self.ended = datetime.now(timezone.utc)
+
+    def result(self):
+        return self
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def to_arrow(self, **kwargs):
+        import pyarrow as pa
+
+        return pa.Table.from_pandas(self.to_dataframe(), preserve_index=False)
+
+    def to_dataframe(self, **kwargs):
+        df = pd.DataFrame(self._rows, columns=self._columns)
+        for col in df.columns:
+            if col in self._date_columns:
+                df[col] = pd.to_datetime(df[col], errors='coerce').dt.date
+        return df
+
+
+class LocalWarehouseClient:
+    """In-process SQLite warehouse exposing a subset of bigquery.Client."""
+
+    def __init__(self, path=':memory:', project=PROJECT_ID):
+        self.project = project
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        for name, arity, fn in [
+            ('MD5', 1, lambda value: None if value is None else hashlib.md5(str(value).encode('utf-8')).digest()),
+            ('TO_HEX', 1, lambda value: None if value is None else bytes(value).hex()),
+            ('FORMAT_DATE', 2, _format_date),
+            ('ARRAY_TO_STRING', -1, _array_to_string),
+            ('REGEXP_REPLACE', 3, _regexp_replace),
+            ('REGEXP_CONTAINS', 2, _regexp_contains),
+        ]:
+            self.connection.create_function(name, arity, fn, deterministic=True)
+        self._schemas = {}
+        self._modified = {}
+        self._labels = {}
+        # One connection serves every thread; calls run one at a time, as scripts and loads are not atomic
+        self._lock = threading.RLock()
+
+    # -- table metadata ---------------------------------------------------
+
+    def dataset(self, dataset_name):
+        return SimpleNamespace(table=lambda table_name: f"{self.project}.{dataset_name}.{table_name}")
+
+    def _touch(self, table_id):
+        self._modified[table_id] = datetime.now(timezone.utc)
+
+    @_locked
+    def get_table(self, table):
+        table_id = _table_id(table)
+        if table_id not in self._schemas:
+            raise NotFound(f"Table {table_id} not found")
+        num_rows = self.connection.execute(f'SELECT COUNT(*) FROM "{table_id}"').fetchone()[0]
+        return SimpleNamespace(
+            table_id=table_id.split('.')[-1],
+            full_table_id=table_id,
+            schema=list(self._schemas[table_id]),
+            num_rows=num_rows,
+            modified=self._modified[table_id],
+            labels=dict(self._labels.get(table_id, {})),
+        )
+
+    @_locked
+    def create_table(self, table, exists_ok=False):
+        table_id = _table_id(table)
+        if table_id in self._schemas:
+            if exists_ok:
+                return self.get_table(table_id)
+            raise ValueError(f"Table {table_id} already exists")
+        schema = list(table.schema)
+        columns = ', '.join(f'"{field.name}"' for field in schema)
+        self.connection.execute(f'CREATE TABLE "{table_id}" ({columns})')
+        self._schemas[table_id] = schema
+        self._touch(table_id)
+        return self.get_table(table_id)
+
+    @_locked
+    def update_table(self, table, fields):
+        table_id = _table_id(table.full_table_id.replace(':', '.'))
+        if 'labels' in fields:
+            self._labels[table_id] = dict(table.labels or {})
+        if 'schema' in fields:
+            known = {field.name for field in self._schemas[table_id]}
+            for field in table.schema:
+                if field.name not in known:
+                    self.connection.execute(f'ALTER TABLE "{table_id}" ADD COLUMN "{field.name}"')
+            self._schemas[table_id] = list(table.schema)
+        self._touch(table_id)
+        return self.get_table(table_id)
+
+    @_locked
+    def delete_table(self, table, not_found_ok=False):
+        table_id = _table_id(table)
+        if table_id not in self._schemas:
+            if not_found_ok:
+                return
+            raise NotFound(f"Table {table_id} not found")
+        self.connection.execute(f'DROP TABLE "{table_id}"')
+        del self._schemas[table_id]
+        del self._modified[table_id]
+        self._labels.pop(table_id, None)
+
+    # -- data -------------------------------------------------------------
+
+    @_locked
+    def load_table_from_dataframe(self, df, table, job_config=None):
+        table_id = _table_id(table)
+        if table_id not in self._schemas:
+            schema = list(job_config.schema) if job_config is not None and job_config.schema else [
+                bigquery.SchemaField(col, "STRING") for col in df.columns
+            ]
+            self.create_table(bigquery.Table(table_id, schema=schema))
+
+        known = [field.name for field in self._schemas[table_id]]
+        for col in df.columns:
+            if col not in known:
+                self._schemas[table_id].append(bigquery.SchemaField(col, "STRING"))
+                self.connection.execute(f'ALTER TABLE "{table_id}" ADD COLUMN "{col}"')
+
+        if job_config is not None and job_config.write_disposition == bigquery.WriteDisposition.WRITE_TRUNCATE:
+            self.connection.execute(f'DELETE FROM "{table_id}"')
+
+        columns = list(df.columns)
+        placeholders = ', '.join('?' for _ in columns)
+        quoted = ', '.join(f'"{col}"' for col in columns)
+        rows = ([_to_sql_value(value) for value in row] for row in df.itertuples(index=False, name=None))
+        self.connection.execute('BEGIN')
+        self.connection.executemany(f'INSERT INTO "{table_id}" ({quoted}) VALUES ({placeholders})', rows)
+        self.connection.execute('COMMIT')
+        self._touch(table_id)
+        return SimpleNamespace(result=lambda: None, output_rows=len(df))
+
+    @_locked
+    def list_rows(self, table, selected_fields=None):
+        table_id = _table_id(table)
+        if table_id not in self._schemas:
+            raise NotFound(f"Table {table_id} not found")
+        fields = selected_fields or self._schemas[table_id]
+        columns = ', '.join(f'"{field.name}"' for field in fields)
+        return self.query(f'SELECT {columns} FROM "{table_id}"')
+
+    def _translate(self, sql, parameters):
+        """Rewrite the BigQuery-only bits of the pipeline's SQL for SQLite."""
+        values = {}
+        for param in parameters:
+            if isinstance(param, bigquery.ArrayQueryParameter):
+                values[param.name] = json.dumps([_to_sql_value(v) for v in param.values])
+                sql = re.sub(rf'UNNEST\(@{param.name}\)', f'(SELECT value FROM json_each(:{param.name}))', sql)
+            else:
+                values[param.name] = _to_sql_value(param.value)
+        sql = re.sub(r'@(\w+)', r':\1', sql)
+        # ARRAY_TO_STRING([a, b], sep) becomes the variadic ARRAY_TO_STRING(sep, a, b)
+        sql = _ARRAY_TO_STRING.sub(r'ARRAY_TO_STRING(\2, \1)', sql)
+        sql = _STRING_LITERAL.sub(_sqlite_literal, sql)
+        return sql, values
+
+    @_locked
+    def query(self, sql, job_config=None):
+        parameters = job_config.query_parameters if job_config is not None else []
+        sql, values = self._translate(sql, parameters)
+        # SELECT * EXCEPT(a, b) becomes SELECT * with a and b dropped from the result
+        excluded = set()
+        match = re.match(r'\s*SELECT \* EXCEPT\(([\w,\s]+)\)', sql)
+        if match:
+            excluded = {name.strip() for name in match.group(1).split(',')}
+            sql = sql[:match.start(1) - len('EXCEPT(')] + sql[match.end(1) + 1:]
+        date_columns = {field.name for schema in self._schemas.values() for field in schema if field.field_type == "DATE"}
+        if job_config is not None and getattr(job_config, 'dry_run', False):
+            return self._dry_run(sql, values, date_columns)
+
+        rows, columns, affected = [], [], 0
+        for statement in (part.strip() for part in sql.split(';')):
+            if not statement:
+                continue
+            try:
+                cursor = self.connection.execute(statement, values)
+            except sqlite3.Error:
+                # A failed BigQuery script rolls back its open transaction
+                if self.connection.in_transaction:
+                    self.connection.execute('ROLLBACK')
+                raise
+            if cursor.description is not None:
+                columns = [col[0] for col in cursor.description]
+                rows = cursor.fetchall()
+            elif cursor.rowcount > 0:
+                affected += cursor.rowcount
+                target = re.match(r'(?:INSERT INTO|UPDATE|DELETE FROM)\s+`([^`]+)`', statement)
+                if target and target.group(1) in self._schemas:
+                    self._touch(target.group(1))
+
+        # Temporary tables only live for the duration of a BigQuery script
+        for (name,) in self.connection.execute("SELECT name FROM temp.sqlite_master WHERE type = 'table'").fetchall():
+            self.connection.execute(f'DROP TABLE temp."{name}"')
+        if excluded:
+            keep = [i for i, col in enumerate(columns) if col not in excluded]
+            rows = [tuple(row[i] for i in keep) for row in rows]
+            columns = [columns[i] for i in keep]
+        return LocalQueryJob(rows, columns, affected, date_columns)
+
+    def _dry_run(self, sql, values, date_columns):
+        for statement in (part.strip() for part in sql.split(';')):
+            if statement:
+                self.connection.execute(f"EXPLAIN {statement}", values)  # Raises as BigQuery would on a bad query
+        job = LocalQueryJob([], [], 0, date_columns)
+        job.total_bytes_processed = sum(self._table_bytes(table_id) for table_id in set(re.findall(r'`([^`]+)`', sql))
+                                        if table_id in self._schemas)
+        return job
+
+    def _table_bytes(self, table_id):
+        sizes = ' + '.join(f'COALESCE(LENGTH(CAST("{field.name}" AS BLOB)), 0)' for field in self._schemas[table_id])
+        return int(self.connection.execute(f'SELECT COALESCE(SUM({sizes}), 0) FROM "{table_id}"').fetchone()[0])
@@ -1,165 +1,520 @@
-from pyspark.sql import SparkSession
-import logging
-from google.cloud import storage
-from google.cloud import bigquery
-from google.cloud.exceptions import NotFound
-from excel_to_pandas import load_excel_to_dataframe, load_dataframe_to_bigquery, create_table, TABLE_SCHEMA  # Ensure you import all necessary functions and variables
-from bigquery_upsert import table_exists, read_existing_data, upsert_to_bigquery
-from config import PROJECT_ID, DATASET_NAME, TABLE_NAME
-import pandas as pd
-import time
-from google.cloud import bigquery_datatransfer_v1
-
-def process_file(event, context):
-    logging.basicConfig(level=logging.INFO)
-
-    # Get the bucket and file name
-    bucket_name = event['bucket']
-    file_name = event['name']
-    logging.info(f"Processing file {file_name} from bucket {bucket_name}")
-
-    # File path in Google Cloud Storage
-    file_path = f"gs://{bucket_name}/{file_name}"
-
-    # Load Excel data into a Pandas DataFrame
-    df_new = None
-    try:
-        df_new = load_excel_to_dataframe(file_path)
-        logging.info(f"Loaded Excel data into DataFrame with {df_new.shape[0]} rows.")
-    except Exception as e:
-        logging.error(f"Error loading Excel file to DataFrame from {file_path}: {e}")
-        return
-
-    # Ensure df_new is not None or empty
-    if df_new is None or df_new.empty:
-        logging.error("The new DataFrame is empty or was not loaded correctly.")
-        return
-
-    # Drop rows with missing emp_id
-    if 'emp_id' not in df_new.columns:
-        logging.error("New DataFrame is missing 'emp_id' column.")
-        return
-    if df_new['emp_id'].isnull().any():
-        logging.warning("New DataFrame contains rows with missing 'emp_id'. Dropping those rows.")
-        df_new.dropna(subset=['emp_id'], inplace=True)
-
-    # Initialize BigQuery client
-    try:
-        client = bigquery.Client()
-    except Exception as e:
-        logging.error(f"Error initializing BigQuery client: {e}")
-        return
-
-    # Check if the BigQuery table exists
-    if not table_exists(client, DATASET_NAME, TABLE_NAME):
-        logging.info("BigQuery table does not exist. Creating the table...")
-        try:
-            create_table(client, DATASET_NAME, TABLE_NAME, TABLE_SCHEMA)
-            logging.info("Table created successfully.")
-        except Exception as e:
-            logging.error(f"Failed to create table: {e}")
-            return
-
-    # Read existing data from BigQuery
-    try:
-        df_existing = read_existing_data(client, DATASET_NAME, TABLE_NAME)
-        logging.info(f"Loaded existing data from BigQuery with {df_existing.shape[0]} rows.")
-    except NotFound:
-        logging.info("Table exists but no data found. Proceeding with full insert.")
-        df_existing = pd.DataFrame()  # No existing data
-    except Exception as e:
-        logging.error(f"Error reading existing data from BigQuery: {e}")
-        return
-
-    # Drop rows with missing emp_id in existing data
-    if not df_existing.empty:
-        if 'emp_id' not in df_existing.columns:
-            logging.error("Existing DataFrame is missing 'emp_id' column.")
-            return
-        if df_existing['emp_id'].isnull().any():
-            logging.warning("Existing DataFrame contains rows with missing 'emp_id'. Dropping those rows.")
-            df_existing.dropna(subset=['emp_id'], inplace=True)
-
-    # Log DataFrame types and shapes
-    logging.info(f"New DataFrame columns: {df_new.columns.tolist()}")
-    logging.info(f"Existing DataFrame columns: {df_existing.columns.tolist()}")
-    logging.info(f"Shape of New DataFrame: {df_new.shape}")
-    logging.info(f"Shape of Existing DataFrame: {df_existing.shape}")
-
-    # Define columns to check
-    columns_to_check = [
-        'emp_id', 'site', 'name', 'role', 'status', 'leader', 'manager', 
-        'work_email', 'wave', 'alo_credential_user_name', 'date_of_hire', 
-        'termination_date', 'go_live', 'tenure', 'contract_type', 
-        'contract_end_date', 'flash_card_user', 'national_id', 
-        'personal_email', 'birthday', 'address', 'barrio_localidad', 
-        'phone_number', 'natterbox', 'start_date', 'end_date'
-    ]
-
-    # Align existing DataFrame types to match new DataFrame
-    for column in df_new.columns:
-        if column in df_existing.columns:
-            df_existing[column] = df_existing[column].astype(df_new[column].dtype)
-        else:
-            df_existing[column] = pd.Series([None] * len(df_existing), dtype=df_new[column].dtype)
-
-    # Ensure both DataFrames have matching columns
-    missing_in_new = set(df_existing.columns) - set(df_new.columns)
-    missing_in_existing = set(df_new.columns) - set(df_existing.columns)
-
-    # Log missing columns
-    if missing_in_new:
-        logging.warning(f"Missing columns in new DataFrame: {missing_in_new}")
-    if missing_in_existing:
-        logging.warning(f"Missing columns in existing DataFrame: {missing_in_existing}")
-
-    for col in missing_in_existing:
-        df_new[col] = None
-    for col in missing_in_new:
-        df_existing[col] = None
-
-    # Check data types consistency after alignment
-    if not all(df_new.dtypes == df_existing.dtypes):
-        logging.error("Data type mismatch between new and existing DataFrames after alignment.")
-        return
-
-    # Check for changes before performing upsert
-    if not df_existing.empty:
-        # Compare DataFrames to see if they are the same
-        if df_existing.equals(df_new):
-            logging.info("No changes detected in new data. Skipping upsert.")
-            return  # Exit if there are no changes
-
-    # Perform data loading or upsert operation
-    try:
-        if df_existing.empty:
-            logging.info("No existing data found, performing a full insert.")
-            load_successful = load_dataframe_to_bigquery(df_new, PROJECT_ID, DATASET_NAME, TABLE_NAME)
-            if not load_successful:
-                logging.error("Failed to load new data into BigQuery.")
-        else:
-            logging.info("Existing data found, performing upsert.")
-            df_existing = df_existing.reindex(columns=columns_to_check)
-            df_new = df_new.reindex(columns=columns_to_check)
-
-            upsert_result = upsert_to_bigquery(df_existing, df_new)
-            if not upsert_result['success']:
-                logging.error(f"Failed to upsert data into BigQuery: {upsert_result['error']}")
-    except Exception as e:
-        logging.error(f"Failed to upsert data into BigQuery: {e}")
-        return
-
-    logging.info("Data processing completed successfully.")
-<<<<<<< HEAD
-    # TRIGGER SCHEDULED QUERY
-=======
-     # TRIGGER SCHEDULED QUERY
->>>>>>> faee8e9593257ea17b0f6b0a4de31c47017124eb
-    transferid = '671d5600-0000-2ecb-91d3-089e0831d8c8'
-    client = bigquery_datatransfer_v1.DataTransferServiceClient()
-    projectid = 'tdcxai-data-science'
-    parent = client.project_transfer_config_path(projectid, transferid)
-    start_time = bigquery_datatransfer_v1.types.Timestamp(seconds=int(time.time() + 10))
-    response = client.start_manual_transfer_runs(parent, requested_run_time=start_time)
-    print('Scheduled Query Triggered')
-
+import logging
+from excel_to_pandas import load_excel_to_dataframe, detect_format, create_table, get_table_schema  # Ensure you import all necessary functions and variables
+from gcp_clients import get_bigquery_client, table_exists
+from bigquery_upsert import ensure_row_hash_column, mark_text_format, require_text_format, ensure_current_table, append_versions, upsert_to_bigquery, record_change_set
+from scd2_diff import KEY_COLUMN, ROW_HASH_COLUMN, change_set
+from sharded_diff import fingerprint_split
+from merge_upsert import merge_upsert_to_bigquery
+from snapshot_cache import load_snapshot
+from ledger import build_ledger_keys, get_ledger
+from table_lease import get_leases, lease_name, upload_id
+from backfill import replay_export
+from pipelines import default_pipeline, load_pipelines, match_pipelines, pipelines_version
+from instrumentation import trace, span, profiled
+from scheduled_query import request_run, wait_for_runs
+from config import UPSERT_MODE, PLAN_MODE, LEDGER_PREFIX, SNAPSHOT_PREFIX, LEASE_PREFIX, LEASE_TTL_SECONDS, QUEUE_MAX_ATTEMPTS, PIPELINE_WORKERS, OVERLAP_IO
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import pandas as pd
+import fsspec
+import io
+import uuid
+
+def process_file(event, context):
+    logging.basicConfig(level=logging.INFO)
+
+    # Get the bucket and file name
+    bucket_name = event['bucket']
+    file_name = event['name']
+    if file_name.startswith((LEDGER_PREFIX, SNAPSHOT_PREFIX, LEASE_PREFIX)):
+        return  # Our own ledger entries, cached snapshots, leases and queued uploads
+
+    # One structured record per invocation, with a span per stage
+    with trace('process_file', bucket=bucket_name, name=file_name, generation=event.get('generation')) as record:
+        record['outcome'] = handle_upload(event)
+
+        # Triggers were handed to a background thread; give them a bounded wait before returning
+        with span('transfer_wait'):
+            wait_for_runs()
+
+
+def handle_upload(event):
+    """Process one uploaded object; returns the outcome recorded in the invocation's trace."""
+    bucket_name = event['bucket']
+    file_name = event['name']
+
+    # Rosters registered for this object name
+    pipelines = match_pipelines(file_name)
+    if not pipelines:
+        logging.info(f"No pipeline is registered for {file_name}. Skipping.")
+        return 'no_pipeline'
+
+    # Plan mode reports what the upload would change and writes nothing, not even the ledger
+    if PLAN_MODE:
+        from upload_plan import plan_upload, format_plan
+
+        plans = plan_upload(f"gs://{bucket_name}/{file_name}", pipelines)
+        for plan in plans:
+            logging.info(f"Plan for {file_name}:\n{format_plan(plan)}")
+        return 'planned' if plans else 'failed'
+
+    # Skip pipelines that already processed this content with their current schema
+    try:
+        ledger = get_ledger(bucket_name)
+        pipelines = [p for p in pipelines if not ledger.seen(build_ledger_keys(event, pipelines_version([p])))]
+        if not pipelines:
+            logging.info(f"File {file_name} from bucket {bucket_name} was already processed. Skipping.")
+            return 'duplicate'
+    except Exception as e:
+        logging.warning(f"Idempotency ledger unavailable, processing anyway: {e}")
+        ledger = None
+
+    logging.info(f"Processing file {file_name} from bucket {bucket_name}")
+
+    # File path in Google Cloud Storage, and what the ledger needs to identify the upload
+    upload = {'file_path': f"gs://{bucket_name}/{file_name}", 'bucket': bucket_name, 'name': file_name,
+              'generation': event.get('generation'), 'md5Hash': event.get('md5Hash'), 'crc32c': event.get('crc32c')}
+
+    try:
+        leases = get_leases(bucket_name)
+    except Exception as e:
+        logging.warning(f"Table leases unavailable, processing without coordination: {e}")
+        leases = None
+
+    if leases is None:
+        if not run_pipelines(upload['file_path'], pipelines, ledger):
+            return 'failed'
+        record_processed(ledger, upload, pipelines)
+        return 'processed'
+
+    # Concurrent invocations take turns on each pipeline's tables
+    return run_serialized(pipelines, upload, leases, ledger)
+
+
+def record_processed(ledger, upload, pipelines):
+    """Enter an upload in the idempotency ledger as processed by pipelines."""
+    if ledger is None:
+        return
+    for pipeline in pipelines:
+        try:
+            ledger.record(build_ledger_keys(upload, pipelines_version([pipeline])),
+                          {'bucket': upload['bucket'], 'name': upload['name'], 'generation': upload['generation'],
+                           'pipeline': pipeline.name})
+        except Exception as e:
+            logging.warning(f"Could not record {upload['name']} in the idempotency ledger: {e}")
+
+
+def run_serialized(pipelines, upload, leases, ledger=None):
+    """Queue an upload on each pipeline's lease, then work through the queues for as long as this invocation holds leases.
+
+    Returns 'processed' or 'failed' when this invocation upserted the upload
+    for some of its pipelines, and 'queued' when the invocations holding the
+    leases pick it up instead.
+    """
+    entry_id = upload_id(upload)
+    for pipeline in pipelines:
+        leases.enqueue(lease_name(pipeline), entry_id, upload)
+    results = drain_queues(pipelines, leases, ledger)
+    outcomes = [results[pipeline.name][entry_id] for pipeline in pipelines if entry_id in results[pipeline.name]]
+    if not outcomes:
+        return 'queued'
+    return 'processed' if all(outcomes) else 'failed'
+
+
+def drain_queues(pipelines, leases, ledger=None):
+    """Upsert the pipelines' queued uploads while their leases can be had; returns {pipeline name: {entry_id: succeeded}}.
+
+    The leases that are free are taken together, and pipelines whose queues
+    hold the same uploads are upserted together, so an upload matching several
+    pipelines is downloaded and parsed once. A queue is checked again after
+    every release: an upload queued before that check is taken here, and one
+    queued after it finds the lease free and takes it itself, so nothing is
+    left waiting for the next event. Only uploads that succeeded leave a
+    queue; a failed one stays queued for the next holder to retry, and is not
+    taken again by this caller. Its entry counts the failures, and after
+    QUEUE_MAX_ATTEMPTS of them it is moved to the queue's dead letters.
+    """
+    owner = uuid.uuid4().hex
+    results = {pipeline.name: {} for pipeline in pipelines}
+    held = []
+
+    def untried(pipeline):
+        return [(queued_id, entry) for queued_id, entry in leases.pending(lease_name(pipeline))
+                if queued_id not in results[pipeline.name]]
+
+    def renew_lease():
+        return all([leases.acquire(lease_name(pipeline), owner, LEASE_TTL_SECONDS) for pipeline in held])
+
+    remaining = list(pipelines)
+    while remaining:
+        held = [pipeline for pipeline in remaining if leases.acquire(lease_name(pipeline), owner, LEASE_TTL_SECONDS)]
+        if not held:
+            break
+        try:
+            batches = {}
+            for pipeline in held:
+                batch = untried(pipeline)
+                if batch:
+                    batches.setdefault(tuple(queued_id for queued_id, _ in batch), ([entry for _, entry in batch], []))[1].append(pipeline)
+            for queued_ids, (uploads, group) in batches.items():
+                outcomes = upsert_batch(group, uploads, ledger, renew_lease)
+                for pipeline in group:
+                    results[pipeline.name].update(zip(queued_ids, outcomes[pipeline.name]))
+                    leases.remove(lease_name(pipeline), [queued_id for queued_id, ok in zip(queued_ids, outcomes[pipeline.name]) if ok])
+                    for queued_id, upload, ok in zip(queued_ids, uploads, outcomes[pipeline.name]):
+                        if not ok:
+                            count_failure(leases, lease_name(pipeline), queued_id, upload)
+        finally:
+            for pipeline in held:
+                leases.release(lease_name(pipeline), owner)
+        remaining = [pipeline for pipeline in held if untried(pipeline)]
+    return results
+
+
+def count_failure(leases, name, entry_id, upload):
+    """Count a failed attempt on a queued upload; dead-letter it after QUEUE_MAX_ATTEMPTS."""
+    entry = dict(upload, attempts=upload.get('attempts', 0) + 1)
+    if entry['attempts'] < QUEUE_MAX_ATTEMPTS:
+        leases.update(name, entry_id, entry)
+        return
+    leases.dead_letter(name, entry_id, entry)
+    logging.error(f"Upload {upload['name']} failed {entry['attempts']} times on {name}; "
+                  f"moved it to the dead letters. Fix it and upload it again.")
+
+
+def process_queued(name, leases, bucket_name=None):
+    """Upsert the uploads queued on a table's lease while a job outside process_file held it."""
+    try:
+        ledger = get_ledger(bucket_name)
+    except Exception as e:
+        logging.warning(f"Idempotency ledger unavailable, queued uploads will not be recorded: {e}")
+        ledger = None
+    for pipeline in load_pipelines():
+        if lease_name(pipeline) == name:
+            results = drain_queues([pipeline], leases, ledger)[pipeline.name]
+            if results:
+                logging.info(f"Upserted {sum(results.values())} of {len(results)} uploads queued on {name}.")
+            return results
+    return {}
+
+
+def upsert_batch(pipelines, uploads, ledger=None, renew_lease=None):
+    """Upsert the same queued uploads for several pipelines, oldest first; returns {pipeline name: [succeeded]}.
+
+    A single upload is run for all the pipelines at once, and succeeds or
+    fails for all of them; several are batched per pipeline.
+    """
+    if len(uploads) == 1:
+        ok = run_pipelines(uploads[0]['file_path'], pipelines, ledger)
+        results = {pipeline.name: [ok] for pipeline in pipelines}
+    else:
+        results = {}
+        for pipeline in pipelines:
+            logging.info(f"Upserting {len(uploads)} queued uploads for pipeline {pipeline.name} in one batch.")
+            results[pipeline.name] = run_batch(pipeline, [upload['file_path'] for upload in uploads], ledger, renew_lease)
+    for pipeline in pipelines:
+        for upload, ok in zip(uploads, results[pipeline.name]):
+            if ok:
+                record_processed(ledger, upload, [pipeline])
+    return results
+
+
+def process_roster(file_path, pipeline=None):
+    """Load one roster export and upsert it; returns True when it was fully handled."""
+    return run_pipelines(file_path, [pipeline or default_pipeline()])
+
+
+def run_pipelines(file_path, pipelines, ledger=None):
+    """Parse one upload and upsert it for each of its pipelines; True when all of them succeeded.
+
+    The upload is downloaded once and its format detected (xlsx, CSV or
+    Parquet). Its sheets are then parsed, and the pipelines upserted, on at
+    most PIPELINE_WORKERS threads sharing the instance's warm clients. Pipelines write to distinct tables, so their
+    upserts never touch the same rows. With OVERLAP_IO each pipeline's table
+    checks and snapshot read start before the download and run alongside it
+    and the parse, as none of them depends on the upload. The ledger, when
+    given, coalesces scheduled query triggers across instances.
+    """
+    sheets = [(pipeline, sheet_name) for pipeline in pipelines for sheet_name in pipeline.sheets]
+    pool = ThreadPoolExecutor(max_workers=max(1, min(PIPELINE_WORKERS, len(sheets) + len(pipelines))))
+    try:
+        # Submitted first, so these have all started before any upsert waits on them
+        preparing = {pipeline.name: pool.submit(profiled(prepare_pipeline), pipeline) for pipeline in pipelines} if OVERLAP_IO else {}
+
+        data = read_upload(file_path)
+        if data is None:
+            return False
+        file_format = detect_format(file_path, data[:4])
+        sheets = [(pipeline, sheet_name) for pipeline in pipelines for sheet_name in upload_sheets(pipeline, file_format)]
+
+        frames = list(pool.map(profiled(lambda job: load_sheet(file_path, data, *job, file_format=file_format)), sheets))
+        frames_by_pipeline = {pipeline.name: [] for pipeline in pipelines}
+        for (pipeline, _), df in zip(sheets, frames):
+            frames_by_pipeline[pipeline.name].append(df)
+
+        @profiled
+        def finish(pipeline):
+            future = preparing.get(pipeline.name)
+            prepared = future.result() if future else prepare_pipeline(pipeline)
+            return prepared is not None and upsert_roster(pipeline, frames_by_pipeline[pipeline.name], prepared, ledger)
+
+        return all(list(pool.map(finish, pipelines)))
+    finally:
+        # On failure, work that has not started is cancelled; calls already in flight finish first
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def run_batch(pipeline, file_paths, ledger=None, renew_lease=None):
+    """Upsert several uploads of one pipeline with a single diff and write; returns whether each succeeded.
+
+    The uploads are replayed in order against the current state in memory,
+    as successive runs would apply them on the same day, and every version
+    they produce is appended in one script, with one change set covering
+    them all. Merge mode diffs in BigQuery, so there they are merged one
+    after the other. renew_lease, when given, is called before every write
+    and must return True for the write to go ahead.
+    """
+    prepared = prepare_pipeline(pipeline)
+    if prepared is None:
+        return [False] * len(file_paths)
+
+    batch = []
+    for file_path in file_paths:
+        data = read_upload(file_path)
+        file_format = detect_format(file_path, data[:4]) if data else None
+        frames = [load_sheet(file_path, data, pipeline, sheet_name, file_format)
+                  for sheet_name in upload_sheets(pipeline, file_format)] if data else []
+        if not frames or any(df is None or df.empty for df in frames):
+            logging.error(f"A sheet of {file_path} is empty or was not loaded correctly; leaving it out of the batch.")
+            frames = None
+        batch.append(frames)
+
+    def lease_held():
+        if renew_lease is None or renew_lease():
+            return True
+        logging.error(f"Lost the lease on {lease_name(pipeline)}; leaving the rest of the batch queued.")
+        return False
+
+    if UPSERT_MODE == 'merge':
+        results = []
+        for frames in batch:
+            if frames is not None and not lease_held():
+                return results + [False] * (len(batch) - len(results))
+            results.append(frames is not None and upsert_roster(pipeline, frames, prepared, ledger))
+        return results
+
+    client, current = prepared
+    run_date = datetime.now().date()
+    records, changes = [], []
+    with span('batch_replay', rows_in=sum(len(df) for frames in batch if frames for df in frames),
+              table=pipeline.table_name) as stage:
+        for frames in batch:
+            if frames is not None:
+                df_new = pipeline.schema.conform(pd.concat(frames, ignore_index=True)) if len(frames) > 1 else frames[0]
+                file_records, current, diff = replay_export(current, df_new, run_date, pipeline.schema)
+                if not file_records.empty:
+                    records.append(file_records)
+                    changes.append(change_set(diff, pipeline.schema.names, run_date))
+        stage['rows_out'] = sum(len(df) for df in records)
+
+    if records:
+        if not lease_held():
+            return [False] * len(file_paths)
+        records_df = pd.concat(records, ignore_index=True)
+        opened_df = current[current[KEY_COLUMN].isin(records_df[KEY_COLUMN])].drop(columns=[ROW_HASH_COLUMN])
+        try:
+            append_versions(records_df, opened_df, pipeline.dataset_name, pipeline.table_name,
+                            pipeline.current_table_name, pipeline.schema)
+        except Exception as e:
+            logging.error(f"Failed to upsert the batch into BigQuery: {e}")
+            return [False] * len(file_paths)
+        record_change_set(pd.concat(changes, ignore_index=True), pipeline.dataset_name, pipeline.table_name)
+        logging.info(f"Appended {len(records_df)} records from {len(file_paths)} uploads for pipeline {pipeline.name}.")
+        if pipeline.trigger_scheduled_query:
+            with span('transfer_trigger'):
+                trigger_scheduled_query(ledger)
+    else:
+        logging.info("No changes detected in the batch. Skipping upsert.")
+    return [frames is not None for frames in batch]
+
+
+def read_upload(file_path):
+    """Download an uploaded export; None when it cannot be read."""
+    try:
+        with fsspec.open(file_path, 'rb') as file:
+            return file.read()
+    except Exception as e:
+        logging.error(f"Error reading upload {file_path}: {e}")
+        return None
+
+
+def upload_sheets(pipeline, file_format):
+    """Sheets of a pipeline to parse from an upload; a CSV or Parquet export holds a single table."""
+    return pipeline.sheets if file_format == 'xlsx' else pipeline.sheets[:1]
+
+
+def load_sheet(file_path, data, pipeline, sheet_name, file_format=None):
+    """Parse one sheet of a downloaded export with its pipeline's schema."""
+    workbook = io.BytesIO(data)  # Each thread reads its own view of the shared bytes
+    workbook.name = file_path
+    return load_excel_to_dataframe(workbook, sheet_name=sheet_name, column_count=pipeline.column_count,
+                                   schema=pipeline.schema, file_format=file_format)
+
+
+def prepare_pipeline(pipeline):
+    """Get a pipeline's tables ready and read its current state; returns (client, snapshot) or None on failure.
+
+    The snapshot is None in merge mode, which does not diff in the function.
+    """
+    schema = pipeline.schema
+    dataset_name, table_name, current_table_name = pipeline.dataset_name, pipeline.table_name, pipeline.current_table_name
+
+    # Initialize BigQuery client (reused across warm invocations)
+    try:
+        client = get_bigquery_client()
+    except Exception as e:
+        logging.error(f"Error initializing BigQuery client: {e}")
+        return None
+
+    # Check if the BigQuery table exists
+    if not table_exists(client, dataset_name, table_name):
+        logging.info(f"BigQuery table {table_name} does not exist. Creating the table...")
+        try:
+            create_table(client, dataset_name, table_name, get_table_schema(schema))
+            mark_text_format(client, dataset_name, table_name)
+            logging.info("Table created successfully.")
+        except Exception as e:
+            logging.error(f"Failed to create table: {e}")
+            return None
+
+    # Make sure history rows carry fingerprints, the current-state table exists and both hold the current text format
+    try:
+        with span('table_checks', table=table_name):
+            ensure_row_hash_column(client, dataset_name, table_name, schema)
+            ensure_current_table(client, dataset_name, table_name, current_table_name, schema)
+            require_text_format(client, dataset_name, [table_name, current_table_name])
+    except Exception as e:
+        logging.error(f"Error preparing BigQuery tables: {e}")
+        return None
+
+    if UPSERT_MODE == 'merge':
+        return client, None
+
+    # Current-state snapshot to compare fingerprints against (cached when still valid)
+    try:
+        return client, load_snapshot(client, dataset_name, current_table_name, schema)
+    except Exception as e:
+        logging.error(f"Error reading current roster state from BigQuery: {e}")
+        return None
+
+
+def upsert_roster(pipeline, frames, prepared, ledger=None):
+    """Upsert the parsed sheets of one pipeline into its tables; returns True when fully handled."""
+    schema = pipeline.schema
+    dataset_name, table_name, current_table_name = pipeline.dataset_name, pipeline.table_name, pipeline.current_table_name
+    client, snapshot = prepared
+
+    # Ensure every sheet was loaded; upserting the others alone would hide the failure
+    if any(df is None or df.empty for df in frames):
+        logging.error(f"A sheet of pipeline {pipeline.name} is empty or was not loaded correctly.")
+        return False
+    df_new = schema.conform(pd.concat(frames, ignore_index=True)) if len(frames) > 1 else frames[0]
+    logging.info(f"Loaded Excel data for pipeline {pipeline.name} into DataFrame with {df_new.shape[0]} rows.")
+
+    # Drop rows with missing emp_id
+    if 'emp_id' not in df_new.columns:
+        logging.error("New DataFrame is missing 'emp_id' column.")
+        return False
+    if df_new['emp_id'].isnull().any():
+        logging.warning("New DataFrame contains rows with missing 'emp_id'. Dropping those rows.")
+        df_new.dropna(subset=['emp_id'], inplace=True)
+
+    # Server-side mode: stage the file and let BigQuery close and open versions
+    if UPSERT_MODE == 'merge':
+        upsert_result = merge_upsert_to_bigquery(client, df_new, dataset_name, table_name, current_table_name,
+                                                 schema=schema)
+        if not upsert_result['success']:
+            logging.error(f"Failed to merge data into BigQuery: {upsert_result['error']}")
+            return False
+        record_change_set(upsert_result['changes'], dataset_name, table_name)
+        logging.info(f"Data processing completed successfully for pipeline {pipeline.name}.")
+        if pipeline.trigger_scheduled_query and upsert_result['inserted_rows']:
+            with span('transfer_trigger'):
+                trigger_scheduled_query(ledger)
+        return True
+
+    # Compare content fingerprints against the current-state snapshot
+    df_existing = pd.DataFrame()  # No existing data
+    if not snapshot.empty:
+        with span('fingerprint_split', rows_in=len(df_new), table=table_name) as stage:
+            changed_ids, new_ids = fingerprint_split(df_new, snapshot[['emp_id', ROW_HASH_COLUMN]], schema.compared_types)
+            stage['rows_out'] = len(changed_ids) + len(new_ids)
+        logging.info(f"Fingerprints show {len(changed_ids)} changed and {len(new_ids)} new emp_ids.")
+        if not changed_ids and not new_ids:
+            logging.info("No changes detected in new data. Skipping upsert.")
+            return True
+        df_new = df_new[df_new['emp_id'].isin(changed_ids + new_ids)]
+
+        # Existing rows of the changed employees; row_hash is recomputed on load
+        df_existing = snapshot[snapshot['emp_id'].isin(changed_ids)].drop(columns=[ROW_HASH_COLUMN]).reset_index(drop=True)
+        logging.info(f"Loaded existing data for {df_existing.shape[0]} changed employees.")
+
+    # Drop rows with missing emp_id in existing data
+    if not df_existing.empty:
+        if 'emp_id' not in df_existing.columns:
+            logging.error("Existing DataFrame is missing 'emp_id' column.")
+            return False
+        if df_existing['emp_id'].isnull().any():
+            logging.warning("Existing DataFrame contains rows with missing 'emp_id'. Dropping those rows.")
+            df_existing.dropna(subset=['emp_id'], inplace=True)
+
+    # Both frames follow the compiled roster schema; only missing columns need checking
+    with span('type_alignment', rows_in=len(df_new) + len(df_existing), table=table_name):
+        missing_columns = [col for col in schema.names if col not in df_new.columns]
+        if missing_columns:
+            logging.error(f"New DataFrame is missing columns: {missing_columns}")
+            return False
+        df_new = df_new[schema.names]
+        if not df_existing.empty:
+            df_existing = df_existing[schema.names]
+            schema.share_categories(df_new, df_existing)
+
+    # Check for changes before performing upsert
+    if not df_existing.empty:
+        # Compare DataFrames to see if they are the same
+        if df_existing.equals(df_new):
+            logging.info("No changes detected in new data. Skipping upsert.")
+            return True  # Exit if there are no changes
+
+    # Perform data loading or upsert operation
+    try:
+        if df_existing.empty:
+            logging.info("No existing data found, inserting every row as a new hire.")
+            df_existing = df_new.iloc[0:0]
+        else:
+            logging.info("Existing data found, performing upsert.")
+        upsert_result = upsert_to_bigquery(df_existing, df_new, dataset_name, table_name, current_table_name, schema)
+        if not upsert_result['success']:
+            logging.error(f"Failed to upsert data into BigQuery: {upsert_result['error']}")
+            return False
+        inserted_rows = upsert_result['inserted_rows']
+    except Exception as e:
+        logging.error(f"Failed to upsert data into BigQuery: {e}")
+        return False
+
+    logging.info(f"Data processing completed successfully for pipeline {pipeline.name}.")
+    # TRIGGER SCHEDULED QUERY (only when rows were written)
+    if pipeline.trigger_scheduled_query and inserted_rows:
+        with span('transfer_trigger'):
+            trigger_scheduled_query(ledger)
+    return True
+
+
+def trigger_scheduled_query(ledger=None):
+    """Request a run of the downstream scheduled query that consumes the roster table.
+
+    Requests within one TRIGGER_WINDOW_SECONDS window share a single run, started
+    once the window closes; the transfer API is called on a background thread,
+    so this does not block.
+    """
+    request_run(ledger)
@@ -0,0 +1,268 @@
+from google.cloud import bigquery
+from excel_to_pandas import get_table_schema, get_roster_schema
+from scd2_diff import KEY_COLUMN, SCD_DATE_COLUMNS, ROW_HASH_COLUMN, Scd2Diff, compute_row_hash, change_set
+from instrumentation import span, job_stats
+from config import PROJECT_ID
+from datetime import datetime, timedelta, timezone
+import pandas as pd
+import logging
+import uuid
+
+# Position of each row in the uploaded file, used to pick the first row per emp_id
+SOURCE_ROW_COLUMN = 'source_row'
+STAGING_TABLE_TTL = timedelta(hours=1)
+# Script-scoped temporary table holding the rows a merge appends
+CHANGES_TABLE = 'scd2_changes'
+
+
+def build_scd2_merge_script(table_id, current_table_id, staging_table_id, columns, comparison_columns):
+    """Build the close-and-open SCD2 script run against the history and current tables.
+
+    In one transaction the script appends to the history table:
+      * the current version of every changed emp_id, closed with end_date = @run_date;
+      * the first staged row of every changed emp_id, opened on @run_date;
+      * every staged row whose emp_id has no version yet, opened on @run_date;
+    and replaces the current-table row of every changed or new emp_id with its
+    first opened row. A staged emp_id is changed when any comparison column IS
+    DISTINCT FROM its current version, so NULLs compare as values. Current
+    versions come from the current table, so history is never scanned. The
+    script's result is the rows it appended, with their change_type.
+    """
+    column_list = ', '.join(columns)
+    staged_columns = ', '.join(
+        f"@run_date AS {col}" if col in SCD_DATE_COLUMNS else f"s.{col}" for col in columns
+    )
+    closed_columns = ', '.join(f"@run_date AS {col}" if col == 'end_date' else f"c.{col}" for col in columns)
+    differs = '\n             OR '.join(f"s.{col} IS DISTINCT FROM c.{col}" for col in comparison_columns)
+
+    return f"""
+BEGIN TRANSACTION;
+
+CREATE TEMP TABLE {CHANGES_TABLE} AS
+WITH first_staged AS (
+  SELECT *
+  FROM (
+    SELECT s.*,
+           ROW_NUMBER() OVER (PARTITION BY {KEY_COLUMN} ORDER BY {SOURCE_ROW_COLUMN}) AS staged_rank
+    FROM `{staging_table_id}` s
+  )
+  WHERE staged_rank = 1
+),
+changed AS (
+  SELECT s.{KEY_COLUMN}
+  FROM first_staged s
+  JOIN `{current_table_id}` c ON s.{KEY_COLUMN} = c.{KEY_COLUMN}
+  WHERE {differs}
+)
+SELECT 'closed' AS change_type, CAST(NULL AS INT64) AS {SOURCE_ROW_COLUMN}, {closed_columns}
+FROM `{current_table_id}` c
+WHERE c.{KEY_COLUMN} IN (SELECT {KEY_COLUMN} FROM changed)
+UNION ALL
+SELECT 'opened' AS change_type, s.{SOURCE_ROW_COLUMN}, {staged_columns}
+FROM first_staged s
+WHERE s.{KEY_COLUMN} IN (SELECT {KEY_COLUMN} FROM changed)
+UNION ALL
+SELECT 'opened' AS change_type, s.{SOURCE_ROW_COLUMN}, {staged_columns}
+FROM `{staging_table_id}` s
+WHERE NOT EXISTS (SELECT 1 FROM `{current_table_id}` c WHERE c.{KEY_COLUMN} = s.{KEY_COLUMN});
+
+INSERT INTO `{table_id}` ({column_list})
+SELECT {column_list} FROM {CHANGES_TABLE};
+
+DELETE FROM `{current_table_id}`
+WHERE {KEY_COLUMN} IN (SELECT {KEY_COLUMN} FROM {CHANGES_TABLE});
+
+INSERT INTO `{current_table_id}` ({column_list})
+SELECT {column_list}
+FROM (
+  SELECT *, ROW_NUMBER() OVER (PARTITION BY {KEY_COLUMN} ORDER BY {SOURCE_ROW_COLUMN}) AS opened_rank
+  FROM {CHANGES_TABLE}
+  WHERE change_type = 'opened'
+)
+WHERE opened_rank = 1;
+
+COMMIT TRANSACTION;
+
+SELECT * FROM {CHANGES_TABLE};
+"""
+
+
+def changes_to_diff(changes, columns, schema=None):
+    """Rebuild the Scd2Diff a merge script applied from the rows it returned.
+
+    Frames are indexed by the first-appearance rank of each emp_id among the
+    opened rows, as diff_scd2 indexes them, so change_set keeps the write order.
+    """
+    schema = schema or get_roster_schema()
+    changes = schema.conform(changes.copy())
+    opened = changes[changes['change_type'] == 'opened'].sort_values(SOURCE_ROW_COLUMN, kind='stable')
+    closed = changes[changes['change_type'] == 'closed']
+    ranks = pd.Index(opened[KEY_COLUMN].drop_duplicates())
+    is_changed = opened[KEY_COLUMN].isin(closed[KEY_COLUMN])
+
+    def ranked(df):
+        return df[columns].set_axis(ranks.get_indexer(df[KEY_COLUMN]))
+
+    return Scd2Diff(closed=ranked(closed).sort_index(), opened=ranked(opened[is_changed]).sort_index(),
+                    new_hires=ranked(opened[~is_changed]))
+
+
+def build_append_script(table_id, current_table_id, records_table_id, opened_table_id, columns):
+    """Append the staged records to history and make the first staged opened row of each emp_id its current version.
+
+    Both tables change in one transaction, so a failed run leaves neither
+    written and history never gets ahead of the current-state table.
+    """
+    column_list = ', '.join(columns)
+    return f"""
+BEGIN TRANSACTION;
+
+INSERT INTO `{table_id}` ({column_list})
+SELECT {column_list} FROM `{records_table_id}`;
+
+DELETE FROM `{current_table_id}`
+WHERE {KEY_COLUMN} IN (SELECT {KEY_COLUMN} FROM `{opened_table_id}`);
+
+INSERT INTO `{current_table_id}` ({column_list})
+SELECT {column_list}
+FROM (
+  SELECT *, ROW_NUMBER() OVER (PARTITION BY {KEY_COLUMN} ORDER BY {SOURCE_ROW_COLUMN}) AS staged_rank
+  FROM `{opened_table_id}`
+)
+WHERE staged_rank = 1;
+
+COMMIT TRANSACTION;
+"""
+
+
+def build_replace_script(table_id, current_table_id, history_table_id, state_table_id, columns):
+    """Replace the contents of the history and current-state tables with two staged tables in one transaction."""
+    column_list = ', '.join(columns)
+    return f"""
+BEGIN TRANSACTION;
+
+DELETE FROM `{table_id}` WHERE TRUE;
+
+INSERT INTO `{table_id}` ({column_list})
+SELECT {column_list} FROM `{history_table_id}`;
+
+DELETE FROM `{current_table_id}` WHERE TRUE;
+
+INSERT INTO `{current_table_id}` ({column_list})
+SELECT {column_list} FROM `{state_table_id}`;
+
+COMMIT TRANSACTION;
+"""
+
+
+def replace_tables(client, history_df, current_df, dataset_name, table_name, current_table_name, schema=None):
+    """Stage a rewritten history and current state, then swap both tables' contents in one script; returns its job.
+
+    The tables keep their partitioning, clustering and labels, and a failed
+    run leaves both as they were.
+    """
+    table_id = f"{PROJECT_ID}.{dataset_name}.{table_name}"
+    current_table_id = f"{PROJECT_ID}.{dataset_name}.{current_table_name}"
+    columns = [field.name for field in get_table_schema(schema or get_roster_schema())]
+    staged = []
+    try:
+        staged.append(stage_dataframe(client, history_df, dataset_name, table_name, schema))
+        staged.append(stage_dataframe(client, current_df, dataset_name, current_table_name, schema))
+        script = build_replace_script(table_id, current_table_id, staged[0], staged[1], columns)
+        with span('replace_script', rows_in=len(history_df) + len(current_df), table=table_name) as stage:
+            job = client.query(script)
+            job.result()
+            stage.update(job_stats(job))
+        logging.info(f"Replaced {table_id} with {len(history_df)} rows and {current_table_id} with {len(current_df)} rows.")
+        return job
+    finally:
+        for staging_table_id in staged:
+            client.delete_table(staging_table_id, not_found_ok=True)
+
+
+def append_and_refresh(client, records_df, opened_df, dataset_name, table_name, current_table_name, schema=None):
+    """Stage records and opened rows, then append and refresh the current state in one script; returns its job."""
+    table_id = f"{PROJECT_ID}.{dataset_name}.{table_name}"
+    current_table_id = f"{PROJECT_ID}.{dataset_name}.{current_table_name}"
+    columns = [field.name for field in get_table_schema(schema or get_roster_schema())]
+    staged = [stage_dataframe(client, records_df, dataset_name, table_name, schema)]
+    try:
+        # Every record is opened when a first load appends the new rows themselves
+        if opened_df is not records_df:
+            staged.append(stage_dataframe(client, opened_df, dataset_name, current_table_name, schema))
+        script = build_append_script(table_id, current_table_id, staged[0], staged[-1], columns)
+        with span('append_script', rows_in=len(records_df), table=table_name) as stage:
+            job = client.query(script)
+            job.result()
+            stage.update(job_stats(job), rows_out=len(records_df))
+        logging.info(f"Appended {len(records_df)} records to {table_id} and refreshed "
+                     f"{opened_df[KEY_COLUMN].nunique()} employees in {current_table_id}.")
+        return job
+    finally:
+        for staging_table_id in staged:
+            client.delete_table(staging_table_id, not_found_ok=True)
+
+
+def stage_dataframe(client, df, dataset_name, table_name, schema=None):
+    """Load the parsed roster into a short-lived staging table next to the target."""
+    schema = schema or get_roster_schema()
+    staging_table_id = f"{PROJECT_ID}.{dataset_name}.{table_name}_staging_{uuid.uuid4().hex[:12]}"
+    staged = df.reset_index(drop=True)
+    staged[ROW_HASH_COLUMN] = compute_row_hash(staged, schema.compared_types)
+    staged[SOURCE_ROW_COLUMN] = staged.index.astype('int64')
+
+    fields = [field for field in get_table_schema(schema) if field.name in staged.columns]
+    fields.append(bigquery.SchemaField(SOURCE_ROW_COLUMN, "INT64"))
+    table = bigquery.Table(staging_table_id, schema=fields)
+    table.expires = datetime.now(timezone.utc) + STAGING_TABLE_TTL
+    client.create_table(table)
+
+    job_config = bigquery.LoadJobConfig(schema=fields, write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
+    with span('staging_load', rows_in=len(staged), table=table_name) as stage:
+        job = client.load_table_from_dataframe(staged[[field.name for field in fields]], staging_table_id, job_config=job_config)
+        job.result()
+        stage.update(job_stats(job))
+    logging.info(f"Staged {len(staged)} rows in {staging_table_id}.")
+    return staging_table_id
+
+
+def merge_upsert_to_bigquery(client, new_df, dataset_name, table_name, current_table_name, run_date=None, schema=None):
+    """Apply the SCD2 close-and-open logic inside the warehouse, without reading history."""
+    run_date = run_date or datetime.now().date()
+    schema = schema or get_roster_schema()
+    table_id = f"{PROJECT_ID}.{dataset_name}.{table_name}"
+    current_table_id = f"{PROJECT_ID}.{dataset_name}.{current_table_name}"
+    columns = [field.name for field in get_table_schema(schema)]
+    comparison_columns = list(schema.compared_types)
+
+    try:
+        new_df = new_df.dropna(subset=[KEY_COLUMN])
+        missing_columns = [col for col in columns if col not in new_df.columns and col != ROW_HASH_COLUMN]
+        if missing_columns:
+            error_message = f"Columns missing from new_df: {', '.join(missing_columns)}"
+            logging.error(error_message)
+            return {"success": False, "error": error_message}
+
+        staging_table_id = stage_dataframe(client, new_df, dataset_name, table_name, schema)
+        try:
+            script = build_scd2_merge_script(table_id, current_table_id, staging_table_id, columns, comparison_columns)
+            job_config = bigquery.QueryJobConfig(
+                query_parameters=[bigquery.ScalarQueryParameter("run_date", "DATE", run_date)]
+            )
+            with span('merge_script', rows_in=len(new_df), table=table_name) as stage:
+                job = client.query(script, job_config=job_config)
+                rows = job.result().to_dataframe()
+                inserted = len(rows)
+                stage.update(job_stats(job), rows_out=inserted)
+        finally:
+            client.delete_table(staging_table_id, not_found_ok=True)
+
+        logging.info(f"Merged {len(new_df)} staged rows into {table_id}; inserted {inserted} records.")
+        changes = change_set(changes_to_diff(rows, schema.names, schema), schema.names, run_date)
+        return {"success": True, "message": f"Inserted {inserted} records into BigQuery.", "inserted_rows": inserted,
+                "changes": changes}
+
+    except Exception as e:
+        error_message = f"Error in merge upsert: {str(e)}"
+        logging.error(error_message)
+        return {"success": False, "error": error_message}
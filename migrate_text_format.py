@@ -0,0 +1,73 @@
+"""Rewrite whole numbers the first reader stored as floats, once per table.
+
+pd.read_excel read a text column holding a blank cell as floats, so ids,
+phone numbers and codes loaded before the streaming reader were stored as
+'3001234567.0', where uploads now carry '3001234567'. Diffing one against the
+other would close and reopen every such employee, so uploads refuse a table
+until it is labelled as migrated. Run this once per deployment, before
+uploads are processed:
+
+    python migrate_text_format.py                              # every registered pipeline
+    python migrate_text_format.py --pipeline alo_roster --lease-bucket my-uploads
+
+Each pipeline's history and current-state tables are rewritten with one
+UPDATE each, their row hashes recomputed, and both labelled. The pipeline's
+upload lease is held meanwhile, so uploads arriving wait in its queue and are
+upserted afterwards. Tables already labelled, and tables the pipeline created
+itself, are left alone.
+"""
+import argparse
+import logging
+
+from bigquery_upsert import ensure_row_hash_column, ensure_text_format
+from gcp_clients import get_bigquery_client, table_exists
+from pipelines import load_pipelines
+
+
+def migrate_pipeline(pipeline, leases, lease_bucket=None):
+    """Migrate one pipeline's tables under its lease; returns the names of the tables rewritten."""
+    from table_lease import held_lease, lease_name
+
+    client = get_bigquery_client()
+    rewritten = []
+    with held_lease(leases, lease_name(pipeline)):
+        for table_name in (pipeline.table_name, pipeline.current_table_name):
+            if not table_exists(client, pipeline.dataset_name, table_name):
+                continue
+            if table_name == pipeline.table_name:
+                ensure_row_hash_column(client, pipeline.dataset_name, table_name, pipeline.schema)
+            if ensure_text_format(client, pipeline.dataset_name, table_name, pipeline.schema):
+                rewritten.append(table_name)
+    if leases is not None:
+        from main import process_queued
+
+        process_queued(lease_name(pipeline), leases, lease_bucket)
+    return rewritten
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pipeline', action='append', help='migrate this registered pipeline (repeatable) instead of all')
+    parser.add_argument('--lease-bucket', help='bucket holding the table leases, when LEASE_BUCKET is not set')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+
+    from table_lease import get_leases
+
+    registered = {pipeline.name: pipeline for pipeline in load_pipelines()}
+    unknown = [name for name in args.pipeline or [] if name not in registered]
+    if unknown:
+        parser.error(f"unknown pipeline(s): {', '.join(unknown)}")
+    try:
+        leases = get_leases(args.lease_bucket)
+    except ValueError as e:
+        parser.error(f"{e} Pass --lease-bucket with the bucket uploads land in.")
+
+    for name in args.pipeline or registered:
+        pipeline = registered[name]
+        rewritten = migrate_pipeline(pipeline, leases, args.lease_bucket)
+        logging.info(f"Pipeline {name}: " + (f"rewrote {', '.join(rewritten)}." if rewritten else "already migrated."))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Registry of the roster pipelines served by one deployment.
+
+pipelines.yaml (or the file named by PIPELINES_PATH) maps uploaded object
+names to the sheets to read, the reference schema describing them and the
+tables they are upserted into, so a new client roster is a registry entry
+rather than another deployment with its own cold starts. Every pipeline keeps
+the SCD2 layout of the original roster: its schema must key on emp_id and
+carry the start_date/end_date validity dates.
+"""
+import fnmatch
+import functools
+import logging
+import os
+from typing import NamedTuple
+
+import yaml
+
+from excel_to_pandas import get_roster_schema, get_schema_version
+from scd2_diff import KEY_COLUMN, SCD_DATE_COLUMNS
+from config import DATASET_NAME, TABLE_NAME, CURRENT_TABLE_NAME, PIPELINES_PATH
+
+
+class Pipeline(NamedTuple):
+    """One roster: the uploads it reads and the tables it maintains."""
+    name: str
+    file_pattern: str
+    sheets: tuple
+    column_count: int
+    schema_path: str
+    dataset_name: str
+    table_name: str
+    current_table_name: str
+    trigger_scheduled_query: bool
+
+    @property
+    def schema(self):
+        """Compiled reference schema of the pipeline's sheets."""
+        return get_roster_schema(self.schema_path)
+
+
+def _pipeline(name, entry, base_dir):
+    table_name = entry.get('table', TABLE_NAME)
+    default_current_table = CURRENT_TABLE_NAME if table_name == TABLE_NAME else f"{table_name}_current"
+    return Pipeline(
+        name=name,
+        file_pattern=entry.get('file_pattern', '*'),
+        sheets=tuple(entry['sheets']),
+        column_count=int(entry['columns']),
+        schema_path=os.path.join(base_dir, entry['schema']),
+        dataset_name=entry.get('dataset', DATASET_NAME),
+        table_name=table_name,
+        current_table_name=entry.get('current_table', default_current_table),
+        trigger_scheduled_query=bool(entry.get('trigger_scheduled_query', False)),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def load_pipelines(path=PIPELINES_PATH):
+    """Parse and validate the registry once per instance."""
+    with open(path) as file:
+        entries = yaml.safe_load(file)['pipelines']
+    pipelines = tuple(_pipeline(name, entry, os.path.dirname(path)) for name, entry in entries.items())
+    if not pipelines:
+        raise ValueError(f"No pipelines are defined in {path}.")
+
+    # Concurrent pipelines must never write to the same table
+    tables = [(p.dataset_name, table) for p in pipelines for table in (p.table_name, p.current_table_name)]
+    if len(set(tables)) != len(tables):
+        raise ValueError(f"Pipelines in {path} must write to distinct tables.")
+    for pipeline in pipelines:
+        schema = pipeline.schema
+        if schema.key != KEY_COLUMN or schema.scd_date_columns != SCD_DATE_COLUMNS:
+            raise ValueError(f"Schema of pipeline '{pipeline.name}' must key on {KEY_COLUMN} and define {SCD_DATE_COLUMNS}.")
+    logging.info(f"Loaded {len(pipelines)} pipelines from {path}.")
+    return pipelines
+
+
+def default_pipeline():
+    """The first registered pipeline; the one process_roster runs when given none."""
+    return load_pipelines()[0]
+
+
+def match_pipelines(file_name):
+    """Pipelines whose file_pattern matches an uploaded object name."""
+    return [pipeline for pipeline in load_pipelines() if fnmatch.fnmatch(file_name, pipeline.file_pattern)]
+
+
+def pipelines_version(pipelines):
+    """Ledger version of an upload's pipelines; changes whenever one of their schemas does."""
+    return '+'.join(get_schema_version(pipeline.schema_path) for pipeline in pipelines)
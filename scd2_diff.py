@@ -0,0 +1,212 @@
+import pandas as pd
+import numpy as np
+import hashlib
+import json
+from typing import NamedTuple
+
+KEY_COLUMN = 'emp_id'
+SCD_DATE_COLUMNS = ['start_date', 'end_date']
+ROW_HASH_COLUMN = 'row_hash'
+
+# Canonical text form shared by compute_row_hash and row_hash_sql
+HASH_SEPARATOR = '\x1f'
+HASH_NULL_TOKEN = '\\N'
+
+
+class Scd2Diff(NamedTuple):
+    """Record frames produced by a single SCD2 diff.
+
+    Every frame is indexed by the first-appearance rank of its emp_id in the
+    new data, which is the order the rows are written in.
+    """
+    closed: pd.DataFrame
+    opened: pd.DataFrame
+    new_hires: pd.DataFrame
+
+
+_type_of = np.frompyfunc(type, 1, 1)
+
+
+def _object_values(series: pd.Series) -> np.ndarray:
+    """Values as an object array; missing values of extension dtypes (string, date32)
+    become None, since pd.NA cannot take part in an elementwise ==."""
+    if isinstance(series.dtype, pd.api.extensions.ExtensionDtype):
+        return series.to_numpy(dtype=object, na_value=None)
+    return series.to_numpy(dtype=object)
+
+
+def _changed(old: pd.Series, new: pd.Series) -> np.ndarray:
+    """Flag positions where str(old) != str(new), as the former row-wise check did.
+
+    Values that compare equal and share a type are taken as unchanged, so str()
+    only runs on the (few) remaining candidates. Categorical columns holding the
+    same categories (see CompiledSchema.share_categories) compare by code.
+    """
+    if (isinstance(old.dtype, pd.CategoricalDtype) and isinstance(new.dtype, pd.CategoricalDtype)
+            and old.cat.categories.equals(new.cat.categories)):
+        return old.cat.codes.to_numpy() != new.cat.codes.to_numpy()
+    old_values = _object_values(old)
+    new_values = _object_values(new)
+    same = old_values == new_values
+    if same.dtype != bool:  # pd.NA makes the elementwise comparison ambiguous
+        return old_values.astype(str) != new_values.astype(str)
+    same &= _type_of(old_values) == _type_of(new_values)
+    candidates = np.flatnonzero(~same)
+    changed = np.zeros(len(old_values), dtype=bool)
+    changed[candidates] = old_values[candidates].astype(str) != new_values[candidates].astype(str)
+    return changed
+
+
+def _stamp_dates(df: pd.DataFrame, run_date, columns) -> pd.DataFrame:
+    for col in columns:
+        df[col] = pd.Series(run_date, index=df.index, dtype=df[col].dtype)  # Keeps e.g. date32 columns typed
+    return df
+
+
+def diff_scd2(existing_df: pd.DataFrame, new_df: pd.DataFrame, columns_to_check: list, run_date) -> Scd2Diff:
+    """Compare the current snapshot with new data in one keyed, columnar pass.
+
+    For an emp_id present on both sides, the first existing row is compared with
+    the first new row on every column except the key and SCD dates. When they
+    differ, the last existing row is closed (end_date = run_date) and the new row
+    is opened (start_date = end_date = run_date). Every row whose emp_id does not
+    exist yet is opened as a new hire.
+    """
+    comparison_columns = [col for col in columns_to_check if col != KEY_COLUMN and col not in SCD_DATE_COLUMNS]
+
+    new_first = new_df.drop_duplicates(subset=[KEY_COLUMN], keep='first')
+    new_keys = pd.Index(new_first[KEY_COLUMN])
+    existing_first = existing_df.drop_duplicates(subset=[KEY_COLUMN], keep='first')
+    existing_last = existing_df.drop_duplicates(subset=[KEY_COLUMN], keep='last')
+
+    # Keyed join on emp_id: position of each new emp_id in the existing snapshot
+    existing_pos = pd.Index(existing_first[KEY_COLUMN]).get_indexer(new_keys)
+    matched = existing_pos >= 0
+    new_matched = new_first[matched]
+    old_matched = existing_first.iloc[existing_pos[matched]]
+
+    changed = np.zeros(len(new_matched), dtype=bool)
+    for col in comparison_columns:
+        changed |= _changed(old_matched[col], new_matched[col])
+
+    changed_keys = new_matched[KEY_COLUMN][changed]
+    changed_rank = new_keys.get_indexer(changed_keys)
+
+    closed = existing_last.iloc[pd.Index(existing_last[KEY_COLUMN]).get_indexer(changed_keys)]
+    closed = _stamp_dates(closed[columns_to_check].copy(), run_date, ['end_date'])
+    closed.index = changed_rank
+
+    opened = new_matched[changed][columns_to_check].copy()
+    opened = _stamp_dates(opened, run_date, SCD_DATE_COLUMNS)
+    opened.index = changed_rank
+
+    is_new_hire = ~new_df[KEY_COLUMN].isin(existing_df[KEY_COLUMN])
+    new_hires = new_df[is_new_hire][columns_to_check].copy()
+    new_hires = _stamp_dates(new_hires, run_date, SCD_DATE_COLUMNS)
+    new_hires.index = new_keys.get_indexer(new_hires[KEY_COLUMN])
+
+    return Scd2Diff(closed=closed, opened=opened, new_hires=new_hires)
+
+
+def records_to_insert(diff: Scd2Diff) -> pd.DataFrame:
+    """Concatenate a diff into the rows to append, closed record before opened one per emp_id."""
+    frames = [frame for frame in diff if not frame.empty]
+    if not frames:
+        return pd.DataFrame(columns=diff.opened.columns)
+    records = pd.concat(frames)
+    records = records.sort_index(kind='stable')
+    return records.reset_index(drop=True)
+
+
+def change_set(diff: Scd2Diff, columns_to_check: list, run_date) -> pd.DataFrame:
+    """One audit row per record the diff opens: emp_id, change type and what changed.
+
+    For a 'changed' emp_id, changed_columns lists the compared columns that
+    differ between the closed and the opened version, and old_values/new_values
+    hold those columns as JSON objects. A 'new_hire' has no old values; its
+    new_values carry the whole record. Rows follow the write order.
+    """
+    comparison_columns = [col for col in columns_to_check if col != KEY_COLUMN and col not in SCD_DATE_COLUMNS]
+    old, new = diff.closed, diff.opened  # Aligned on the emp_id rank
+
+    masks = [_changed(old[col], new[col]) for col in comparison_columns]
+    changed_columns = [[col for col, flag in zip(comparison_columns, flags) if flag] for flags in zip(*masks)]
+    old_values = {col: _object_values(old[col]) for col in comparison_columns}
+    new_values = {col: _object_values(new[col]) for col in comparison_columns}
+    changed = pd.DataFrame({
+        'emp_id': new[KEY_COLUMN].to_numpy(dtype=object),
+        'change_type': 'changed',
+        'changed_columns': changed_columns,
+        'old_values': [json.dumps({col: old_values[col][i] for col in cols}, default=str)
+                       for i, cols in enumerate(changed_columns)],
+        'new_values': [json.dumps({col: new_values[col][i] for col in cols}, default=str)
+                       for i, cols in enumerate(changed_columns)],
+    }, index=new.index)
+
+    hire_values = [_object_values(diff.new_hires[col]) for col in comparison_columns]
+    new_hires = pd.DataFrame({
+        'emp_id': diff.new_hires[KEY_COLUMN].to_numpy(dtype=object),
+        'change_type': 'new_hire',
+        'changed_columns': [[] for _ in range(len(diff.new_hires))],
+        'old_values': None,
+        'new_values': [json.dumps(dict(zip(comparison_columns, row)), default=str) for row in zip(*hire_values)],
+    }, index=diff.new_hires.index)
+
+    changes = pd.concat([changed, new_hires]).sort_index(kind='stable').reset_index(drop=True)
+    changes.insert(0, 'run_date', pd.Series(run_date, index=changes.index, dtype=diff.opened['start_date'].dtype))
+    return changes
+
+
+def _canonical_text(series: pd.Series, field_type: str) -> pd.Series:
+    """Render a column as text the same way row_hash_sql does in BigQuery."""
+    if field_type == 'DATE':
+        text = pd.to_datetime(series, errors='coerce').dt.strftime('%Y-%m-%d')
+    elif field_type in ('INT64', 'INTEGER'):
+        text = pd.to_numeric(series, errors='coerce').round().astype('Int64').astype('string')
+    else:
+        text = series.astype('string')
+    return text.fillna(HASH_NULL_TOKEN).astype(object)
+
+
+def compute_row_hash(df: pd.DataFrame, column_types: dict) -> pd.Series:
+    """Compute a stable MD5 fingerprint of the given columns for every row.
+
+    column_types maps column name to BigQuery type; the result matches
+    row_hash_sql(column_types) evaluated on the same rows in BigQuery.
+    """
+    if df.empty:
+        return pd.Series([], index=df.index, dtype=object)
+    columns = list(column_types)
+    joined = _canonical_text(df[columns[0]], column_types[columns[0]])
+    joined = joined.str.cat([_canonical_text(df[col], column_types[col]) for col in columns[1:]], sep=HASH_SEPARATOR)
+    return pd.Series([hashlib.md5(text.encode('utf-8')).hexdigest() for text in joined], index=df.index, dtype=object)
+
+
+def row_hash_sql(column_types: dict) -> str:
+    """BigQuery expression computing the same fingerprint as compute_row_hash."""
+    parts = []
+    for col, field_type in column_types.items():
+        if field_type == 'DATE':
+            text = f"FORMAT_DATE('%Y-%m-%d', {col})"
+        elif field_type == 'STRING':
+            text = col
+        else:
+            text = f"CAST({col} AS STRING)"
+        parts.append(f"IFNULL({text}, '\\\\N')")
+    return f"TO_HEX(MD5(ARRAY_TO_STRING([{', '.join(parts)}], '\\x1f')))"
+
+
+def split_by_fingerprint(new_df: pd.DataFrame, fingerprints: pd.DataFrame):
+    """Split the emp_ids of new_df by comparing their row hashes with the current ones.
+
+    Returns (changed_ids, new_ids): emp_ids whose current fingerprint differs from
+    the new data, and emp_ids that have no current version at all.
+    """
+    current = fingerprints.drop_duplicates(subset=[KEY_COLUMN]).set_index(KEY_COLUMN)[ROW_HASH_COLUMN]
+    new_first = new_df.drop_duplicates(subset=[KEY_COLUMN], keep='first')
+    current_hash = current.reindex(new_first[KEY_COLUMN]).to_numpy()
+    is_known = new_first[KEY_COLUMN].isin(current.index).to_numpy()
+    is_changed = is_known & (current_hash != new_first[ROW_HASH_COLUMN].to_numpy())
+    changed_ids = new_first.loc[is_changed, KEY_COLUMN].tolist()
+    new_ids = new_first.loc[~is_known, KEY_COLUMN].tolist()
+    return changed_ids, new_ids
@@ -0,0 +1,135 @@
+"""Coalesced, non-blocking trigger of the downstream scheduled query.
+
+Every successful upload used to start a manual run of the transfer config, so
+several exports landing within minutes re-ran the same query once per file.
+Requests are now grouped into fixed windows of TRIGGER_WINDOW_SECONDS. The
+first request in a window claims it, in this instance's memory and in the
+idempotency ledger (an atomic create, so concurrent instances agree), and
+defers one run until the window has closed: a background thread waits for the
+window's end and then starts a manual run for that time, which is in the past
+by then, as the API requires. Later requests in the same window find the claim
+and do nothing; their rows are loaded before the window's run starts. The
+deferred call skips the run when one is still PENDING, as that run has not
+read the table yet, and retries up to TRIGGER_ATTEMPTS times.
+
+wait_for_runs keeps the claiming invocation alive until its window's run has
+been requested, plus at most TRIGGER_WAIT_SECONDS for the API call.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from gcp_clients import get_transfer_client
+from config import TRANSFER_PROJECT_ID, TRANSFER_CONFIG_ID, TRIGGER_WINDOW_SECONDS, TRIGGER_WAIT_SECONDS
+
+# Seconds after a window closes before its run is requested, so the run time is safely in the past
+RUN_DELAY_SECONDS = 2
+TRIGGER_ATTEMPTS = 3
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='scheduled-query')
+_pending = {}  # Future -> epoch seconds by which its API call should be done
+_claimed_windows = set()
+_lock = threading.Lock()
+_sleep = time.sleep
+
+
+def run_window(now, window=TRIGGER_WINDOW_SECONDS):
+    """(start, end) of the window holding now, in epoch seconds; the end is the window's run time."""
+    start = int(now // window) * window if window > 0 else int(now)
+    return start, start + max(window, 0)
+
+
+def _claim(window_start, ledger):
+    """Return True when this request is the first of its window."""
+    with _lock:
+        if window_start in _claimed_windows:
+            return False
+        _claimed_windows.add(window_start)
+    if ledger is None:
+        return True
+    key = f"scheduled_query:{TRANSFER_PROJECT_ID}/{TRANSFER_CONFIG_ID}:{window_start}"
+    try:
+        return ledger.add(key, {'window_start': window_start})
+    except Exception as e:
+        logging.warning(f"Could not claim scheduled query window in the ledger, triggering anyway: {e}")
+        return True
+
+
+def _pending_run(client, parent):
+    """Name of a run of the config that has not started yet, or None."""
+    from google.cloud import bigquery_datatransfer_v1
+
+    runs = client.list_transfer_runs(request={
+        'parent': parent,
+        'states': [bigquery_datatransfer_v1.TransferState.PENDING],
+        'page_size': 1,
+    })
+    run = next(iter(runs), None)
+    return run.name if run is not None else None
+
+
+def _start_run(run_time):
+    """Start one manual run for run_time once it has passed; None when a pending run covers it."""
+    from google.protobuf.timestamp_pb2 import Timestamp
+
+    _sleep(max(0.0, run_time + RUN_DELAY_SECONDS - time.time()))
+    client = get_transfer_client()
+    parent = client.transfer_config_path(TRANSFER_PROJECT_ID, TRANSFER_CONFIG_ID)
+    for attempt in range(1, TRIGGER_ATTEMPTS + 1):
+        try:
+            pending = _pending_run(client, parent)
+            if pending is not None:
+                logging.info(f"Scheduled query run {pending} has not started yet; it will read the new rows.")
+                return None
+            response = client.start_manual_transfer_runs(request={
+                'parent': parent,
+                'requested_run_time': Timestamp(seconds=int(run_time)),
+            })
+            logging.info(f"Scheduled query {TRANSFER_CONFIG_ID} triggered for "
+                         f"{time.strftime('%H:%M:%S', time.gmtime(run_time))} UTC.")
+            return response
+        except Exception as e:
+            if attempt == TRIGGER_ATTEMPTS:
+                raise
+            logging.warning(f"Triggering the scheduled query failed (attempt {attempt}), retrying: {e}")
+            _sleep(attempt)
+
+
+def request_run(ledger=None, now=None):
+    """Ask for the run of the current window; returns the deferred API call, or None when coalesced."""
+    if not TRANSFER_CONFIG_ID:
+        logging.info("TRANSFER_CONFIG_ID is not set; not triggering the scheduled query.")
+        return None
+    window_start, run_time = run_window(now or time.time())
+    if not _claim(window_start, ledger):
+        logging.info(f"Scheduled query run for the window starting at {window_start} was already requested.")
+        return None
+    future = _executor.submit(_start_run, run_time)
+    with _lock:
+        _pending[future] = run_time + RUN_DELAY_SECONDS + TRIGGER_WAIT_SECONDS
+    return future
+
+
+def wait_for_runs(timeout=None):
+    """Wait for deferred trigger calls before the invocation ends; returns how many failed or timed out.
+
+    Each call is given until TRIGGER_WAIT_SECONDS after its window's run time,
+    or timeout seconds from now when given.
+    """
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+    if not pending:
+        return 0
+    if timeout is None:
+        timeout = max(0.0, max(pending.values()) - time.time())
+    done, not_done = wait(pending, timeout=timeout)
+    failed = 0
+    for future in done:
+        if future.exception() is not None:
+            failed += 1
+            logging.error(f"Failed to trigger the scheduled query: {future.exception()}")
+    if not_done:
+        logging.warning(f"{len(not_done)} scheduled query triggers still waiting after {timeout:.0f}s; not waiting for them.")
+    return failed + len(not_done)
@@ -1,47 +1,200 @@
-import yaml
-import pandas as pd
-import logging
-
-# Set up logging
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
-
-def load_schema(file_path: str) -> dict:
-    """Loads schema from a YAML file."""
-    try:
-        with open(file_path, 'r') as file:
-            schema = yaml.safe_load(file)
-        return schema['schema']
-    except FileNotFoundError:
-        logging.error(f"File not found: {file_path}")
-        raise  # Reraise the exception to inform the caller
-    except yaml.YAMLError as e:
-        logging.error(f"Error reading YAML file: {e}")
-        raise  # Reraise the exception to inform the caller
-    except KeyError:
-        logging.error("YAML file does not contain a 'schema' key.")
-        raise  # Reraise the exception to inform the caller
-
-def sync_columns(df: pd.DataFrame, reference_schema: dict) -> pd.DataFrame:
-    """Synchronizes DataFrame columns to match a reference schema."""
-    if df.empty:
-        logging.warning("The input DataFrame is empty. No columns to sync.")
-        return df  # Return the empty DataFrame
-
-    if not isinstance(reference_schema, dict):
-        logging.error("Reference schema should be a dictionary.")
-        raise ValueError("Reference schema should be a dictionary.")
-
-    # Generate column mappings and identify mismatches
-    df_columns = {i: col for i, col in enumerate(df.columns)}
-    mismatched_columns = {}
-
-    # Compare columns with the reference schema
-    for idx, ref_col in reference_schema.items():
-        if df_columns.get(idx) != ref_col:
-            mismatched_columns[df_columns.get(idx, 'MISSING')] = ref_col
-            logging.info(f"Column mismatch at index {idx}: Found '{df_columns.get(idx)}', expected '{ref_col}'")
-
-    # Apply corrections to DataFrame columns
-    new_columns = [mismatched_columns.get(col, col) for col in df.columns]
-    df.columns = new_columns
-    return df
+import yaml
+import hashlib
+import functools
+import pandas as pd
+import pyarrow as pa
+import logging
+from typing import NamedTuple
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+
+def load_schema(file_path: str) -> dict:
+    """Loads schema from a YAML file."""
+    try:
+        with open(file_path, 'r') as file:
+            schema = yaml.safe_load(file)
+        return schema['schema']
+    except FileNotFoundError:
+        logging.error(f"File not found: {file_path}")
+        raise  # Reraise the exception to inform the caller
+    except yaml.YAMLError as e:
+        logging.error(f"Error reading YAML file: {e}")
+        raise  # Reraise the exception to inform the caller
+    except KeyError:
+        logging.error("YAML file does not contain a 'schema' key.")
+        raise  # Reraise the exception to inform the caller
+
+def schema_version(file_path: str) -> str:
+    """Short fingerprint of a schema file, changing whenever the schema does."""
+    with open(file_path, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()[:12]
+
+class ColumnSpec(NamedTuple):
+    """One column of the reference schema."""
+    position: int
+    name: str
+    field_type: str  # BigQuery type
+    role: str        # 'key', 'compared' or 'scd_date'
+    text: bool       # Cells rendered as text, blanks becoming ''
+    categorical: bool = False  # Held as a pandas categorical (few distinct values)
+
+# pandas dtype each BigQuery type is held in once a frame is conformed
+DATE_DTYPE = pd.ArrowDtype(pa.date32())
+ROLES = ('key', 'compared', 'scd_date')
+TYPES = ('STRING', 'INT64', 'DATE')
+
+class CompiledSchema(NamedTuple):
+    """Conversion plan compiled once from reference_schema.yaml."""
+    columns: tuple
+
+    @property
+    def names(self) -> list:
+        return [col.name for col in self.columns]
+
+    @property
+    def positions(self) -> dict:
+        """Column name by sheet position, as sync_columns expects."""
+        return {col.position: col.name for col in self.columns}
+
+    @property
+    def key(self) -> str:
+        return next(col.name for col in self.columns if col.role == 'key')
+
+    @property
+    def scd_date_columns(self) -> list:
+        return [col.name for col in self.columns if col.role == 'scd_date']
+
+    @property
+    def field_types(self) -> dict:
+        return {col.name: col.field_type for col in self.columns}
+
+    @property
+    def compared_types(self) -> dict:
+        """BigQuery type of every column that takes part in change detection."""
+        return {col.name: col.field_type for col in self.columns if col.role == 'compared'}
+
+    @property
+    def text_columns(self) -> list:
+        return [col.name for col in self.columns if col.text]
+
+    @property
+    def categorical_columns(self) -> list:
+        return [col.name for col in self.columns if col.categorical]
+
+    @property
+    def date_columns(self) -> list:
+        return [col.name for col in self.columns if col.field_type == 'DATE']
+
+    @property
+    def int_columns(self) -> list:
+        return [col.name for col in self.columns if col.field_type == 'INT64']
+
+    def dtypes(self) -> dict:
+        """pandas dtype of every column after conform()."""
+        dtypes = {}
+        for col in self.columns:
+            if col.field_type == 'DATE':
+                dtypes[col.name] = DATE_DTYPE
+            elif col.field_type == 'INT64':
+                dtypes[col.name] = 'int64'
+            elif col.categorical:
+                dtypes[col.name] = 'category'
+            else:
+                dtypes[col.name] = 'string' if col.text else object
+        return dtypes
+
+    def conform(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Give a frame read from anywhere (sheet, warehouse, Parquet) the schema's dtypes.
+
+        Columns already held in the right dtype are left untouched, so conforming
+        a frame twice costs nothing.
+        """
+        for name, dtype in self.dtypes().items():
+            if name not in df.columns or df[name].dtype == dtype:
+                continue
+            if dtype is DATE_DTYPE:
+                df[name] = pd.to_datetime(df[name], errors='coerce').astype(DATE_DTYPE)
+            elif dtype == 'int64':
+                df[name] = pd.to_numeric(df[name], errors='coerce').fillna(0).astype('int64')
+            elif dtype == 'string':
+                df[name] = df[name].astype('string')
+            elif dtype == 'category':
+                df[name] = df[name].astype(object).astype('category')  # Categories as plain str, whatever the source
+            else:
+                values = df[name].astype(object)
+                df[name] = values.where(values.notna(), None)
+        return df
+
+    def share_categories(self, *frames: pd.DataFrame) -> None:
+        """Give the categorical columns of several conformed frames the same categories, in place.
+
+        Codes then mean the same value in every frame, so comparing two columns
+        compares integers, and concatenating them keeps the categorical dtype.
+        """
+        for name in self.categorical_columns:
+            columns = [df[name] for df in frames if name in df.columns and isinstance(df[name].dtype, pd.CategoricalDtype)]
+            if len(columns) < 2:
+                continue
+            categories = functools.reduce(lambda left, right: left.union(right), (col.cat.categories for col in columns))
+            for df in frames:
+                if name in df.columns and isinstance(df[name].dtype, pd.CategoricalDtype):
+                    df[name] = df[name].cat.set_categories(categories)
+
+def compile_schema(reference_schema: dict) -> CompiledSchema:
+    """Compile the parsed reference schema into a CompiledSchema.
+
+    Every entry is a mapping with name, type, role, text and categorical. A
+    schema in the original format, bare column names only, is rejected with
+    instructions to upgrade it: its columns carry no types or key.
+    """
+    bare = [position for position, entry in reference_schema.items() if isinstance(entry, str)]
+    if bare:
+        raise ValueError(
+            f"The reference schema lists bare column names (positions {', '.join(map(str, sorted(bare)))}), "
+            "the format used before column types and roles. Rewrite each entry as a mapping, e.g. "
+            "0: {name: emp_id, type: STRING, role: key, text: true}; see reference_schema.yaml for every column."
+        )
+    columns = []
+    for position, entry in sorted(reference_schema.items()):
+        spec = ColumnSpec(
+            position=int(position),
+            name=entry['name'],
+            field_type=entry.get('type', 'STRING').upper(),
+            role=entry.get('role', 'compared'),
+            text=bool(entry.get('text', False)),
+            categorical=bool(entry.get('categorical', False)),
+        )
+        if spec.field_type not in TYPES or spec.role not in ROLES:
+            raise ValueError(f"Unsupported type or role for column '{spec.name}': {spec.field_type}, {spec.role}")
+        if spec.categorical and (spec.field_type != 'STRING' or spec.role != 'compared'):
+            raise ValueError(f"Column '{spec.name}' cannot be categorical: only compared STRING columns can.")
+        columns.append(spec)
+    if sum(col.role == 'key' for col in columns) != 1:
+        raise ValueError("The reference schema must mark exactly one column with role: key.")
+    return CompiledSchema(columns=tuple(columns))
+
+def sync_columns(df: pd.DataFrame, reference_schema: dict) -> pd.DataFrame:
+    """Synchronizes DataFrame columns to match a reference schema."""
+    if df.empty:
+        logging.warning("The input DataFrame is empty. No columns to sync.")
+        return df  # Return the empty DataFrame
+
+    if not isinstance(reference_schema, dict):
+        logging.error("Reference schema should be a dictionary.")
+        raise ValueError("Reference schema should be a dictionary.")
+
+    # Generate column mappings and identify mismatches
+    df_columns = {i: col for i, col in enumerate(df.columns)}
+    mismatched_columns = {}
+
+    # Compare columns with the reference schema
+    for idx, ref_col in reference_schema.items():
+        if df_columns.get(idx) != ref_col:
+            mismatched_columns[df_columns.get(idx, 'MISSING')] = ref_col
+            logging.info(f"Column mismatch at index {idx}: Found '{df_columns.get(idx)}', expected '{ref_col}'")
+
+    # Apply corrections to DataFrame columns
+    new_columns = [mismatched_columns.get(col, col) for col in df.columns]
+    df.columns = new_columns
+    return df
@@ -0,0 +1,182 @@
+"""Diff very large rosters on several cores.
+
+diff_scd2 runs on one core. sharded_diff_scd2 splits the existing and new
+frames by a hash of emp_id, so every row of an employee lands in the same
+shard on both sides, and diffs the shards in a pool of worker processes.
+Shards travel as Arrow IPC files in shared memory (/dev/shm where it exists):
+the parent converts each frame to Arrow once and writes every shard as a
+filter of it, and a worker memory-maps its shard, restores the frame's pandas
+dtypes, diffs it and writes its diff back the same way. Only
+file paths and dtypes are pickled. The shard diffs are re-ranked on the new
+data's emp_id order and concatenated: each frame then holds the rows
+diff_scd2 would return, sorted by that rank, so records_to_insert returns the
+same records.
+
+The fingerprint split that runs before the diff on every upload is sharded
+the same way: fingerprint_split hashes the whole new roster and compares it
+with the current fingerprints shard by shard in the workers, so the MD5 loop
+over every row, the slowest step of a mostly unchanged upload, runs on all
+of them. Only the changed and new emp_ids come back.
+
+A pool is started once per instance and worker count from a forkserver with
+this module preloaded, so workers neither inherit the parent's threads nor
+re-import pandas for every diff. DIFF_WORKERS sets the default worker count;
+frames with fewer than DIFF_SHARD_MIN_ROWS rows together are diffed and split
+in process, where the IPC round trip would cost more than it saves.
+"""
+import logging
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import pyarrow as pa
+
+from scd2_diff import KEY_COLUMN, ROW_HASH_COLUMN, Scd2Diff, compute_row_hash, diff_scd2, split_by_fingerprint
+from schema_utils import DATE_DTYPE
+from config import DIFF_WORKERS, DIFF_SHARD_MIN_ROWS
+
+# Shards are written where reading them back is a memory copy, not disk I/O
+SHARD_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+_pools = {}  # Worker count -> pool
+
+
+def get_pool(workers=DIFF_WORKERS):
+    """Process pool of this many workers, shared by every sharded diff of this instance that asks for that size."""
+    if workers not in _pools:
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload([__name__])
+        _pools[workers] = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+    return _pools[workers]
+
+
+def shutdown_pools():
+    """Stop every worker pool; the next sharded diff starts a new one."""
+    while _pools:
+        _pools.popitem()[1].shutdown()
+
+
+def shard_of(keys, shards):
+    """Shard of every emp_id; stable across processes and runs."""
+    return pd.util.hash_pandas_object(keys.astype(str), index=False).to_numpy() % shards
+
+
+def _write_ipc(table, path):
+    with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+
+
+def _read_ipc(path, dtypes):
+    """Frame written by _write_ipc, with the dtypes it had before (e.g. 'string', which Arrow returns as object)."""
+    with pa.memory_map(path) as source:
+        df = pa.ipc.open_file(source).read_all().to_pandas(types_mapper={pa.date32(): DATE_DTYPE}.get)
+    for col, dtype in dtypes.items():
+        if col in df.columns and df[col].dtype != dtype:
+            df[col] = df[col].astype(dtype)
+    return df
+
+
+def _diff_shard(existing_path, new_path, dtypes, columns_to_check, run_date):
+    """Worker: diff one shard and write each frame of its diff next to the inputs; returns their paths.
+
+    dtypes holds the existing and the new frame's dtypes, by frame name.
+    """
+    diff = diff_scd2(_read_ipc(existing_path, dtypes['existing']), _read_ipc(new_path, dtypes['new']),
+                     columns_to_check, run_date)
+    paths = {}
+    for name, df in diff._asdict().items():
+        paths[name] = f"{new_path}.{name}"
+        _write_ipc(pa.Table.from_pandas(df, preserve_index=False), paths[name])
+    return paths
+
+
+def sharded_diff_scd2(existing_df, new_df, columns_to_check, run_date, workers=DIFF_WORKERS):
+    """diff_scd2 over emp_id shards in worker processes; same rows, ordered by emp_id rank."""
+    pool = get_pool(workers)
+    dtypes = {'existing': dict(existing_df.dtypes), 'new': dict(new_df.dtypes)}
+    existing_shards = shard_of(existing_df[KEY_COLUMN], workers)
+    new_shards = shard_of(new_df[KEY_COLUMN], workers)
+    existing_table = pa.Table.from_pandas(existing_df, preserve_index=False)
+    new_table = pa.Table.from_pandas(new_df, preserve_index=False)
+
+    with tempfile.TemporaryDirectory(prefix='roster_diff_', dir=SHARD_DIR) as workdir:
+        futures = []
+        for shard in range(workers):  # Each shard starts as soon as it is written
+            existing_path, new_path = os.path.join(workdir, f"existing_{shard}"), os.path.join(workdir, f"new_{shard}")
+            _write_ipc(existing_table.filter(pa.array(existing_shards == shard)), existing_path)
+            _write_ipc(new_table.filter(pa.array(new_shards == shard)), new_path)
+            futures.append(pool.submit(_diff_shard, existing_path, new_path, dtypes, columns_to_check, run_date))
+        results = [future.result() for future in futures]
+        # Closed rows are existing rows; opened rows and new hires come from the new frame
+        sources = {'closed': 'existing', 'opened': 'new', 'new_hires': 'new'}
+        parts = {name: [_read_ipc(paths[name], dtypes[sources[name]]) for paths in results] for name in Scd2Diff._fields}
+
+    # Shards rank emp_ids within themselves; rank them on the whole new frame again
+    new_keys = pd.Index(new_df[KEY_COLUMN].drop_duplicates())
+    frames = {}
+    for name, shard_frames in parts.items():
+        df = pd.concat(shard_frames, ignore_index=True)
+        df.index = new_keys.get_indexer(df[KEY_COLUMN])
+        frames[name] = df.sort_index(kind='stable')
+    return Scd2Diff(**frames)
+
+
+def diff_rosters(existing_df, new_df, columns_to_check, run_date, workers=DIFF_WORKERS):
+    """diff_scd2, sharded over DIFF_WORKERS processes when the frames are large enough to gain from it."""
+    if workers > 1 and len(existing_df) + len(new_df) >= DIFF_SHARD_MIN_ROWS:
+        try:
+            return sharded_diff_scd2(existing_df, new_df, columns_to_check, run_date, workers)
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            # e.g. a text column holding numbers and strings, which Arrow cannot hold in one column
+            logging.warning(f"Could not shard the diff, diffing in process: {e}")
+    return diff_scd2(existing_df, new_df, columns_to_check, run_date)
+
+
+def _split_shard(new_path, fingerprints_path, dtypes, column_types):
+    """Worker: hash one shard of the new roster and split its emp_ids against the shard's fingerprints."""
+    new_df = _read_ipc(new_path, dtypes)
+    new_df[ROW_HASH_COLUMN] = compute_row_hash(new_df, column_types)
+    return split_by_fingerprint(new_df, _read_ipc(fingerprints_path, {}))
+
+
+def sharded_fingerprint_split(new_df, fingerprints, column_types, workers=DIFF_WORKERS):
+    """split_by_fingerprint with the new rows hashed in worker processes; same emp_ids in the same order."""
+    pool = get_pool(workers)
+    new_df = new_df[[KEY_COLUMN] + [col for col in column_types if col != KEY_COLUMN]]
+    dtypes = dict(new_df.dtypes)
+    new_shards = shard_of(new_df[KEY_COLUMN], workers)
+    fingerprint_shards = shard_of(fingerprints[KEY_COLUMN], workers)
+    new_table = pa.Table.from_pandas(new_df, preserve_index=False)
+    fingerprint_table = pa.Table.from_pandas(fingerprints[[KEY_COLUMN, ROW_HASH_COLUMN]], preserve_index=False)
+
+    with tempfile.TemporaryDirectory(prefix='roster_split_', dir=SHARD_DIR) as workdir:
+        futures = []
+        for shard in range(workers):
+            new_path, fingerprints_path = os.path.join(workdir, f"new_{shard}"), os.path.join(workdir, f"fingerprints_{shard}")
+            _write_ipc(new_table.filter(pa.array(new_shards == shard)), new_path)
+            _write_ipc(fingerprint_table.filter(pa.array(fingerprint_shards == shard)), fingerprints_path)
+            futures.append(pool.submit(_split_shard, new_path, fingerprints_path, dtypes, column_types))
+        results = [future.result() for future in futures]
+
+    # Back in the order of the emp_ids' first rows in new_df
+    new_keys = pd.Index(new_df[KEY_COLUMN].drop_duplicates())
+    changed_ids = [emp_id for changed, _ in results for emp_id in changed]
+    new_ids = [emp_id for _, new in results for emp_id in new]
+    return (new_keys[sorted(new_keys.get_indexer(changed_ids))].tolist(),
+            new_keys[sorted(new_keys.get_indexer(new_ids))].tolist())
+
+
+def fingerprint_split(new_df, fingerprints, column_types, workers=DIFF_WORKERS):
+    """Hash new_df and split its emp_ids against the current fingerprints; returns (changed_ids, new_ids).
+
+    Sharded over DIFF_WORKERS processes when the frames are large enough to
+    gain from it. new_df is not modified.
+    """
+    if workers > 1 and len(new_df) + len(fingerprints) >= DIFF_SHARD_MIN_ROWS:
+        try:
+            return sharded_fingerprint_split(new_df, fingerprints, column_types, workers)
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            logging.warning(f"Could not shard the fingerprint split, hashing in process: {e}")
+    return split_by_fingerprint(new_df.assign(**{ROW_HASH_COLUMN: compute_row_hash(new_df, column_types)}), fingerprints)
@@ -0,0 +1,233 @@
+"""Cached copy of the current-state table, reused across invocations.
+
+Only this pipeline writes tbl_alo_roster_current, so most triggers can diff
+against a snapshot kept from the previous run instead of querying BigQuery.
+The snapshot is held in memory on warm instances, as Parquet under
+SNAPSHOT_CACHE_DIR and, when SNAPSHOT_BUCKET is set, as a Parquet object
+under SNAPSHOT_PREFIX in that bucket.
+
+Every copy records the table's `modified` time and row count it reflects and
+is only used while get_table still reports both, which costs a metadata call
+rather than a query. Any edit made outside the pipeline (DML, a load, a
+console fix) moves `modified`, so the next run re-reads the table. To drop
+the cached copies explicitly, run:
+
+    python snapshot_cache.py --invalidate
+"""
+import io
+import json
+import logging
+import os
+from datetime import datetime
+
+import pandas as pd
+
+from instrumentation import span
+from gcp_clients import get_bigquery_client, get_storage_client
+from excel_to_pandas import get_roster_schema, get_table_schema, read_to_dataframe
+from scd2_diff import KEY_COLUMN, ROW_HASH_COLUMN, compute_row_hash
+from config import PROJECT_ID, DATASET_NAME, CURRENT_TABLE_NAME, SNAPSHOT_CACHE_DIR, SNAPSHOT_BUCKET, SNAPSHOT_PREFIX
+
+# Parquet schema metadata key holding the table state a snapshot reflects
+STATE_KEY = b'roster_snapshot_state'
+
+# Snapshots validated during this instance's lifetime, by table id
+_snapshots = {}
+
+
+def _table_id(dataset_name, table_name):
+    return f"{PROJECT_ID}.{dataset_name}.{table_name}"
+
+
+def table_state(client, dataset_name, table_name):
+    """The (modified, num_rows) pair a snapshot of the table must match."""
+    table = client.get_table(_table_id(dataset_name, table_name))
+    return {'modified': table.modified.isoformat(), 'num_rows': int(table.num_rows)}
+
+
+def normalize_snapshot(df, schema=None):
+    """Give snapshot columns the roster schema's dtypes whatever they were read from."""
+    schema = schema or get_roster_schema()
+    df = schema.conform(df.reindex(columns=[field.name for field in get_table_schema(schema)]).reset_index(drop=True))
+    hashes = df[ROW_HASH_COLUMN].astype(object)
+    df[ROW_HASH_COLUMN] = hashes.where(hashes.notna(), None)
+    return df
+
+
+def _local_path(table_name):
+    return os.path.join(SNAPSHOT_CACHE_DIR, f"{table_name}.parquet")
+
+
+def _blob(table_name):
+    return get_storage_client().bucket(SNAPSHOT_BUCKET).blob(f"{SNAPSHOT_PREFIX}{table_name}.parquet")
+
+
+def _to_parquet(df, state):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({**table.schema.metadata, STATE_KEY: json.dumps(state).encode('utf-8')})
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer)
+    return buffer.getvalue()
+
+
+def _from_parquet(data):
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(io.BytesIO(data))
+    state = json.loads(table.schema.metadata[STATE_KEY])
+    return table.to_pandas(), state
+
+
+def _read_copies(table_name):
+    """Yield (source, df, state) for each persisted copy, cheapest first."""
+    if SNAPSHOT_CACHE_DIR and os.path.exists(_local_path(table_name)):
+        with open(_local_path(table_name), 'rb') as file:
+            yield ('local', *_from_parquet(file.read()))
+    if SNAPSHOT_BUCKET:
+        from google.api_core.exceptions import NotFound
+
+        try:
+            data = _blob(table_name).download_as_bytes()
+        except NotFound:
+            return
+        yield ('gcs', *_from_parquet(data))
+
+
+def _write_copies(table_name, df, state, include_gcs=True):
+    data = _to_parquet(df, state)
+    if SNAPSHOT_CACHE_DIR:
+        os.makedirs(SNAPSHOT_CACHE_DIR, exist_ok=True)
+        path = _local_path(table_name)
+        with open(f"{path}.tmp", 'wb') as file:
+            file.write(data)
+        os.replace(f"{path}.tmp", path)  # Readers never see a partial file
+    if SNAPSHOT_BUCKET and include_gcs:
+        _blob(table_name).upload_from_string(data, content_type='application/octet-stream')
+
+
+def read_current_table(client, dataset_name, table_name, schema=None):
+    """Read the whole current-state table (one row per employee).
+
+    list_rows reads table storage directly instead of running a query; over
+    the Storage Read API it is billed per byte read, at a lower rate than a
+    query scan.
+    """
+    schema = schema or get_roster_schema()
+    rows = client.list_rows(_table_id(dataset_name, table_name), selected_fields=get_table_schema(schema))
+    df = read_to_dataframe(rows, schema)
+    logging.info(f"Read {df.shape[0]} current rows from {dataset_name}.{table_name}.")
+    return normalize_snapshot(df, schema)
+
+
+def load_snapshot(client, dataset_name, table_name, schema=None):
+    """Return the current-state table, from a cached copy whenever one is still valid."""
+    with span('snapshot_read', table=table_name) as stage:
+        df, stage['source'] = _load_snapshot(client, dataset_name, table_name, schema)
+        stage['rows_out'] = len(df)
+    return df
+
+
+def _load_snapshot(client, dataset_name, table_name, schema):
+    """Return (snapshot, where it came from)."""
+    table_id = _table_id(dataset_name, table_name)
+    state = table_state(client, dataset_name, table_name)
+
+    cached = _snapshots.get(table_id)
+    if cached is not None and cached[0] == state:
+        logging.info(f"Using in-memory snapshot of {table_name} ({state['num_rows']} rows).")
+        return cached[1], 'memory'
+
+    try:
+        for source, df, cached_state in _read_copies(table_name):
+            if cached_state == state:
+                logging.info(f"Using {source} snapshot of {table_name} ({state['num_rows']} rows).")
+                _snapshots[table_id] = (state, df)
+                if source == 'gcs':
+                    _write_copies(table_name, df, state, include_gcs=False)
+                return df, source
+            logging.info(f"Ignoring stale {source} snapshot of {table_name}.")
+    except Exception as e:
+        logging.warning(f"Could not read cached snapshot of {table_name}: {e}")
+
+    df = read_current_table(client, dataset_name, table_name, schema)
+    _snapshots[table_id] = (state, df)
+    try:
+        _write_copies(table_name, df, state)
+    except Exception as e:
+        logging.warning(f"Could not cache snapshot of {table_name}: {e}")
+    return df, 'table'
+
+
+def update_snapshot(client, opened_df, dataset_name, table_name, schema=None, before=None, written=None):
+    """Apply rows the pipeline just made current to the snapshot loaded earlier in this run.
+
+    before is the table state read just ahead of the write and written the
+    time the write job ended. The snapshot is only carried forward when
+    before is the state it was loaded at, the table now holds exactly the
+    snapshot's rows and was not modified after the write; otherwise
+    something else touched the table and the snapshot is invalidated
+    instead, so the next run re-reads it.
+    """
+    table_id = _table_id(dataset_name, table_name)
+    cached = _snapshots.get(table_id)
+    if cached is None or opened_df.empty:
+        return
+
+    try:
+        if before is not None and before != cached[0]:
+            logging.warning(f"{table_name} changed after its snapshot was read; invalidating it.")
+            invalidate_snapshot(dataset_name, table_name)
+            return
+        schema = schema or get_roster_schema()
+        opened = opened_df.drop_duplicates(subset=[KEY_COLUMN], keep='first')
+        opened = opened.assign(**{ROW_HASH_COLUMN: compute_row_hash(opened, schema.compared_types)})
+        snapshot = cached[1]
+        # An empty part would take part in picking the column dtypes; categoricals of differing
+        # categories concatenate as object and are conformed back
+        parts = [snapshot[~snapshot[KEY_COLUMN].isin(opened[KEY_COLUMN])], normalize_snapshot(opened, schema)]
+        df = normalize_snapshot(pd.concat([part for part in parts if not part.empty], ignore_index=True), schema)
+        state = table_state(client, dataset_name, table_name)
+        modified_after = written is not None and datetime.fromisoformat(state['modified']) > written
+        if state['num_rows'] != len(df) or modified_after:
+            logging.warning(f"{table_name} has {state['num_rows']} rows, snapshot has {len(df)}"
+                            f"{', and it was modified after the write' if modified_after else ''}; invalidating it.")
+            invalidate_snapshot(dataset_name, table_name)
+            return
+        _snapshots[table_id] = (state, df)
+        _write_copies(table_name, df, state)
+        logging.info(f"Updated snapshot of {table_name} with {len(opened)} rows.")
+    except Exception as e:
+        logging.warning(f"Could not update snapshot of {table_name}, invalidating it: {e}")
+        invalidate_snapshot(dataset_name, table_name)
+
+
+def invalidate_snapshot(dataset_name=DATASET_NAME, table_name=CURRENT_TABLE_NAME):
+    """Drop every cached copy of the table, e.g. after it was edited by hand."""
+    _snapshots.pop(_table_id(dataset_name, table_name), None)
+    if SNAPSHOT_CACHE_DIR and os.path.exists(_local_path(table_name)):
+        os.remove(_local_path(table_name))
+    if SNAPSHOT_BUCKET:
+        from google.api_core.exceptions import NotFound
+
+        try:
+            _blob(table_name).delete()
+        except NotFound:
+            pass
+    logging.info(f"Invalidated cached snapshot of {dataset_name}.{table_name}.")
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Manage the cached snapshot of the current-state table.")
+    parser.add_argument('--invalidate', action='store_true', help='delete the local and GCS copies')
+    parser.add_argument('--table', default=CURRENT_TABLE_NAME)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.invalidate:
+        invalidate_snapshot(DATASET_NAME, args.table)
+    else:
+        print(table_state(get_bigquery_client(), DATASET_NAME, args.table))
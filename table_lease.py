@@ -0,0 +1,283 @@
+"""Per-table leases and the queue of uploads waiting for them.
+
+Two invocations that diff against the same current state and both append
+would write every changed version twice, so only the holder of a pipeline's
+lease may read its snapshot and write its tables. An upload is first added to
+the pipeline's queue; whoever holds (or next acquires) the lease takes every
+queued upload and upserts them together. Uploads that arrive while a run is
+in flight therefore wait in the queue and are picked up as one batch instead
+of each repeating the read and the load.
+
+Acquiring a lease is an atomic create (a GCS object written with
+ifGenerationMatch=0, or a row inserted in a SQLite transaction). A lease
+carries an expiry, so one left behind by a crashed instance is taken over
+after LEASE_TTL_SECONDS.
+
+A queued upload that fails stays queued with its attempt count, and after
+QUEUE_MAX_ATTEMPTS failures it is moved to the queue's dead letters, where an
+operator can inspect it, instead of being retried by every later holder.
+
+Jobs run outside process_file that rewrite a pipeline's tables, such as the
+history compaction, hold the same lease with held_lease.
+"""
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+from gcp_clients import get_storage_client
+from config import LEASE_BACKEND, LEASE_BUCKET, LEASE_PREFIX, LEASE_PATH, LEASE_TTL_SECONDS
+
+
+def table_lease_name(dataset_name, table_name):
+    """Lease guarding a history table and its current-state table."""
+    return f"{dataset_name}.{table_name}"
+
+
+def lease_name(pipeline):
+    """Lease guarding a pipeline's tables."""
+    return table_lease_name(pipeline.dataset_name, pipeline.table_name)
+
+
+def upload_id(upload):
+    """Queue id of an upload; a retried event maps to the entry already queued."""
+    return hashlib.sha256(f"{upload['bucket']}/{upload['name']}#{upload['generation']}".encode('utf-8')).hexdigest()
+
+
+class LeaseBackend(ABC):
+    """Storage for leases and queues; acquire must be an atomic create or takeover."""
+
+    @abstractmethod
+    def acquire(self, name, owner, ttl):
+        """Take the lease unless another owner holds an unexpired one; return whether it was taken."""
+
+    @abstractmethod
+    def release(self, name, owner):
+        """Drop the lease if owner holds it."""
+
+    @abstractmethod
+    def enqueue(self, name, entry_id, entry):
+        """Queue an entry; an entry_id already queued is kept as is."""
+
+    @abstractmethod
+    def pending(self, name):
+        """Queued (entry_id, entry) pairs, oldest first."""
+
+    @abstractmethod
+    def remove(self, name, entry_ids):
+        """Drop the given entries from the queue."""
+
+    @abstractmethod
+    def update(self, name, entry_id, entry):
+        """Replace a queued entry, keeping its place in the queue."""
+
+    @abstractmethod
+    def dead_letter(self, name, entry_id, entry):
+        """Move an entry from the queue to its dead letters."""
+
+    @abstractmethod
+    def dead_letters(self, name):
+        """Dead-lettered (entry_id, entry) pairs."""
+
+
+class SQLiteLeases(LeaseBackend):
+    """Leases and queues in a local SQLite file, shared by every process on the machine."""
+
+    def __init__(self, path=LEASE_PATH):
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=30)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS queue (seq INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, "
+            "entry_id TEXT NOT NULL, entry TEXT NOT NULL, UNIQUE (name, entry_id))"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS dead_letters (name TEXT NOT NULL, entry_id TEXT NOT NULL, entry TEXT NOT NULL, "
+            "PRIMARY KEY (name, entry_id))"
+        )
+
+    def acquire(self, name, owner, ttl):
+        now = time.time()
+        self.connection.execute("BEGIN IMMEDIATE")  # Holds the write lock from the check to the insert
+        try:
+            held = self.connection.execute("SELECT owner, expires FROM leases WHERE name = ?", (name,)).fetchone()
+            if held is not None and held[0] != owner and held[1] > now:
+                return False
+            self.connection.execute("INSERT OR REPLACE INTO leases (name, owner, expires) VALUES (?, ?, ?)",
+                                    (name, owner, now + ttl))
+            return True
+        finally:
+            self.connection.execute("COMMIT")
+
+    def release(self, name, owner):
+        self.connection.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    def enqueue(self, name, entry_id, entry):
+        self.connection.execute("INSERT OR IGNORE INTO queue (name, entry_id, entry) VALUES (?, ?, ?)",
+                                (name, entry_id, json.dumps(entry, default=str)))
+
+    def pending(self, name):
+        rows = self.connection.execute("SELECT entry_id, entry FROM queue WHERE name = ? ORDER BY seq", (name,))
+        return [(entry_id, json.loads(entry)) for entry_id, entry in rows]
+
+    def remove(self, name, entry_ids):
+        self.connection.executemany("DELETE FROM queue WHERE name = ? AND entry_id = ?",
+                                    [(name, entry_id) for entry_id in entry_ids])
+
+    def update(self, name, entry_id, entry):
+        self.connection.execute("UPDATE queue SET entry = ? WHERE name = ? AND entry_id = ?",
+                                (json.dumps(entry, default=str), name, entry_id))
+
+    def dead_letter(self, name, entry_id, entry):
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.execute("INSERT OR REPLACE INTO dead_letters (name, entry_id, entry) VALUES (?, ?, ?)",
+                                    (name, entry_id, json.dumps(entry, default=str)))
+            self.connection.execute("DELETE FROM queue WHERE name = ? AND entry_id = ?", (name, entry_id))
+
+    def dead_letters(self, name):
+        rows = self.connection.execute("SELECT entry_id, entry FROM dead_letters WHERE name = ? ORDER BY rowid", (name,))
+        return [(entry_id, json.loads(entry)) for entry_id, entry in rows]
+
+
+class GCSLeases(LeaseBackend):
+    """Leases as GCS objects created with ifGenerationMatch=0; queued uploads as one object each."""
+
+    def __init__(self, bucket_name, prefix=LEASE_PREFIX, client=None):
+        self.bucket = (client or get_storage_client()).bucket(bucket_name)
+        self.prefix = prefix
+
+    def _lease_blob(self, name):
+        return self.bucket.blob(f"{self.prefix}{name}.lease")
+
+    def _queue_prefix(self, name):
+        return f"{self.prefix}{name}/"
+
+    def _dead_letter_prefix(self, name):
+        return f"{self.prefix}dead_letters/{name}/"
+
+    def _write_lease(self, name, owner, ttl, generation):
+        from google.api_core.exceptions import PreconditionFailed
+
+        blob = self._lease_blob(name)
+        blob.metadata = {'owner': owner, 'expires': str(time.time() + ttl)}
+        try:
+            blob.upload_from_string(b'', content_type='application/octet-stream', if_generation_match=generation)
+            return True
+        except PreconditionFailed:
+            return False
+
+    def acquire(self, name, owner, ttl):
+        if self._write_lease(name, owner, ttl, generation=0):
+            return True
+        held = self.bucket.get_blob(self._lease_blob(name).name)
+        if held is None:  # Released in the meantime
+            return self._write_lease(name, owner, ttl, generation=0)
+        metadata = held.metadata or {}
+        if metadata.get('owner') != owner and float(metadata.get('expires', 0)) > time.time():
+            return False
+        # Expired (or already ours): take it over unless someone else just did
+        return self._write_lease(name, owner, ttl, generation=held.generation)
+
+    def release(self, name, owner):
+        from google.api_core.exceptions import NotFound, PreconditionFailed
+
+        held = self.bucket.get_blob(self._lease_blob(name).name)
+        if held is None or (held.metadata or {}).get('owner') != owner:
+            return
+        try:
+            held.delete(if_generation_match=held.generation)
+        except (NotFound, PreconditionFailed):
+            pass
+
+    def enqueue(self, name, entry_id, entry):
+        from google.api_core.exceptions import PreconditionFailed
+
+        try:
+            self.bucket.blob(f"{self._queue_prefix(name)}{entry_id}.json").upload_from_string(
+                json.dumps(entry, default=str), content_type='application/json', if_generation_match=0
+            )
+        except PreconditionFailed:
+            pass  # Already queued by an earlier delivery of the same event
+
+    def pending(self, name):
+        blobs = sorted(self.bucket.list_blobs(prefix=self._queue_prefix(name)), key=lambda blob: blob.time_created)
+        # An updated entry is kept in the object's metadata
+        return [(blob.name.rsplit('/', 1)[-1][:-len('.json')],
+                 json.loads((blob.metadata or {}).get('entry') or blob.download_as_bytes())) for blob in blobs]
+
+    def remove(self, name, entry_ids):
+        from google.api_core.exceptions import NotFound
+
+        for entry_id in entry_ids:
+            try:
+                self.bucket.blob(f"{self._queue_prefix(name)}{entry_id}.json").delete()
+            except NotFound:
+                pass
+
+    def update(self, name, entry_id, entry):
+        from google.api_core.exceptions import PreconditionFailed
+
+        blob = self.bucket.get_blob(f"{self._queue_prefix(name)}{entry_id}.json")
+        if blob is None:
+            return
+        # Rewritten in place, so the queue keeps its order by creation time
+        blob.metadata = {**(blob.metadata or {}), 'entry': json.dumps(entry, default=str)}
+        try:
+            blob.patch(if_generation_match=blob.generation)
+        except PreconditionFailed:
+            pass  # Removed or replaced in the meantime
+
+    def dead_letter(self, name, entry_id, entry):
+        self.bucket.blob(f"{self._dead_letter_prefix(name)}{entry_id}.json").upload_from_string(
+            json.dumps(entry, default=str), content_type='application/json'
+        )
+        self.remove(name, [entry_id])
+
+    def dead_letters(self, name):
+        blobs = sorted(self.bucket.list_blobs(prefix=self._dead_letter_prefix(name)), key=lambda blob: blob.time_created)
+        return [(blob.name.rsplit('/', 1)[-1][:-len('.json')], json.loads(blob.download_as_bytes())) for blob in blobs]
+
+
+def get_leases(bucket_name):
+    """Leases configured by LEASE_BACKEND, or None when invocations are not coordinated."""
+    if LEASE_BACKEND == 'none':
+        return None
+    if LEASE_BACKEND == 'sqlite':
+        return SQLiteLeases()
+    if LEASE_BACKEND == 'gcs':
+        if not (LEASE_BUCKET or bucket_name):
+            raise ValueError("LEASE_BACKEND is 'gcs' but no lease bucket is set (LEASE_BUCKET).")
+        return GCSLeases(LEASE_BUCKET or bucket_name)
+    raise ValueError(f"Unknown LEASE_BACKEND '{LEASE_BACKEND}'")
+
+
+@contextmanager
+def held_lease(leases, name, ttl=LEASE_TTL_SECONDS):
+    """Hold a lease for a job run outside process_file; yields a callable that renews it.
+
+    Raises RuntimeError when another writer holds the lease, and renew raises
+    when the lease expired and was taken over in the meantime. With leases
+    None (LEASE_BACKEND=none) nothing is coordinated.
+    """
+    if leases is None:
+        logging.warning(f"Table leases are disabled; make sure no uploads are processed while {name} is rewritten.")
+        yield lambda: None
+        return
+    owner = uuid.uuid4().hex
+
+    def renew():
+        if not leases.acquire(name, owner, ttl):
+            raise RuntimeError(f"The lease on {name} expired and was taken over by another writer.")
+
+    if not leases.acquire(name, owner, ttl):
+        raise RuntimeError(f"The lease on {name} is held by another writer; run again once its uploads are processed.")
+    try:
+        yield renew
+    finally:
+        leases.release(name, owner)
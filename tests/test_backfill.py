@@ -0,0 +1,83 @@
+"""A backfill writes the same tables as processing its exports one upload at a time."""
+import shutil
+import sys
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+import backfill
+import bigquery_upsert
+import excel_to_pandas
+import main
+import snapshot_cache
+import table_lease
+from benchmarks.roster_generator import write_export_series
+from config import PROJECT_ID, DATASET_NAME, TABLE_NAME, CURRENT_TABLE_NAME
+from excel_to_pandas import get_roster_schema, get_table_schema
+from gcp_clients import set_bigquery_client
+from local_warehouse import LocalWarehouseClient
+from scd2_diff import KEY_COLUMN
+
+COLUMNS = [field.name for field in get_table_schema(get_roster_schema())]
+
+
+@pytest.fixture
+def exports(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'trigger_scheduled_query', lambda *args, **kwargs: None)
+    monkeypatch.setattr(snapshot_cache, 'SNAPSHOT_CACHE_DIR', str(tmp_path / 'snapshot'))
+    monkeypatch.setattr(snapshot_cache, '_snapshots', {})
+    directory = tmp_path / 'exports'
+    paths = write_export_series(str(directory), 150, exports=4, churn=0.1, new_hire_rate=0.05)
+    shutil.copy(paths[-1], directory / 'roster_2024-01-29.xlsx')  # An unchanged re-export
+    yield str(directory)
+    set_bigquery_client(None)
+
+
+def _on_day(monkeypatch, day):
+    today = type('Day', (datetime,), {'now': classmethod(lambda cls, tz=None: datetime.combine(day, datetime.min.time()))})
+    monkeypatch.setattr(bigquery_upsert, 'datetime', today)
+    monkeypatch.setattr(excel_to_pandas, 'datetime', today)
+
+
+def _canonical(df):
+    df = snapshot_cache.normalize_snapshot(df[COLUMNS]).astype(str)
+    return df.sort_values(COLUMNS, ignore_index=True)
+
+
+def _sequential(directory, monkeypatch):
+    client = LocalWarehouseClient()
+    set_bigquery_client(client)
+    for run_date, path in backfill.list_exports(directory):
+        _on_day(monkeypatch, run_date)
+        assert main.process_roster(path)
+    tables = [client.query(f"SELECT * FROM `{PROJECT_ID}.{DATASET_NAME}.{table}`").to_dataframe()
+              for table in (TABLE_NAME, CURRENT_TABLE_NAME)]
+    return [_canonical(df) for df in tables]
+
+
+def test_local_backfill_matches_sequential_uploads(exports, tmp_path, monkeypatch):
+    history, current = _sequential(exports, monkeypatch)
+
+    monkeypatch.setattr(sys, 'argv', ['backfill.py', exports, '--local-dir', str(tmp_path / 'out'), '--workers', '1'])
+    backfill.main()
+
+    assert len(history) > 150 and len(current) == current[KEY_COLUMN].nunique()
+    pd.testing.assert_frame_equal(_canonical(pd.read_parquet(tmp_path / 'out' / 'history.parquet')), history)
+    pd.testing.assert_frame_equal(_canonical(pd.read_parquet(tmp_path / 'out' / 'current.parquet')), current)
+
+
+def test_backfill_writes_the_tables_as_sequential_uploads_would(exports, tmp_path, monkeypatch):
+    history, current = _sequential(exports, monkeypatch)
+
+    client = LocalWarehouseClient()
+    set_bigquery_client(client)
+    leases = table_lease.SQLiteLeases(str(tmp_path / 'leases.sqlite'))
+    monkeypatch.setattr(table_lease, 'get_leases', lambda bucket_name: leases)
+    monkeypatch.setattr(sys, 'argv', ['backfill.py', exports, '--workers', '1', '--no-trigger'])
+    backfill.main()
+
+    tables = [client.query(f"SELECT * FROM `{PROJECT_ID}.{DATASET_NAME}.{table}`").to_dataframe()
+              for table in (TABLE_NAME, CURRENT_TABLE_NAME)]
+    pd.testing.assert_frame_equal(_canonical(tables[0]), history)
+    pd.testing.assert_frame_equal(_canonical(tables[1]), current)
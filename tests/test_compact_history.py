@@ -0,0 +1,80 @@
+"""Spark compaction in local mode, on a history the pipeline wrote to the SQLite stand-in."""
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pytest
+
+import bigquery_upsert
+import compact_history
+import main
+import snapshot_cache
+from benchmarks.roster_generator import write_export_series
+from config import DATASET_NAME, CURRENT_TABLE_NAME
+from excel_to_pandas import get_roster_schema
+from gcp_clients import set_bigquery_client
+from local_warehouse import LocalWarehouseClient
+from scd2_diff import KEY_COLUMN
+
+pytest.importorskip('pyspark')
+
+
+@pytest.fixture(scope='module')
+def spark():
+    session = compact_history.get_spark()
+    yield session
+    session.stop()
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    client = LocalWarehouseClient()
+    set_bigquery_client(client)
+    monkeypatch.setattr(main, 'UPSERT_MODE', 'dataframe')
+    monkeypatch.setattr(main, 'trigger_scheduled_query', lambda *args, **kwargs: None)
+    monkeypatch.setattr(snapshot_cache, 'SNAPSHOT_CACHE_DIR', str(tmp_path / 'snapshot'))
+    monkeypatch.setattr(snapshot_cache, '_snapshots', {})
+    paths = write_export_series(str(tmp_path / 'exports'), 150, exports=3, churn=0.2, new_hire_rate=0.05)
+    # Weekly uploads, the last re-loading the first export, so versions repeat and dates differ
+    for week, path in enumerate(paths + paths[:1]):
+        day = datetime(2024, 1, 1) + timedelta(weeks=week)
+        monkeypatch.setattr(bigquery_upsert, 'datetime', type('Day', (datetime,), {'now': classmethod(lambda cls, tz=None, day=day: day)}))
+        assert main.process_roster(path)
+    yield client
+    set_bigquery_client(None)
+
+
+def _by_version(df):
+    return df.sort_values([KEY_COLUMN, 'start_date', 'end_date'], ignore_index=True)
+
+
+def test_compaction_merges_versions_clips_overlaps_and_keeps_the_current_state(client, spark, tmp_path):
+    schema = get_roster_schema()
+    compared = list(schema.compared_types)
+    workdir = str(tmp_path)
+    history = _by_version(compact_history.to_pandas(compact_history.read_history(spark, None, workdir), workdir, 'history_in'))
+    # A manual fix left one closed version running two days into the next one
+    closed = history.index[history['start_date'] < history['end_date']][0]
+    history.loc[closed, 'end_date'] = history.loc[closed, 'end_date'] + timedelta(days=2)
+    history.to_parquet(tmp_path / 'history.parquet', index=False)
+
+    compacted = compact_history.compact_versions(compact_history.read_history(spark, str(tmp_path / 'history.parquet'), workdir), compared).cache()
+    assert compacted.filter('_overlaps').count() == 1
+    versions = _by_version(compact_history.to_pandas(compacted.drop('_overlaps'), workdir, 'versions'))
+
+    # Consecutive identical versions are merged
+    assert len(versions) < len(history)
+    content = versions[compared].astype(str).agg('|'.join, axis=1)
+    assert not (content == content.groupby(versions[KEY_COLUMN]).shift()).any()
+    # No version ends after the next one starts; the clipped one ends where the next starts
+    next_start = versions.groupby(KEY_COLUMN)['start_date'].shift(-1)
+    follows = next_start.notna()
+    assert (versions['end_date'][follows].astype(str) <= next_start[follows].astype(str)).all()
+    clipped = versions[(versions[KEY_COLUMN] == history.loc[closed, KEY_COLUMN])
+                       & (versions['start_date'] <= history.loc[closed, 'start_date'])].index[-1]
+    assert versions.loc[clipped, 'end_date'] == next_start[clipped]
+
+    # The current state stays row for row the same
+    current = compact_history.to_pandas(compact_history.current_versions(compacted.drop('_overlaps')), workdir, 'current')
+    table = snapshot_cache.read_current_table(client, DATASET_NAME, CURRENT_TABLE_NAME, schema)
+    pd.testing.assert_frame_equal(current.sort_values(KEY_COLUMN, ignore_index=True)[schema.names],
+                                  table.sort_values(KEY_COLUMN, ignore_index=True)[schema.names])
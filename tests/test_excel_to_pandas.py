@@ -0,0 +1,55 @@
+"""Workbook readers: the streaming reader must load a roster as pd.read_excel did, with either engine."""
+from datetime import date, datetime
+
+import pandas as pd
+import pytest
+
+import excel_to_pandas
+from benchmarks.roster_generator import generate_roster, write_roster
+from excel_to_pandas import (ROSTER_SHEET_NAME, clean_column_names, convert_roster_types, get_roster_schema,
+                             iter_excel_chunks, load_excel_to_dataframe)
+from schema_utils import sync_columns
+
+CURRENT_DATE = date(2024, 1, 8)
+
+
+@pytest.fixture
+def workbook(tmp_path):
+    rows = generate_roster(200, seed=3)
+    # Blank cells of every column type, date cells with a time, and whole numbers stored as floats
+    for row in rows[::9]:
+        row.update(leader=None, tenure=None, go_live=None, natterbox=None)
+    for row in rows[::13]:
+        row.update(date_of_hire=datetime(2023, 5, 17, 14, 30), termination_date=date(2024, 1, 2))
+    for row in rows[::17]:
+        row.update(wave=12.0, national_id=1012345678.0, tenure='7', address='')
+    for row in rows[::23]:  # Blank numeric ids upcast the whole column to floats in pd.read_excel
+        row.update(national_id=None, phone_number=None, birthday='-')
+    rows.insert(50, {col: None for col in rows[0]})  # Fully blank rows, skipped by the streaming reader
+    rows.insert(120, {col: None for col in rows[0]})
+    return write_roster(str(tmp_path / 'roster.xlsx'), rows)
+
+
+def test_calamine_reads_rosters_like_openpyxl(workbook, monkeypatch):
+    pytest.importorskip('python_calamine')
+    frames = {}
+    for engine in ('openpyxl', 'calamine'):
+        monkeypatch.setattr(excel_to_pandas, 'xlsx_engine', lambda engine=engine: engine)
+        frames[engine] = load_excel_to_dataframe(workbook, current_date=CURRENT_DATE, chunk_size=64)
+
+    assert len(frames['openpyxl']) == 200
+    pd.testing.assert_frame_equal(frames['calamine'], frames['openpyxl'])
+
+
+def test_streaming_reader_matches_read_excel(workbook):
+    schema = get_roster_schema()
+    raw = pd.read_excel(workbook, sheet_name=ROSTER_SHEET_NAME, usecols='A:X', header=0, engine='openpyxl')
+    raw.columns = clean_column_names(raw.columns)
+    raw = raw.dropna(how='all').reset_index(drop=True)  # The one intended difference: blank rows are skipped
+    assert raw['national_id'].dtype == 'float64'  # The upcast the text rendering has to undo
+    expected = schema.conform(sync_columns(convert_roster_types(raw, CURRENT_DATE, schema), schema.positions))
+
+    chunks = list(iter_excel_chunks(workbook, chunk_size=64, current_date=CURRENT_DATE))
+    assert len(chunks) == 4
+    pd.testing.assert_frame_equal(schema.conform(pd.concat(chunks, ignore_index=True)), expected)
+    pd.testing.assert_frame_equal(load_excel_to_dataframe(workbook, current_date=CURRENT_DATE, chunk_size=64), expected)
@@ -0,0 +1,25 @@
+"""Cold-start imports of the Cloud Function (see benchmarks/import_time.py).
+
+Heavy modules are always checked for being deferred. Wall-clock time depends on
+the machine, so the budget is only checked when IMPORT_BUDGET_MS is set, e.g.
+IMPORT_BUDGET_MS=1500 on the deployment's instance class.
+"""
+import os
+
+import pytest
+
+from benchmarks.import_time import DEFERRED_MODULES, measure
+
+
+def test_import_main_defers_heavy_modules():
+    cumulative, _ = measure()
+
+    assert [name for name in DEFERRED_MODULES if name in cumulative] == []
+
+
+@pytest.mark.skipif('IMPORT_BUDGET_MS' not in os.environ, reason='set IMPORT_BUDGET_MS to check the import time budget')
+def test_import_main_within_budget():
+    _, total_us = measure()
+    budget_ms = float(os.environ['IMPORT_BUDGET_MS'])
+
+    assert total_us / 1000 <= budget_ms, f"import main took {total_us / 1000:.0f} ms (budget {budget_ms:.0f} ms)"
@@ -0,0 +1,39 @@
+"""Span records of the per-invocation trace."""
+import json
+
+import numpy as np
+import pytest
+
+from instrumentation import peak_rss_mb, reset_peak_rss, span, trace
+
+
+def _trace(capsys):
+    return json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+
+
+def test_sequential_spans_report_their_own_peak(capsys):
+    if not reset_peak_rss():
+        pytest.skip('the peak RSS cannot be reset on this platform')
+
+    with trace('test'):
+        with span('large'):
+            large = np.ones(40_000_000)  # About 300 MB
+            large.sum()
+        del large
+        with span('small', rows_in=3) as stage:
+            stage['rows_out'] = 3
+
+    record = _trace(capsys)
+    large, small = record['spans']
+    assert large['peak_rss_delta_mb'] > 250
+    assert small['peak_rss_delta_mb'] < 50 and small['peak_rss_mb'] < large['peak_rss_mb']
+    assert record['peak_rss_mb'] >= large['peak_rss_mb'] and record['peak_rss_reset'] is True
+    assert (small['rows_in'], small['rows_out']) == (3, 3)
+
+
+def test_span_outside_a_trace_is_dropped(capsys):
+    with span('alone') as stage:
+        stage['rows_out'] = 1
+
+    assert capsys.readouterr().out == ''
+    assert peak_rss_mb() > 0
@@ -0,0 +1,176 @@
+"""Idempotency ledger and the SQLite stand-ins of the ledger and lease backends."""
+import pytest
+
+import main
+from ledger import SQLiteLedger, build_ledger_keys
+from table_lease import SQLiteLeases, held_lease
+
+EVENT = {'bucket': 'uploads', 'name': 'roster_2024-01-08.xlsx', 'generation': '1704700000000000',
+         'md5Hash': 'XUFAKrxLKna5cZ2REBfFkg=='}
+
+
+def test_ledger_keys_identify_content_and_generation():
+    keys = build_ledger_keys(EVENT, 'v1')
+
+    assert keys == ['content:md5:5d41402abc4b2a76b9719d911017c592:v1',
+                    'generation:uploads/roster_2024-01-08.xlsx#1704700000000000:v1']
+    # The same bytes under another name share the content key; a new schema version shares none
+    copy = dict(EVENT, name='copy.xlsx', generation='1')
+    assert build_ledger_keys(copy, 'v1')[0] == keys[0]
+    assert not set(build_ledger_keys(EVENT, 'v2')) & set(keys)
+
+
+def test_sqlite_ledger_add_is_an_atomic_create(tmp_path):
+    ledger = SQLiteLedger(str(tmp_path / 'ledger.sqlite'))
+
+    assert not ledger.seen(['a', 'b'])
+    assert ledger.add('a', {'name': 'x'})
+    assert not ledger.add('a', {'name': 'y'})
+    assert ledger.seen(['b', 'a'])
+    ledger.record(['b'], {'name': 'x'})
+    assert ledger.contains('b')
+
+
+@pytest.fixture
+def backends(tmp_path, monkeypatch):
+    ledger = SQLiteLedger(str(tmp_path / 'ledger.sqlite'))
+    leases = SQLiteLeases(str(tmp_path / 'leases.sqlite'))
+    monkeypatch.setattr(main, 'get_ledger', lambda bucket_name: ledger)
+    monkeypatch.setattr(main, 'get_leases', lambda bucket_name: leases)
+    return ledger, leases
+
+
+def test_upload_is_processed_once(backends, monkeypatch):
+    processed = []
+    monkeypatch.setattr(main, 'run_pipelines', lambda file_path, pipelines, ledger=None: processed.append(file_path) or True)
+
+    assert main.handle_upload(EVENT) == 'processed'
+    assert main.handle_upload(EVENT) == 'duplicate'  # A retried event
+    assert main.handle_upload(dict(EVENT, name='copy.xlsx', generation='2')) == 'duplicate'  # Same bytes
+    assert processed == ['gs://uploads/roster_2024-01-08.xlsx']
+
+
+def test_failed_upload_is_not_recorded(backends, monkeypatch):
+    ledger, leases = backends
+    monkeypatch.setattr(main, 'run_pipelines', lambda file_path, pipelines, ledger=None: False)
+
+    assert main.handle_upload(EVENT) == 'failed'
+    assert not ledger.seen(build_ledger_keys(EVENT, main.pipelines_version(main.match_pipelines(EVENT['name']))))
+
+
+def test_lease_is_exclusive_until_released_or_expired(tmp_path):
+    leases = SQLiteLeases(str(tmp_path / 'leases.sqlite'))
+
+    assert leases.acquire('t', 'a', ttl=60)
+    assert leases.acquire('t', 'a', ttl=60)  # Renewed by its owner
+    assert not leases.acquire('t', 'b', ttl=60)
+    leases.release('t', 'b')  # Only the owner releases
+    assert not leases.acquire('t', 'b', ttl=60)
+    leases.release('t', 'a')
+    assert leases.acquire('t', 'b', ttl=-1)  # Taken, and already expired
+    assert leases.acquire('t', 'c', ttl=60)
+
+
+def test_held_lease_excludes_uploads_and_detects_a_takeover(tmp_path):
+    leases = SQLiteLeases(str(tmp_path / 'leases.sqlite'))
+
+    with held_lease(leases, 't', ttl=60) as renew:
+        assert not leases.acquire('t', 'upload', ttl=60)
+        renew()
+    assert leases.acquire('t', 'upload', ttl=60)
+    with pytest.raises(RuntimeError):
+        with held_lease(leases, 't'):
+            pass
+    leases.release('t', 'upload')
+
+    with pytest.raises(RuntimeError):
+        with held_lease(leases, 't', ttl=-1) as renew:
+            assert leases.acquire('t', 'upload', ttl=60)  # Taken over once expired
+            renew()
+
+
+def test_lease_queue_keeps_order_and_ignores_requeues(tmp_path):
+    leases = SQLiteLeases(str(tmp_path / 'leases.sqlite'))
+
+    leases.enqueue('t', 'first', {'name': 'a'})
+    leases.enqueue('t', 'second', {'name': 'b'})
+    leases.enqueue('t', 'first', {'name': 'a, retried'})
+    leases.enqueue('other', 'third', {'name': 'c'})
+    assert leases.pending('t') == [('first', {'name': 'a'}), ('second', {'name': 'b'})]
+
+    leases.remove('t', ['first'])
+    assert leases.pending('t') == [('second', {'name': 'b'})]
+
+
+def test_queued_uploads_are_taken_by_the_lease_holder(backends, monkeypatch):
+    ledger, leases = backends
+    batches = []
+    monkeypatch.setattr(main, 'upsert_batch', lambda pipelines, uploads, ledger=None, renew_lease=None: batches.append(
+        [upload['name'] for upload in uploads]) or {p.name: [True] * len(uploads) for p in pipelines})
+    pipeline = main.default_pipeline()
+    name = main.lease_name(pipeline)
+    leases.acquire(name, 'other invocation', ttl=60)
+
+    second = dict(EVENT, name='second.xlsx', generation='2')
+    assert main.run_serialized([pipeline], dict(EVENT, file_path='gs://uploads/first.xlsx'), leases) == 'queued'
+    leases.release(name, 'other invocation')
+    assert main.run_serialized([pipeline], dict(second, file_path='gs://uploads/second.xlsx'), leases) == 'processed'
+
+    assert batches == [['roster_2024-01-08.xlsx', 'second.xlsx']]
+    assert leases.pending(name) == []
+
+
+def test_failed_uploads_stay_queued_for_the_next_holder(backends, monkeypatch):
+    ledger, leases = backends
+    batches = []
+    monkeypatch.setattr(main, 'upsert_batch', lambda pipelines, uploads, ledger=None, renew_lease=None: batches.append(
+        [upload['name'] for upload in uploads]) or {p.name: [upload['name'] != 'broken.xlsx' for upload in uploads] for p in pipelines})
+    pipeline = main.default_pipeline()
+    name = main.lease_name(pipeline)
+    broken = dict(EVENT, name='broken.xlsx', generation='2', file_path='gs://uploads/broken.xlsx')
+
+    assert main.run_serialized([pipeline], broken, leases) == 'failed'
+    assert [entry['name'] for _, entry in leases.pending(name)] == ['broken.xlsx']
+    assert main.run_serialized([pipeline], dict(EVENT, file_path='gs://uploads/first.xlsx'), leases) == 'processed'
+
+    assert batches == [['broken.xlsx'], ['broken.xlsx', 'roster_2024-01-08.xlsx']]
+    assert [entry['name'] for _, entry in leases.pending(name)] == ['broken.xlsx']
+
+
+def test_upload_failing_every_attempt_is_dead_lettered(backends, monkeypatch, caplog):
+    ledger, leases = backends
+    monkeypatch.setattr(main, 'QUEUE_MAX_ATTEMPTS', 3)
+    monkeypatch.setattr(main, 'run_pipelines', lambda file_path, pipelines, ledger=None: 'broken' not in file_path)
+    pipeline = main.default_pipeline()
+    name = main.lease_name(pipeline)
+    broken = dict(EVENT, name='broken.xlsx', generation='2', file_path='gs://uploads/broken.xlsx')
+
+    for attempt in (1, 2):
+        assert main.run_serialized([pipeline], broken, leases) == 'failed'
+        assert [entry['attempts'] for _, entry in leases.pending(name)] == [attempt]
+    assert main.run_serialized([pipeline], broken, leases) == 'failed'
+
+    assert leases.pending(name) == []
+    assert [(entry['name'], entry['attempts']) for _, entry in leases.dead_letters(name)] == [('broken.xlsx', 3)]
+    assert 'moved it to the dead letters' in caplog.text
+    assert main.run_serialized([pipeline], dict(EVENT, file_path='gs://uploads/first.xlsx'), leases) == 'processed'
+
+
+def test_upload_matching_two_pipelines_is_run_once_for_the_held_leases(backends, monkeypatch):
+    ledger, leases = backends
+    runs = []
+    monkeypatch.setattr(main, 'run_pipelines', lambda file_path, pipelines, ledger=None: runs.append(
+        (file_path, [p.name for p in pipelines])) or True)
+    first = main.default_pipeline()
+    second = first._replace(name='second', table_name='second', current_table_name='second_current')
+
+    assert main.run_serialized([first, second], dict(EVENT, file_path='gs://uploads/first.xlsx'), leases) == 'processed'
+    assert runs == [('gs://uploads/first.xlsx', [first.name, 'second'])]
+
+    # Only the free lease is drained now; the other holder takes the upload off its own queue
+    leases.acquire(main.lease_name(second), 'other invocation', ttl=60)
+    upload = dict(EVENT, name='second.xlsx', generation='2', file_path='gs://uploads/second.xlsx')
+    assert main.run_serialized([first, second], upload, leases) == 'processed'
+    assert runs[1:] == [('gs://uploads/second.xlsx', [first.name])]
+    assert leases.pending(main.lease_name(first)) == []
+    assert [entry['name'] for _, entry in leases.pending(main.lease_name(second))] == ['second.xlsx']
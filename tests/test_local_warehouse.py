@@ -0,0 +1,163 @@
+"""Warehouse SQL run against the SQLite stand-in: fingerprints and the two upsert modes."""
+import pandas as pd
+import pytest
+from google.cloud import bigquery
+
+import bigquery_upsert
+import main
+import migrate_text_format
+import snapshot_cache
+import table_lease
+from benchmarks.bench_scd2_diff import make_frames
+from benchmarks.roster_generator import write_export_series
+from config import PROJECT_ID, DATASET_NAME, TABLE_NAME, CURRENT_TABLE_NAME
+from excel_to_pandas import get_roster_schema, get_table_schema
+from gcp_clients import set_bigquery_client
+from local_warehouse import LocalWarehouseClient
+from merge_upsert import replace_tables
+from scd2_diff import KEY_COLUMN, ROW_HASH_COLUMN, compute_row_hash, row_hash_sql
+
+
+def test_row_hash_sql_matches_compute_row_hash():
+    schema = get_roster_schema()
+    df, _ = make_frames(300)
+    df = df.drop_duplicates(subset=[KEY_COLUMN], ignore_index=True)
+    # Blanks of every column type, and text that must not be mistaken for a number or a date
+    df.loc[::7, 'leader'] = None
+    df.loc[::11, 'tenure'] = None
+    df.loc[::13, 'go_live'] = None
+    df.loc[::17, 'address'] = 'Calle 5 # 1-2 ñ'
+    df = schema.conform(df)
+    client = LocalWarehouseClient()
+    table_id = f"{PROJECT_ID}.{DATASET_NAME}.fingerprints"
+    client.load_table_from_dataframe(df, table_id, job_config=bigquery.LoadJobConfig(schema=get_table_schema(schema)[:-1]))
+
+    in_sql = client.query(f"SELECT {KEY_COLUMN}, {row_hash_sql(schema.compared_types)} AS {ROW_HASH_COLUMN} "
+                          f"FROM `{table_id}`").to_dataframe().set_index(KEY_COLUMN)[ROW_HASH_COLUMN]
+    in_pandas = pd.Series(compute_row_hash(df, schema.compared_types).to_numpy(), index=df[KEY_COLUMN])
+
+    assert in_sql.reindex(in_pandas.index).tolist() == in_pandas.tolist()
+
+
+def _table(client, table_name):
+    df = client.query(f"SELECT * FROM `{PROJECT_ID}.{DATASET_NAME}.{table_name}`").to_dataframe()
+    return df.astype(str).sort_values(list(df.columns), ignore_index=True)
+
+
+def _run_exports(mode, paths, tmp_path, monkeypatch):
+    client = LocalWarehouseClient()
+    set_bigquery_client(client)
+    monkeypatch.setattr(main, 'UPSERT_MODE', mode)
+    monkeypatch.setattr(snapshot_cache, 'SNAPSHOT_CACHE_DIR', str(tmp_path / f"snapshot_{mode}"))
+    for path in paths:
+        assert main.process_roster(path)
+    return _table(client, TABLE_NAME), _table(client, CURRENT_TABLE_NAME)
+
+
+@pytest.fixture
+def exports(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'trigger_scheduled_query', lambda *args, **kwargs: None)
+    yield write_export_series(str(tmp_path / 'exports'), 200, exports=3, churn=0.1, new_hire_rate=0.05)
+    set_bigquery_client(None)
+
+
+def test_dataframe_and_merge_modes_write_the_same_tables(exports, tmp_path, monkeypatch):
+    history, current = _run_exports('dataframe', exports, tmp_path, monkeypatch)
+    changes = _table(main.get_bigquery_client(), f"{TABLE_NAME}_changes")
+    merge_history, merge_current = _run_exports('merge', exports, tmp_path, monkeypatch)
+    merge_changes = _table(main.get_bigquery_client(), f"{TABLE_NAME}_changes")
+
+    assert len(history) > 200 and len(current) == current[KEY_COLUMN].nunique()
+    pd.testing.assert_frame_equal(history, merge_history)
+    pd.testing.assert_frame_equal(current, merge_current)
+    assert set(changes['change_type']) == {'new_hire', 'changed'}
+    pd.testing.assert_frame_equal(changes, merge_changes)
+
+
+def test_reupload_changes_nothing(exports, tmp_path, monkeypatch):
+    history, current = _run_exports('dataframe', exports + exports[-1:], tmp_path, monkeypatch)
+    again, again_current = _run_exports('dataframe', exports, tmp_path, monkeypatch)
+
+    pd.testing.assert_frame_equal(history, again)
+    pd.testing.assert_frame_equal(current, again_current)
+
+
+def test_first_load_records_new_hires_in_the_change_set(exports, tmp_path, monkeypatch):
+    history, _ = _run_exports('dataframe', exports[:1], tmp_path, monkeypatch)
+    changes = _table(main.get_bigquery_client(), f"{TABLE_NAME}_changes")
+
+    assert len(changes) == len(history)
+    assert set(changes['change_type']) == {'new_hire'}
+    assert sorted(changes[KEY_COLUMN]) == sorted(history[KEY_COLUMN])
+
+
+def test_replace_tables_swaps_history_and_current_state(exports, tmp_path, monkeypatch):
+    _run_exports('dataframe', exports, tmp_path, monkeypatch)
+    client = main.get_bigquery_client()
+    schema = get_roster_schema()
+    rows = lambda table_name: client.query(f"SELECT * FROM `{PROJECT_ID}.{DATASET_NAME}.{table_name}`").to_dataframe()
+    compacted, latest = rows(TABLE_NAME).iloc[::2], rows(CURRENT_TABLE_NAME).iloc[:10]
+
+    replace_tables(client, schema.conform(compacted[schema.names].copy()), schema.conform(latest[schema.names].copy()),
+                   DATASET_NAME, TABLE_NAME, CURRENT_TABLE_NAME)
+
+    assert len(_table(client, TABLE_NAME)) == len(compacted) and len(_table(client, CURRENT_TABLE_NAME)) == 10
+    pd.testing.assert_frame_equal(_table(client, CURRENT_TABLE_NAME), latest.astype(str).sort_values(
+        list(latest.columns), ignore_index=True))
+
+
+def test_batch_writes_the_same_tables_and_change_sets_as_single_uploads(exports, tmp_path, monkeypatch):
+    history, current = _run_exports('dataframe', exports, tmp_path, monkeypatch)
+    changes = _table(main.get_bigquery_client(), f"{TABLE_NAME}_changes")
+
+    client = LocalWarehouseClient()
+    set_bigquery_client(client)
+    monkeypatch.setattr(snapshot_cache, 'SNAPSHOT_CACHE_DIR', str(tmp_path / 'snapshot_batch'))
+    assert main.run_batch(main.default_pipeline(), exports, renew_lease=lambda: True) == [True] * len(exports)
+
+    pd.testing.assert_frame_equal(history, _table(client, TABLE_NAME))
+    pd.testing.assert_frame_equal(current, _table(client, CURRENT_TABLE_NAME))
+    pd.testing.assert_frame_equal(changes, _table(client, f"{TABLE_NAME}_changes"))
+
+
+def test_batch_is_not_written_without_the_lease(exports, tmp_path, monkeypatch):
+    client = LocalWarehouseClient()
+    set_bigquery_client(client)
+    monkeypatch.setattr(snapshot_cache, 'SNAPSHOT_CACHE_DIR', str(tmp_path / 'snapshot'))
+
+    assert main.run_batch(main.default_pipeline(), exports, renew_lease=lambda: False) == [False] * len(exports)
+    assert len(_table(client, TABLE_NAME)) == 0
+
+
+def test_uploads_wait_for_the_text_format_migration(exports, tmp_path, monkeypatch):
+    client = LocalWarehouseClient()
+    set_bigquery_client(client)
+    monkeypatch.setattr(main, 'UPSERT_MODE', 'dataframe')
+    monkeypatch.setattr(snapshot_cache, 'SNAPSHOT_CACHE_DIR', str(tmp_path / 'snapshot'))
+    monkeypatch.setattr(bigquery_upsert, '_text_formatted', set())
+    schema = get_roster_schema()
+    assert main.process_roster(exports[0])
+    history = _table(client, TABLE_NAME)
+
+    # The tables as the first reader left them: whole numbers in text columns stored as floats, no label
+    for table_name in (TABLE_NAME, CURRENT_TABLE_NAME):
+        table_id = f"{PROJECT_ID}.{DATASET_NAME}.{table_name}"
+        df = schema.conform(client.query(f"SELECT * FROM `{table_id}`").to_dataframe())
+        df['phone_number'] = df['phone_number'].astype('string') + '.0'
+        df[ROW_HASH_COLUMN] = compute_row_hash(df, schema.compared_types)
+        client.load_table_from_dataframe(df, table_id, job_config=bigquery.LoadJobConfig(
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)).result()
+        table = client.get_table(table_id)
+        table.labels = {}
+        client.update_table(table, ['labels'])
+    bigquery_upsert._text_formatted.clear()
+    snapshot_cache.invalidate_snapshot(DATASET_NAME, CURRENT_TABLE_NAME)
+
+    assert not main.process_roster(exports[0])  # Refused rather than reopening every employee
+
+    monkeypatch.setattr(table_lease, 'get_leases', lambda bucket_name: table_lease.SQLiteLeases(str(tmp_path / 'leases.sqlite')))
+    monkeypatch.setattr('sys.argv', ['migrate_text_format.py'])
+    migrate_text_format.main()
+
+    assert main.process_roster(exports[0])
+    pd.testing.assert_frame_equal(_table(client, TABLE_NAME), history)
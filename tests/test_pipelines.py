@@ -0,0 +1,138 @@
+"""The pipelines registry: validation, routing of uploads, and one upload serving two pipelines."""
+import os
+
+import pytest
+
+import main
+import pipelines
+import snapshot_cache
+from benchmarks.roster_generator import write_export_series
+from config import PROJECT_ID, DATASET_NAME, TABLE_NAME, CURRENT_TABLE_NAME
+from gcp_clients import set_bigquery_client
+from ledger import SQLiteLedger
+from local_warehouse import LocalWarehouseClient
+from scd2_diff import KEY_COLUMN
+from table_lease import SQLiteLeases
+
+REFERENCE_SCHEMA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'reference_schema.yaml')
+TWO_PIPELINES = f"""
+pipelines:
+  alo_roster:
+    file_pattern: 'rosters/*'
+    sheets: [Roster ALO]
+    columns: 24
+    schema: {REFERENCE_SCHEMA}
+  alo_copy:
+    file_pattern: 'rosters/*.xlsx'
+    sheets: [Roster ALO]
+    columns: 24
+    schema: {REFERENCE_SCHEMA}
+    table: tbl_alo_copy
+  csv_roster:
+    file_pattern: 'exports/*.csv'
+    sheets: [Roster]
+    columns: 24
+    schema: {REFERENCE_SCHEMA}
+    dataset: other_dataset
+    table: tbl_alo_roster
+"""
+
+
+def _registry(tmp_path, text):
+    path = tmp_path / 'pipelines.yaml'
+    path.write_text(text)
+    return str(path)
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    path = _registry(tmp_path, TWO_PIPELINES)
+    load_pipelines = pipelines.load_pipelines
+    monkeypatch.setattr(pipelines, 'load_pipelines', lambda: load_pipelines(path))
+    return path
+
+
+@pytest.fixture
+def warehouse(tmp_path, monkeypatch):
+    client = LocalWarehouseClient()
+    set_bigquery_client(client)
+    ledger = SQLiteLedger(str(tmp_path / 'ledger.sqlite'))
+    leases = SQLiteLeases(str(tmp_path / 'leases.sqlite'))
+    monkeypatch.setattr(main, 'get_ledger', lambda bucket_name: ledger)
+    monkeypatch.setattr(main, 'get_leases', lambda bucket_name: leases)
+    monkeypatch.setattr(main, 'UPSERT_MODE', 'dataframe')
+    monkeypatch.setattr(main, 'trigger_scheduled_query', lambda *args, **kwargs: None)
+    monkeypatch.setattr(snapshot_cache, 'SNAPSHOT_CACHE_DIR', str(tmp_path / 'snapshot'))
+    monkeypatch.setattr(snapshot_cache, '_snapshots', {})
+    yield client
+    set_bigquery_client(None)
+
+
+def test_registry_entries_default_to_the_configured_tables(tmp_path):
+    loaded = {p.name: p for p in pipelines.load_pipelines(_registry(tmp_path, TWO_PIPELINES))}
+
+    assert loaded['alo_roster'].dataset_name == DATASET_NAME
+    assert (loaded['alo_roster'].table_name, loaded['alo_roster'].current_table_name) == (TABLE_NAME, CURRENT_TABLE_NAME)
+    assert loaded['alo_copy'].current_table_name == 'tbl_alo_copy_current'
+    # The same table name in another dataset is a distinct table
+    assert (loaded['csv_roster'].dataset_name, loaded['csv_roster'].current_table_name) == ('other_dataset', 'tbl_alo_roster_current')
+    assert loaded['alo_roster'].sheets == ('Roster ALO',) and loaded['alo_roster'].column_count == 24
+    assert not loaded['alo_roster'].trigger_scheduled_query
+
+
+def test_registry_schema_paths_are_relative_to_the_registry(tmp_path):
+    (tmp_path / 'schemas').mkdir()
+    (tmp_path / 'schemas' / 'roster.yaml').write_text(open(REFERENCE_SCHEMA).read())
+    path = _registry(tmp_path, "pipelines:\n  alo_roster: {sheets: [Roster ALO], columns: 24, schema: schemas/roster.yaml}\n")
+
+    (pipeline,) = pipelines.load_pipelines(path)
+    assert pipeline.schema_path == str(tmp_path / 'schemas' / 'roster.yaml')
+    assert pipeline.schema.key == KEY_COLUMN and pipeline.file_pattern == '*'
+
+
+@pytest.mark.parametrize('text, error', [
+    ("pipelines: {}\n", "No pipelines"),
+    (f"pipelines:\n  a: {{sheets: [A], columns: 24, schema: {REFERENCE_SCHEMA}, table: t}}\n"
+     f"  b: {{sheets: [B], columns: 24, schema: {REFERENCE_SCHEMA}, table: t}}\n", "distinct tables"),
+    # One pipeline's history table is the other's current-state table
+    (f"pipelines:\n  a: {{sheets: [A], columns: 24, schema: {REFERENCE_SCHEMA}, table: t}}\n"
+     f"  b: {{sheets: [B], columns: 24, schema: {REFERENCE_SCHEMA}, table: u, current_table: t}}\n", "distinct tables"),
+    ("pipelines:\n  a: {sheets: [A], columns: 3, schema: badge_schema.yaml, table: t}\n", "must key on emp_id"),
+])
+def test_invalid_registries_are_rejected(tmp_path, text, error):
+    (tmp_path / 'badge_schema.yaml').write_text(
+        "schema:\n"
+        "  0: {name: badge, type: STRING, role: key}\n"
+        "  1: {name: start_date, type: DATE, role: scd_date}\n"
+        "  2: {name: end_date, type: DATE, role: scd_date}\n")
+
+    with pytest.raises(ValueError, match=error):
+        pipelines.load_pipelines(_registry(tmp_path, text))
+
+
+def test_uploads_are_routed_by_file_pattern(registry):
+    names = lambda file_name: [pipeline.name for pipeline in pipelines.match_pipelines(file_name)]
+
+    assert names('rosters/2024-01-08.xlsx') == ['alo_roster', 'alo_copy']
+    assert names('rosters/2024-01-08.csv') == ['alo_roster']
+    assert names('exports/2024-01-08.csv') == ['csv_roster']
+    assert names('misc/notes.txt') == []
+    assert main.handle_upload({'bucket': 'uploads', 'name': 'misc/notes.txt'}) == 'no_pipeline'
+
+
+def test_upload_matching_two_pipelines_is_downloaded_once_and_upserts_both(registry, warehouse, tmp_path, monkeypatch):
+    (export,) = write_export_series(str(tmp_path / 'exports'), 120, exports=1)
+    downloads = []
+    monkeypatch.setattr(main, 'read_upload', lambda file_path: downloads.append(file_path) or open(export, 'rb').read())
+    event = {'bucket': 'uploads', 'name': 'rosters/2024-01-01.xlsx', 'generation': '1', 'md5Hash': 'XUFAKrxLKna5cZ2REBfFkg=='}
+
+    assert main.handle_upload(event) == 'processed'
+    assert downloads == ['gs://uploads/rosters/2024-01-01.xlsx']
+    rows = lambda table_name: warehouse.query(f"SELECT * FROM `{PROJECT_ID}.{DATASET_NAME}.{table_name}`").to_dataframe()
+    employees = sorted(rows(TABLE_NAME)[KEY_COLUMN])
+    assert len(employees) == 120
+    for table_name in (CURRENT_TABLE_NAME, 'tbl_alo_copy', 'tbl_alo_copy_current'):
+        assert sorted(rows(table_name)[KEY_COLUMN]) == employees
+    # Recorded for both pipelines, so a retried event downloads nothing
+    assert main.handle_upload(event) == 'duplicate'
+    assert len(downloads) == 1
@@ -0,0 +1,128 @@
+"""The set-based SCD2 diff against the per-emp_id loop it replaced."""
+from datetime import date
+
+import pandas as pd
+import pytest
+
+from benchmarks.bench_scd2_diff import make_frames, reference_diff
+from excel_to_pandas import get_roster_schema
+from scd2_diff import KEY_COLUMN, ROW_HASH_COLUMN, compute_row_hash, diff_scd2, records_to_insert, split_by_fingerprint
+
+RUN_DATE = date(2024, 3, 4)
+
+
+def _as_text(df):
+    return df.astype(str).reset_index(drop=True)
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_diff_matches_reference_loop(seed):
+    existing, new = make_frames(400, churn=0.2, new_hire_rate=0.05, history_rate=0.2, seed=seed)
+    columns = list(existing.columns)
+
+    records = records_to_insert(diff_scd2(existing, new, columns, RUN_DATE))
+    expected = reference_diff(existing, new, columns, RUN_DATE)
+
+    assert len(records) > 0
+    pd.testing.assert_frame_equal(_as_text(records), _as_text(expected))
+
+
+def test_diff_of_conformed_frames_matches_reference_loop():
+    schema = get_roster_schema()
+    existing, new = make_frames(400, churn=0.2, seed=3)
+    existing, new = schema.conform(existing), schema.conform(new)
+    schema.share_categories(existing, new)
+
+    records = records_to_insert(diff_scd2(existing, new, schema.names, RUN_DATE))
+    expected = reference_diff(existing, new, schema.names, RUN_DATE)
+
+    # The loop rebuilt rows from dicts, which drops the column dtypes
+    pd.testing.assert_frame_equal(_as_text(schema.conform(records)), _as_text(schema.conform(expected)))
+
+
+def _frame(rows):
+    return pd.DataFrame(rows, columns=[KEY_COLUMN, 'status', 'start_date', 'end_date'])
+
+
+def test_records_to_insert_order():
+    old = date(2024, 1, 1)
+    existing = _frame([
+        ('A', 'Active', old, old),
+        ('B', 'Active', date(2023, 1, 1), date(2023, 6, 1)),  # Earlier version of B
+        ('B', 'Active', old, old),
+        ('C', 'Active', old, old),
+    ])
+    new = _frame([
+        ('N1', 'Active', None, None),
+        ('C', 'Inactive', None, None),
+        ('A', 'Active', None, None),
+        ('B', 'Inactive', None, None),
+        ('N1', 'Trainee', None, None),  # A second row of a new hire is appended too
+    ])
+
+    records = records_to_insert(diff_scd2(existing, new, list(existing.columns), RUN_DATE))
+
+    assert records[[KEY_COLUMN, 'status']].values.tolist() == [
+        ['N1', 'Active'], ['N1', 'Trainee'],
+        ['C', 'Active'], ['C', 'Inactive'],
+        ['B', 'Active'], ['B', 'Inactive'],
+    ]
+    # The last existing version is the one closed; opened rows start and end on the run date
+    assert records.loc[4, 'start_date'] == old and records.loc[4, 'end_date'] == RUN_DATE
+    assert (records.loc[[0, 1, 3, 5], ['start_date', 'end_date']] == RUN_DATE).all().all()
+
+
+def test_records_to_insert_without_changes():
+    existing, _ = make_frames(50)
+    records = records_to_insert(diff_scd2(existing, existing, list(existing.columns), RUN_DATE))
+
+    assert records.empty
+    assert list(records.columns) == list(existing.columns)
+
+
+def test_split_by_fingerprint():
+    types = {'status': 'STRING'}
+    current = _frame([('A', 'Active', None, None), ('B', 'Active', None, None)])
+    current[ROW_HASH_COLUMN] = compute_row_hash(current, types)
+    new = _frame([('B', 'Inactive', None, None), ('A', 'Active', None, None), ('C', 'Active', None, None)])
+    new[ROW_HASH_COLUMN] = compute_row_hash(new, types)
+
+    assert split_by_fingerprint(new, current[[KEY_COLUMN, ROW_HASH_COLUMN]]) == (['B'], ['C'])
+
+
+def test_sharded_diff_gets_a_pool_per_worker_count():
+    import sharded_diff
+
+    schema = get_roster_schema()
+    existing, new = make_frames(400, churn=0.2, seed=4)
+    existing, new = schema.conform(existing), schema.conform(new)
+    schema.share_categories(existing, new)
+    expected = records_to_insert(diff_scd2(existing, new, schema.names, RUN_DATE))
+    try:
+        for workers in (2, 3):
+            records = records_to_insert(sharded_diff.sharded_diff_scd2(existing, new, schema.names, RUN_DATE, workers))
+            pd.testing.assert_frame_equal(_as_text(records), _as_text(expected))
+            assert sharded_diff.get_pool(workers)._max_workers == workers
+        assert sharded_diff.get_pool(2) is not sharded_diff.get_pool(3)
+    finally:
+        sharded_diff.shutdown_pools()
+
+
+def test_sharded_fingerprint_split_matches_split_by_fingerprint():
+    import sharded_diff
+
+    schema = get_roster_schema()
+    existing, new = make_frames(400, churn=0.02, seed=5)
+    existing, new = schema.conform(existing), schema.conform(new)
+    current = existing.drop_duplicates(subset=[KEY_COLUMN], keep='last')
+    current = current.assign(**{ROW_HASH_COLUMN: compute_row_hash(current, schema.compared_types)})
+    fingerprints = current[[KEY_COLUMN, ROW_HASH_COLUMN]]
+    expected = split_by_fingerprint(new.assign(**{ROW_HASH_COLUMN: compute_row_hash(new, schema.compared_types)}), fingerprints)
+    try:
+        split = sharded_diff.sharded_fingerprint_split(new, fingerprints, schema.compared_types, workers=3)
+    finally:
+        sharded_diff.shutdown_pools()
+
+    assert split == expected
+    assert 0 < len(expected[0]) < 40 and len(expected[1]) == 8
+    assert ROW_HASH_COLUMN not in new.columns
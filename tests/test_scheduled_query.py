@@ -0,0 +1,95 @@
+"""Scheduled query triggers: one deferred run per window, requested for a time in the past."""
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import scheduled_query
+from ledger import SQLiteLedger
+
+WINDOW = scheduled_query.TRIGGER_WINDOW_SECONDS
+
+
+class FakeTransferClient:
+    def __init__(self, pending=(), fail=False):
+        self.pending = list(pending)
+        self.fail = fail
+        self.started = []
+
+    def transfer_config_path(self, project, config):
+        return f"projects/{project}/transferConfigs/{config}"
+
+    def list_transfer_runs(self, request):
+        return iter(self.pending)
+
+    def start_manual_transfer_runs(self, request):
+        if self.fail:
+            raise RuntimeError('transfer API unavailable')
+        self.started.append(request)
+        return SimpleNamespace(runs=[])
+
+
+@pytest.fixture
+def transfer(monkeypatch):
+    client = FakeTransferClient()
+    monkeypatch.setattr(scheduled_query, 'get_transfer_client', lambda: client)
+    monkeypatch.setattr(scheduled_query, 'TRANSFER_CONFIG_ID', 'config')
+    monkeypatch.setattr(scheduled_query, '_claimed_windows', set())
+    monkeypatch.setattr(scheduled_query, '_sleep', lambda seconds: None)
+    return client
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    return SQLiteLedger(str(tmp_path / 'ledger.sqlite'))
+
+
+def _window_start():
+    """Start of a window that has already closed, so the deferred call runs at once."""
+    return (int(time.time()) // WINDOW - 2) * WINDOW
+
+
+def test_requests_in_one_window_start_one_run(transfer, ledger, monkeypatch):
+    start = _window_start()
+    for offset in (0, 1, WINDOW // 2, WINDOW - 1):
+        scheduled_query.request_run(ledger, now=start + offset)
+    # Another instance, with its own memory, claims through the shared ledger
+    monkeypatch.setattr(scheduled_query, '_claimed_windows', set())
+    scheduled_query.request_run(ledger, now=start + 2)
+    assert scheduled_query.wait_for_runs(5) == 0
+
+    assert len(transfer.started) == 1
+    assert transfer.started[0]['parent'].endswith('/transferConfigs/config')
+    assert transfer.started[0]['requested_run_time'].seconds == start + WINDOW <= time.time()
+
+
+def test_each_window_gets_its_own_run(transfer, ledger):
+    start = _window_start() - WINDOW
+    scheduled_query.request_run(ledger, now=start)
+    scheduled_query.request_run(ledger, now=start + WINDOW)
+    assert scheduled_query.wait_for_runs(5) == 0
+    assert [run['requested_run_time'].seconds for run in transfer.started] == [start + WINDOW, start + 2 * WINDOW]
+
+
+def test_run_waits_for_its_window_to_close(transfer, monkeypatch):
+    slept = []
+    monkeypatch.setattr(scheduled_query, '_sleep', slept.append)
+    now = time.time()
+    scheduled_query.request_run(now=now)
+    assert scheduled_query.wait_for_runs(5) == 0
+    run_time = transfer.started[0]['requested_run_time'].seconds
+    assert run_time > now - 1 and slept[0] >= run_time - time.time()
+
+
+def test_pending_run_is_not_duplicated(transfer):
+    transfer.pending = [SimpleNamespace(name='runs/1')]
+    scheduled_query.request_run(now=_window_start())
+    assert scheduled_query.wait_for_runs(5) == 0
+    assert transfer.started == []
+
+
+def test_failed_trigger_is_retried_then_reported(transfer):
+    transfer.fail = True
+    scheduled_query.request_run(now=_window_start())
+    assert scheduled_query.wait_for_runs(5) == 1
+    assert transfer.started == []
@@ -0,0 +1,31 @@
+"""Compiling reference_schema.yaml into the roster's conversion plan."""
+import pytest
+
+from excel_to_pandas import get_roster_schema
+from schema_utils import compile_schema, load_schema
+
+
+def test_shipped_schema_compiles():
+    schema = get_roster_schema()
+
+    assert schema.key == 'emp_id'
+    assert schema.scd_date_columns == ['start_date', 'end_date']
+    assert get_roster_schema() is schema  # Parsed once per instance
+
+
+def test_original_bare_name_format_asks_for_an_upgrade(tmp_path):
+    path = tmp_path / 'reference_schema.yaml'
+    path.write_text('schema:\n  0: "emp_id"\n  1: "site"\n  2: "name"\n  24: "start_date"\n  25: "end_date"\n')
+
+    with pytest.raises(ValueError, match='bare column names'):
+        compile_schema(load_schema(str(path)))
+
+
+@pytest.mark.parametrize('entry, message', [
+    ({'name': 'emp_id', 'type': 'FLOAT64', 'role': 'key'}, 'Unsupported type'),
+    ({'name': 'emp_id', 'type': 'STRING', 'role': 'key', 'categorical': True}, 'cannot be categorical'),
+    ({'name': 'emp_id', 'type': 'STRING'}, 'exactly one column with role: key'),
+])
+def test_invalid_entries_are_rejected(entry, message):
+    with pytest.raises(ValueError, match=message):
+        compile_schema({0: entry})
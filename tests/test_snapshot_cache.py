@@ -0,0 +1,60 @@
+"""The cached current-state snapshot carried forward across writes."""
+import pandas as pd
+import pytest
+
+import main
+import snapshot_cache
+from benchmarks.roster_generator import write_export_series
+from config import PROJECT_ID, DATASET_NAME, CURRENT_TABLE_NAME
+from excel_to_pandas import get_roster_schema
+from gcp_clients import set_bigquery_client
+from local_warehouse import LocalWarehouseClient
+from scd2_diff import KEY_COLUMN
+
+CURRENT_TABLE_ID = f"{PROJECT_ID}.{DATASET_NAME}.{CURRENT_TABLE_NAME}"
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    client = LocalWarehouseClient()
+    set_bigquery_client(client)
+    monkeypatch.setattr(main, 'UPSERT_MODE', 'dataframe')
+    monkeypatch.setattr(main, 'trigger_scheduled_query', lambda *args, **kwargs: None)
+    monkeypatch.setattr(snapshot_cache, 'SNAPSHOT_CACHE_DIR', str(tmp_path / 'snapshot'))
+    monkeypatch.setattr(snapshot_cache, '_snapshots', {})
+    yield client
+    set_bigquery_client(None)
+
+
+def _sorted(df):
+    return df.sort_values(KEY_COLUMN, ignore_index=True)
+
+
+def test_updated_snapshot_matches_the_table(client, tmp_path):
+    for path in write_export_series(str(tmp_path / 'exports'), 150, exports=3, churn=0.2, new_hire_rate=0.1):
+        assert main.process_roster(path)
+
+    state, cached = snapshot_cache._snapshots[CURRENT_TABLE_ID]
+    assert state == snapshot_cache.table_state(client, DATASET_NAME, CURRENT_TABLE_NAME)
+    fresh = snapshot_cache.read_current_table(client, DATASET_NAME, CURRENT_TABLE_NAME, get_roster_schema())
+    pd.testing.assert_frame_equal(_sorted(cached), _sorted(fresh))
+    assert _sorted(cached).astype(str).equals(_sorted(fresh).astype(str))  # None is not read back as NaN
+
+
+def test_write_from_elsewhere_invalidates_the_snapshot(client, tmp_path, monkeypatch):
+    first, second = write_export_series(str(tmp_path / 'exports'), 50, exports=2, churn=0.2)
+    assert main.process_roster(first)
+    assert CURRENT_TABLE_ID in snapshot_cache._snapshots
+
+    # A hand edit between this run's snapshot read and its write; the row count stays the same
+    load_snapshot = main.load_snapshot
+
+    def edited_after_read(*args, **kwargs):
+        df = load_snapshot(*args, **kwargs)
+        client.query(f"UPDATE `{CURRENT_TABLE_ID}` SET site = 'Edited' WHERE {KEY_COLUMN} = '100000'").result()
+        return df
+
+    monkeypatch.setattr(main, 'load_snapshot', edited_after_read)
+    assert main.process_roster(second)
+
+    assert CURRENT_TABLE_ID not in snapshot_cache._snapshots
@@ -0,0 +1,43 @@
+"""Plan mode prices every read a run would make, on the SQLite stand-in of the warehouse."""
+import pytest
+
+import main
+import snapshot_cache
+import upload_plan
+from benchmarks.roster_generator import write_export_series
+from gcp_clients import set_bigquery_client
+from local_warehouse import LocalWarehouseClient
+
+
+@pytest.fixture
+def loaded_export(tmp_path, monkeypatch):
+    set_bigquery_client(LocalWarehouseClient())
+    monkeypatch.setattr(main, 'trigger_scheduled_query', lambda *args, **kwargs: None)
+    monkeypatch.setattr(snapshot_cache, 'SNAPSHOT_CACHE_DIR', str(tmp_path / 'snapshot'))
+    path = write_export_series(str(tmp_path / 'exports'), 100, exports=1)[0]
+    assert main.process_roster(path)
+    yield path
+    set_bigquery_client(None)
+
+
+def _plan(path, mode, monkeypatch):
+    monkeypatch.setattr(upload_plan, 'UPSERT_MODE', mode)
+    plan, = upload_plan.plan_upload(path)
+    assert plan['rows_to_append'] == 0  # The export is already loaded
+    return plan, {item['step']: item for item in plan['queries']}
+
+
+def test_current_state_read_is_priced_as_a_storage_read(loaded_export, monkeypatch):
+    plan, queries = _plan(loaded_export, 'dataframe', monkeypatch)
+
+    read = queries['current_state_read']
+    assert read['api'] == 'storage_read' and read['bytes'] > 0
+    assert plan['billed_bytes'] == read['bytes']
+    assert plan['estimated_cost_usd'] == round(read['bytes'] / 2**40 * upload_plan.PRICES_PER_TIB['storage_read'], 6)
+
+
+def test_merge_script_is_priced_even_when_nothing_changed(loaded_export, monkeypatch):
+    plan, queries = _plan(loaded_export, 'merge', monkeypatch)
+
+    assert queries['merge_script']['bytes'] > 0
+    assert plan['billed_bytes'] == queries['merge_script']['bytes']
@@ -0,0 +1,262 @@
+"""Plan what an upload would change, without writing anything.
+
+    python upload_plan.py gs://bucket/roster_2024-01-08.xlsx
+    python upload_plan.py ./roster_2024-01-08.xlsx --pipeline alo_roster --json
+
+The upload is parsed and diffed against each matching pipeline's current
+state the way process_file would (fingerprint split, then diff_scd2). The
+plan lists the employees whose current version would be closed and a new one
+opened, the new hires and the rows that would be appended to history. Every
+query a run would issue against the pipeline's tables is sized with a
+BigQuery dry run and priced at BQ_PRICE_PER_TIB; the current-state read goes
+through the Storage Read API and is priced at BQ_STORAGE_READ_PRICE_PER_TIB
+(nothing is read when the cached snapshot is still valid, so it is an upper
+bound). For scale, the plan also prices read_existing_data, the full-history
+read that diffing against the current-state table avoids.
+
+No table is created or altered, no load job runs, the ledger is not written
+and no scheduled query is triggered; only the snapshot cache may be
+refreshed by the current-state read. With PLAN_MODE=true process_file logs
+this plan for every upload instead of processing it.
+"""
+import argparse
+import json
+import logging
+from datetime import datetime
+
+import pandas as pd
+from google.cloud import bigquery
+
+from bigquery_upsert import CURRENT_VERSION_QUERY, TEXT_FORMAT_LABEL, TEXT_FORMAT_VERSION, existing_data_query
+from excel_to_pandas import detect_format, get_table_schema, read_to_dataframe
+from gcp_clients import get_bigquery_client, table_exists
+from pipelines import load_pipelines, match_pipelines
+from scd2_diff import KEY_COLUMN, ROW_HASH_COLUMN, compute_row_hash, diff_scd2, records_to_insert, split_by_fingerprint
+from snapshot_cache import load_snapshot, normalize_snapshot
+from config import PROJECT_ID, UPSERT_MODE, BQ_PRICE_PER_TIB, BQ_STORAGE_READ_PRICE_PER_TIB
+
+# Employee ids shown per list in the text report; --json prints them all
+SHOWN_IDS = 10
+# USD per TiB of each way a run reads its tables
+PRICES_PER_TIB = {'query': BQ_PRICE_PER_TIB, 'storage_read': BQ_STORAGE_READ_PRICE_PER_TIB}
+
+
+def dry_run_bytes(client, query, job_config=None):
+    """Bytes BigQuery would process for a query, from a dry run that runs nothing."""
+    job_config = job_config or bigquery.QueryJobConfig()
+    job_config.dry_run = True
+    job_config.use_query_cache = False
+    return int(client.query(query, job_config=job_config).total_bytes_processed or 0)
+
+
+def _has_row_hash(client, dataset_name, table_name):
+    table = client.get_table(f"{PROJECT_ID}.{dataset_name}.{table_name}")
+    return any(field.name == ROW_HASH_COLUMN for field in table.schema)
+
+
+def _has_text_format(client, dataset_name, table_name):
+    table = client.get_table(f"{PROJECT_ID}.{dataset_name}.{table_name}")
+    return (getattr(table, 'labels', None) or {}).get(TEXT_FORMAT_LABEL) == TEXT_FORMAT_VERSION
+
+
+def _rewrite_float_text(df, schema):
+    """The snapshot as migrate_text_format.py would leave it: '3001234567.0' read as '3001234567'."""
+    for col in schema.text_columns:
+        if schema.field_types[col] == 'STRING' and col in df.columns:
+            df[col] = df[col].astype('string').str.replace(r'^(-?[0-9]+)\.0$', r'\1', regex=True)
+    df = schema.conform(df)
+    df[ROW_HASH_COLUMN] = compute_row_hash(df, schema.compared_types)
+    return df
+
+
+def _scan_query(dataset_name, table_name, columns):
+    return f"SELECT {', '.join(columns)} FROM `{PROJECT_ID}.{dataset_name}.{table_name}`"
+
+
+def estimate_queries(client, pipeline, tables, changed):
+    """Dry-run estimate of each query a run of the pipeline would issue, in run order.
+
+    The refresh and merge scripts read staging tables that only exist during a
+    run, so they are priced by the scan of the current-state table they make.
+    """
+    schema = pipeline.schema
+    dataset_name, table_name, current_table_name = pipeline.dataset_name, pipeline.table_name, pipeline.current_table_name
+    table_columns = [field.name for field in get_table_schema(schema)]
+    estimates = []
+
+    def estimate(step, query, api='query', scans=1):
+        estimates.append({'step': step, 'bytes': scans * dry_run_bytes(client, query), 'api': api})
+
+    if tables['history']:
+        if not tables['row_hash']:
+            estimate('row_hash_backfill', _scan_query(dataset_name, table_name, list(schema.compared_types)))
+        if not tables['current']:
+            estimate('current_seed', CURRENT_VERSION_QUERY.format(
+                columns=', '.join(schema.names), table_id=f"{PROJECT_ID}.{dataset_name}.{table_name}", where=""))
+    if tables['current']:
+        current_scan = _scan_query(dataset_name, current_table_name, table_columns)
+        if UPSERT_MODE == 'merge':
+            # The script runs for every upload: it reads the current state to find changes, then scans it
+            # again to delete the changed rows, even when there are none
+            estimate('merge_script', current_scan, scans=2)
+        else:
+            estimate('current_state_read', current_scan, api='storage_read')
+            if changed:  # The append script deletes the opened employees' rows from the current state
+                estimate('append_script', current_scan)
+    return estimates
+
+
+def current_state(client, pipeline, tables):
+    """Current version of every employee, as the run would diff against it."""
+    schema = pipeline.schema
+    if tables['current']:
+        df = load_snapshot(client, pipeline.dataset_name, pipeline.current_table_name, schema)
+        return df if tables['current_text_format'] or df.empty else _rewrite_float_text(df, schema)
+    if not tables['history']:
+        return pd.DataFrame()
+    # The run would seed the current-state table from history first
+    query = CURRENT_VERSION_QUERY.format(columns=', '.join(schema.names),
+                                         table_id=f"{PROJECT_ID}.{pipeline.dataset_name}.{pipeline.table_name}", where="")
+    df = normalize_snapshot(read_to_dataframe(client.query(query), schema), schema)
+    if not tables['text_format']:
+        return _rewrite_float_text(df, schema)
+    df[ROW_HASH_COLUMN] = compute_row_hash(df, schema.compared_types)
+    return df
+
+
+def plan_pipeline(client, pipeline, frames, run_date=None):
+    """What upserting the parsed sheets of one pipeline would do; see the module docstring."""
+    schema = pipeline.schema
+    run_date = run_date or datetime.now().date()
+    tables = {'history': table_exists(client, pipeline.dataset_name, pipeline.table_name),
+              'current': table_exists(client, pipeline.dataset_name, pipeline.current_table_name)}
+    tables['row_hash'] = tables['history'] and _has_row_hash(client, pipeline.dataset_name, pipeline.table_name)
+    tables['text_format'] = not tables['history'] or _has_text_format(client, pipeline.dataset_name, pipeline.table_name)
+    tables['current_text_format'] = not tables['current'] or \
+        _has_text_format(client, pipeline.dataset_name, pipeline.current_table_name)
+
+    df_new = schema.conform(pd.concat(frames, ignore_index=True)) if len(frames) > 1 else frames[0]
+    df_new = df_new.dropna(subset=[KEY_COLUMN])[schema.names]
+    snapshot = current_state(client, pipeline, tables)
+
+    closed, new_hires, appended = [], df_new[KEY_COLUMN].drop_duplicates().tolist(), len(df_new)
+    if not snapshot.empty:
+        fingerprinted = df_new.assign(**{ROW_HASH_COLUMN: compute_row_hash(df_new, schema.compared_types)})
+        changed_ids, new_ids = split_by_fingerprint(fingerprinted, snapshot[[KEY_COLUMN, ROW_HASH_COLUMN]])
+        df_new = df_new[df_new[KEY_COLUMN].isin(changed_ids + new_ids)].reset_index(drop=True)
+        df_existing = snapshot[snapshot[KEY_COLUMN].isin(changed_ids)].drop(columns=[ROW_HASH_COLUMN])[schema.names]
+        df_existing = df_existing.reset_index(drop=True)
+        schema.share_categories(df_new, df_existing)
+        diff = diff_scd2(df_existing, df_new, schema.names, run_date)
+        closed = diff.closed[KEY_COLUMN].tolist()
+        new_hires = diff.new_hires[KEY_COLUMN].drop_duplicates().tolist()
+        appended = len(records_to_insert(diff))
+
+    estimates = estimate_queries(client, pipeline, tables, changed=bool(appended))
+    history_read = dry_run_bytes(client, existing_data_query(pipeline.dataset_name, pipeline.table_name, schema)) \
+        if tables['history'] else 0
+    billed_bytes = sum(item['bytes'] for item in estimates)
+    cost = sum(item['bytes'] / 2**40 * PRICES_PER_TIB[item['api']] for item in estimates)
+    return {
+        'pipeline': pipeline.name,
+        'table': f"{pipeline.dataset_name}.{pipeline.table_name}",
+        'mode': UPSERT_MODE,
+        'rows_in': sum(len(df) for df in frames),
+        'close_and_open': closed,
+        'new_hires': new_hires,
+        'rows_to_append': appended,
+        'would_trigger_scheduled_query': pipeline.trigger_scheduled_query and appended > 0,
+        'needs_text_format_migration': not (tables['text_format'] and tables['current_text_format']),
+        'queries': estimates,
+        'billed_bytes': billed_bytes,
+        'estimated_cost_usd': round(cost, 6),
+        'read_existing_data_bytes': history_read,
+    }
+
+
+def plan_upload(file_path, pipelines=None):
+    """Plans of every pipeline an upload matches, or of the given pipelines; [] when it cannot be parsed."""
+    from main import read_upload, load_sheet, upload_sheets
+
+    object_name = file_path.split('://', 1)[-1].split('/', 1)[-1] if '://' in file_path else file_path
+    pipelines = pipelines if pipelines is not None else match_pipelines(object_name)
+    data = read_upload(file_path)
+    if data is None or not pipelines:
+        return []
+    file_format = detect_format(file_path, data[:4])
+    client = get_bigquery_client()
+
+    plans = []
+    for pipeline in pipelines:
+        frames = [load_sheet(file_path, data, pipeline, sheet_name, file_format)
+                  for sheet_name in upload_sheets(pipeline, file_format)]
+        if any(df is None or df.empty for df in frames):
+            logging.error(f"A sheet of pipeline {pipeline.name} is empty or was not loaded correctly; no plan.")
+            continue
+        plans.append(plan_pipeline(client, pipeline, frames))
+    return plans
+
+
+def _size(num_bytes):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if num_bytes < 1024:
+            return f"{num_bytes:.0f} {unit}" if unit == 'B' else f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} TiB"
+
+
+def _ids(ids):
+    shown = ', '.join(str(emp_id) for emp_id in ids[:SHOWN_IDS])
+    return f"{shown}, ... ({len(ids) - SHOWN_IDS} more)" if len(ids) > SHOWN_IDS else shown
+
+
+def format_plan(plan):
+    """Human-readable report of one pipeline's plan."""
+    lines = [
+        f"Pipeline {plan['pipeline']} -> {plan['table']} ({plan['mode']} mode), {plan['rows_in']} rows parsed",
+        f"  close and reopen: {len(plan['close_and_open'])} employees {_ids(plan['close_and_open'])}".rstrip(),
+        f"  new hires:        {len(plan['new_hires'])} employees {_ids(plan['new_hires'])}".rstrip(),
+        f"  rows to append:   {plan['rows_to_append']}",
+        f"  scheduled query:  {'would be triggered' if plan['would_trigger_scheduled_query'] else 'not triggered'}",
+        "  queries (dry run):",
+    ]
+    if plan['needs_text_format_migration']:
+        lines.insert(-1, "  text format:      uploads fail until python migrate_text_format.py has run; "
+                         "the changes above assume it has")
+    for item in plan['queries']:
+        note = ' (Storage Read API)' if item['api'] == 'storage_read' else ''
+        lines.append(f"    {item['step']:<20} {_size(item['bytes']):>10}{note}")
+    if not plan['queries']:
+        lines.append("    none (the tables do not exist yet)")
+    lines.append(f"  billed: {_size(plan['billed_bytes'])}, about ${plan['estimated_cost_usd']:.4f} "
+                 f"at ${BQ_PRICE_PER_TIB}/TiB scanned and ${BQ_STORAGE_READ_PRICE_PER_TIB}/TiB read")
+    lines.append(f"  (a full-history read_existing_data would scan {_size(plan['read_existing_data_bytes'])})")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('file_path', help='upload to plan: a gs:// URL or a local path')
+    parser.add_argument('--pipeline', action='append', help='plan this registered pipeline (repeatable) '
+                                                            'instead of those matching the object name')
+    parser.add_argument('--json', action='store_true', help='print the plans as JSON, with every employee id')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(message)s")
+
+    pipelines = None
+    if args.pipeline:
+        registered = {pipeline.name: pipeline for pipeline in load_pipelines()}
+        unknown = [name for name in args.pipeline if name not in registered]
+        if unknown:
+            parser.error(f"unknown pipeline(s): {', '.join(unknown)}")
+        pipelines = [registered[name] for name in args.pipeline]
+
+    plans = plan_upload(args.file_path, pipelines)
+    if args.json:
+        print(json.dumps(plans, indent=2, default=str))
+    else:
+        print('\n\n'.join(format_plan(plan) for plan in plans) or f"Nothing to plan for {args.file_path}.")
+
+
+if __name__ == '__main__':
+    main()